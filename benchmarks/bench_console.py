@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+""" benchmark: qemu.readline(filter_all_control_chars = True) against the old per-byte path """
+
+# pylint: disable=invalid-name
+
+import argparse
+import os
+import re
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+os.environ.setdefault("INCLUDEOS_VMRUNNER",
+                      os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "vmrunner"))
+
+# pylint: disable=wrong-import-position
+from vmrunner import vmrunner
+from vmrunner.console import output_reader
+
+SEABIOS = (b"\x1bc\x1b[?7l\x1b[2J\x1b[0mSeaBIOS (version 1.16.3-debian-1.16.3-2)\r\n"
+           b"Booting from ROM..\r\n\x1b[H\x1b[J\x1b[1;1H\n")
+
+INCLUDEOS = (b"* Multiboot begin: 0x9500\n"
+             b"* Multiboot cmdline @ 0x234092: /nix/store/chainloader \"\"\n"
+             b"================================================================================\n\n"
+             b"                           #include<os> // Literally\n\n"
+             b"================================================================================\n"
+             b"     [ Kernel ] Stack: 0x1ffbe8\n"
+             b"     [ Kernel ] Boot magic: 0x2badb002, addr: 0x9500\n"
+             b"     [ x86_64 ] Initializing paging\n"
+             b"     [ Kernel ] Heap: 0x4000000 - 0x7ffffff (\xc3\xa6\xc3\xb8\xc3\xa5 64 MiB)\n"
+             b"\x1b[32m[ OK ]\x1b[0m Service started \x1b]0;includeos\x07\n"
+             b"     [ Timers ] Tick \x1b[1;33mwarning\x1b[0m: long running task\n")
+
+
+def transcript(size):
+    """ a console transcript of roughly size bytes: SeaBIOS followed by chatty IncludeOS output """
+    return SEABIOS + INCLUDEOS * (size // len(INCLUDEOS) + 1)
+
+
+def legacy_readline(stdout):
+    """ the filter_all_control_chars path before the streaming stripper """
+    control_sequence_pattern = re.compile(r'\x1b.*?[a-zA-Z]')
+    clean_buffer = bytearray()
+    control_buffer = bytearray()
+    inside_control_sequence = False
+    while True:
+        char = stdout.read(1)
+        if not char:
+            break
+        if char == b'\n':
+            clean_buffer.append(char[0])
+            break
+        if char == b'\x1B':
+            inside_control_sequence = True
+            control_buffer.append(char[0])
+        elif inside_control_sequence:
+            control_buffer.append(char[0])
+            if control_sequence_pattern.match(control_buffer.decode("utf-8", errors="replace")):
+                inside_control_sequence = False
+                control_buffer = bytearray()
+        else:
+            clean_buffer.append(char[0])
+    return clean_buffer.decode("utf-8", errors="replace")
+
+
+def feed_pipe(data):
+    """ a pipe with data written into it from a background thread, as from a hypervisor """
+    read_fd, write_fd = os.pipe()
+
+    def write():
+        with open(write_fd, "wb") as pipe:
+            pipe.write(data)
+
+    threading.Thread(target = write, daemon = True).start()
+    return open(read_fd, "rb") # pylint: disable=consider-using-with
+
+
+def run_legacy(data):
+    """ read all lines through the old path """
+    stdout = feed_pipe(data)
+    lines = 0
+    while legacy_readline(stdout):
+        lines += 1
+    return lines
+
+
+def run_streaming(data):
+    """ read all lines through qemu.readline """
+    hyper = vmrunner.qemu({})
+    hyper._reader = output_reader(feed_pipe(data)).start() # pylint: disable=protected-access
+    lines = 0
+    while hyper.readline(filter_all_control_chars = True):
+        lines += 1
+    return lines
+
+
+def measure(name, func, data):
+    """ time func over data and print throughput """
+    start = time.perf_counter()
+    cpu = time.process_time()
+    lines = func(data)
+    cpu = time.process_time() - cpu
+    wall = time.perf_counter() - start
+    print(f"{name:>10}: {lines} lines in {wall:.3f} s, {len(data) / wall / 2**20:.1f} MiB/s, "
+          f"{cpu / lines * 1e6:.2f} us CPU/line")
+    return wall
+
+
+def main():
+    """ run the benchmark """
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument("--size", type = int, default = 4, help = "Transcript size in MiB")
+    parser.add_argument("--skip-legacy", action = "store_true",
+                        help = "Only run the streaming path")
+    args = parser.parse_args()
+
+    data = transcript(args.size * 2**20)
+    print(f"Transcript: {len(data) / 2**20:.1f} MiB")
+
+    streaming = measure("streaming", run_streaming, data)
+    if not args.skip_legacy:
+        legacy = measure("legacy", run_legacy, data)
+        print(f"Speedup: {legacy / streaming:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+""" benchmark: time to import vmrunner and to run boot --help, on top of interpreter startup """
+
+# pylint: disable=invalid-name
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+root = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..")
+
+COMMANDS = {"python" : ["-c", "pass"],
+            "import" : ["-c", "import vmrunner.vmrunner"],
+            "boot --help" : ["-m", "vmrunner.boot", "--help"]}
+
+
+def environment():
+    """ run from the source tree, with nothing that makes vmrunner do more than it needs to """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = root + os.pathsep + env.get("PYTHONPATH", "")
+    env.pop("VERBOSE", None)
+    return env
+
+
+def run(args, env):
+    """ wall time of one run of the interpreter, in milliseconds """
+    start = time.perf_counter()
+    subprocess.run([sys.executable] + args, env = env, check = True,
+                   stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+    return (time.perf_counter() - start) * 1000
+
+
+def slowest_imports(env, count = 8):
+    """ the imports taking the most time, from python -X importtime """
+    output = subprocess.run([sys.executable, "-X", "importtime"] + COMMANDS["import"], env = env,
+                            check = True, capture_output = True, text = True).stderr
+    imports = []
+    for line in output.splitlines()[1:]:
+        _, cumulative, name = line.split("|")
+        imports.append((int(cumulative) / 1000, name.strip()))
+    return sorted(imports, reverse = True)[:count]
+
+
+def main():
+    """ run the benchmark, exits non-zero if importing vmrunner takes longer than --max-ms """
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument("--runs", type = int, default = 20, help = "Runs per command")
+    parser.add_argument("--max-ms", type = float, default = 75,
+                        help = "Fail if importing vmrunner adds more than this many ms, "
+                        "median over all runs")
+    args = parser.parse_args()
+
+    env = environment()
+
+    # Warm up, which also writes bytecode caches
+    for command in COMMANDS.values():
+        run(command, env)
+
+    medians = {}
+    for name, command in COMMANDS.items():
+        medians[name] = statistics.median(run(command, env) for _ in range(args.runs))
+
+    baseline = medians["python"]
+    for name, median in medians.items():
+        extra = "" if name == "python" else f", +{median - baseline:.1f} ms over python"
+        print(f"{name:>12}: {median:.1f} ms{extra}")
+
+    overhead = medians["import"] - baseline
+    if overhead > args.max_ms:
+        print(f"\nImporting vmrunner adds {overhead:.1f} ms, more than {args.max_ms} ms. "
+              "Slowest imports (cumulative ms):")
+        for ms, name in slowest_imports(env):
+            print(f"  {ms:8.1f}  {name}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+""" benchmark: vm.trigger_event pattern matching with many on_output patterns """
+
+# pylint: disable=invalid-name
+
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+
+# pylint: disable=wrong-import-position
+from vmrunner.matcher import output_matcher
+
+LINES = ["     [ Kernel ] Stack: 0x1ffbe8",
+         "     [ x86_64 ] Initializing paging",
+         "     [ TCP ] Connection 10.0.0.42:8080 -> 10.0.0.1:51234 established",
+         "     [ Timers ] Tick 123456: long running task",
+         "[ Net ] RX packet len=1514 queue=3 desc=42",
+         "     [ Kernel ] Heap: 0x4000000 - 0x7ffffff (64 MiB)",
+         "Received 1024 bytes from client 17",
+         "     [ Memory ] alloc 4096 @ 0x7f001000"]
+
+
+def patterns(count):
+    """ a mix of literal and regex patterns, like those registered by large integration tests """
+    result = []
+    for i in range(count):
+        if i % 3 == 0:
+            result.append(rf"Test {i} \w+ after \d+ ms")
+        elif i % 3 == 1:
+            result.append(f"Subtest {i} passed")
+        else:
+            result.append(rf"client {i}\d* disconnected")
+    # A few that do match the transcript
+    result += [r"Received \d+ bytes", "Connection", "SUCCESS",
+               re.escape(r"\x15\x07\t**** PANIC ****")]
+    return result
+
+
+def run_legacy(pats, lines):
+    """ the old trigger_event loop: one re.search per pattern per line """
+    callbacks = {p: len for p in pats}
+    hits = 0
+    for line in lines:
+        for pattern, func in callbacks.items():
+            if re.search(pattern, str(line)):
+                func(line)
+                hits += 1
+    return hits
+
+
+def run_matcher(pats, lines):
+    """ the compiled matcher used by trigger_event """
+    matcher = output_matcher({p: len for p in pats})
+    hits = 0
+    for line in lines:
+        for func in matcher.match(str(line)):
+            func(line)
+            hits += 1
+    return hits
+
+
+def measure(name, func, pats, lines):
+    """ time func and print the per line cost """
+    start = time.perf_counter()
+    hits = func(pats, lines)
+    wall = time.perf_counter() - start
+    print(f"{name:>8}: {len(pats)} patterns, {len(lines)} lines, {hits} hits, "
+          f"{len(lines) / wall:,.0f} lines/s, {wall / len(lines) * 1e6:.2f} us/line")
+    return wall
+
+
+def main():
+    """ run the benchmark """
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument("--patterns", type = int, nargs = "+", default = [10, 100, 200],
+                        help = "Numbers of patterns to measure")
+    parser.add_argument("--lines", type = int, default = 200000,
+                        help = "Transcript length in lines")
+    args = parser.parse_args()
+
+    lines = (LINES * (args.lines // len(LINES) + 1))[:args.lines]
+
+    for count in args.patterns:
+        pats = patterns(count)
+        legacy = measure("legacy", run_legacy, pats, lines)
+        matcher = measure("matcher", run_matcher, pats, lines)
+        print(f"Speedup: {legacy / matcher:.1f}x\n")
+
+
+if __name__ == "__main__":
+    main()
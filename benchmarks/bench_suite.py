@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+""" benchmark suite: vmrunner hot paths against a stub hypervisor, comparable over time.
+
+Runs on any Linux box, no qemu needed. stub_hypervisor.py stands in for qemu, printing
+synthetic SeaBIOS and IncludeOS output. Measured:
+
+  boot              - vm.boot reading and handling all output, lines/s and CPU per line
+  readline          - qemu.readline, the path vm.boot uses
+  readline_filtered - qemu.readline(filter_all_control_chars = True)
+  trigger_event_N   - vm.trigger_event with N extra on_output patterns, per line
+  load_config       - vmrunner.load_with_default_config, with schema validation
+  boot_command      - building the qemu command line for a multiboot kernel
+
+CPU time is this process's only, not the stub's. Each case runs --repeat times, and the
+median is reported. On-disk caches are disabled, so every run does the same work. Save
+results with --json, and compare a later run against them with --compare """
+
+# pylint: disable=invalid-name, too-few-public-methods
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(here, ".."))
+os.environ.setdefault("INCLUDEOS_VMRUNNER", os.path.join(here, "..", "vmrunner"))
+os.environ["VMRUNNER_CACHE_DIR"] = ""
+
+# pylint: disable=wrong-import-position
+from bench_matcher import patterns, LINES
+from vmrunner import vmrunner
+
+EXIT_LINE = "     [ Kernel ] service exited with status"
+
+
+def elf32_kernel(path):
+    """ write a minimal 32-bit ELF executable header to path, enough to be booted directly """
+    ident = b"\x7fELF" + bytes([1, 1, 1]) + bytes(9)
+    header = ident + struct.pack("<HHIIIIIHHHHHH", 2, 3, 1, 0x100000, 52, 0, 0, 52, 32, 0, 40, 0, 0)
+    with open(path, "wb") as f:
+        f.write(header.ljust(4096, b"\0"))
+
+
+class workspace:
+    """ a temporary directory holding the stub hypervisor, a kernel and a vm.json """
+
+    def __init__(self):
+        self._dir = tempfile.TemporaryDirectory(prefix = "vmrunner-bench-") # pylint: disable=consider-using-with
+        self.hypervisor = os.path.join(self._dir.name, "qemu")
+        with open(self.hypervisor, "w", encoding = "utf-8") as f:
+            f.write(f"#!/bin/sh\nexec \"{sys.executable}\" "
+                    f"\"{os.path.join(here, 'stub_hypervisor.py')}\" \"$@\"\n")
+        os.chmod(self.hypervisor, 0o755)
+
+        self.kernel = os.path.join(self._dir.name, "kernel")
+        elf32_kernel(self.kernel)
+
+        disk = os.path.join(self._dir.name, "disk.img")
+        with open(disk, "wb") as f:
+            f.truncate(2**20)
+
+        self.config = {"qemu" : self.hypervisor,
+                       "mem" : 128,
+                       "net" : [{"device" : "virtio", "backend" : "user"}],
+                       "drives" : [{"file" : disk, "type" : "virtio", "format" : "raw",
+                                    "media" : "disk"}]}
+        self.config_path = os.path.join(self._dir.name, "vm.json")
+        with open(self.config_path, "w", encoding = "utf-8") as f:
+            json.dump(self.config, f)
+
+    def close(self):
+        """ remove the directory """
+        self._dir.cleanup()
+
+
+def timed(func):
+    """ run func, returning its result with the wall and CPU seconds it took """
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    result = func()
+    return result, time.perf_counter() - wall, time.process_time() - cpu
+
+
+def throughput(lines, wall, cpu):
+    """ metrics of reading lines """
+    return {"lines/s" : lines / wall, "us CPU/line" : cpu / lines * 1e6}
+
+
+def bench_boot(ws, lines):
+    """ vm.boot against the stub until it prints its exit status """
+    vm = vmrunner.vm(config = ws.config_path, exit_program = False).set_output(echo = False)
+    _, wall, cpu = timed(lambda : vm.boot(timeout = 600, image_name = ws.kernel))
+    if vm.exit_status() != 0:
+        raise Exception(f"Stub VM exited with {vm.exit_status()}: {vm.exit_msg()}") # pylint: disable=broad-exception-raised
+    return throughput(lines, wall, cpu)
+
+
+def bench_readline(ws, lines, filter_all_control_chars = False):
+    """ qemu.readline on the stub's output until its exit status """
+    hyper = vmrunner.qemu(ws.config)
+    hyper.start_process([ws.hypervisor])
+
+    def read():
+        while line := hyper.readline(filter_all_control_chars):
+            if line.startswith(EXIT_LINE):
+                break
+
+    try:
+        _, wall, cpu = timed(read)
+    finally:
+        hyper.stop()
+    return throughput(lines, wall, cpu)
+
+
+def bench_trigger_event(ws, count, lines = 100000):
+    """ vm.trigger_event with count extra patterns registered, none of them exiting """
+    vm = vmrunner.vm(config = ws.config_path, exit_program = False).set_output(echo = False)
+    for pattern in patterns(count)[:count]:
+        vm.on_output(pattern, len)
+    transcript = (LINES * (lines // len(LINES) + 1))[:lines]
+
+    def run():
+        for line in transcript:
+            vm.trigger_event(line)
+
+    _, wall, _ = timed(run)
+    return {"us/line" : wall / lines * 1e6}
+
+
+def bench_load_config(ws, runs = 200):
+    """ load and validate vm.json on top of the default config """
+    _, wall, _ = timed(lambda : [vmrunner.load_with_default_config(True, ws.config_path)
+                                 for _ in range(runs)])
+    return {"ms/call" : wall / runs * 1e3}
+
+
+def bench_boot_command(ws, runs = 200):
+    """ build the qemu command line for a multiboot kernel """
+    hyper = vmrunner.qemu(ws.config)
+    _, wall, _ = timed(lambda : [hyper.boot_command(multiboot = True, kernel_args = "bench",
+                                                    image_name = ws.kernel)
+                                 for _ in range(runs)])
+    return {"ms/call" : wall / runs * 1e3}
+
+
+def cases(ws, args):
+    """ name and function of each case """
+    lines = args.lines
+    result = [("boot", lambda : bench_boot(ws, lines)),
+              ("readline", lambda : bench_readline(ws, lines)),
+              ("readline_filtered", lambda : bench_readline(ws, lines, True))]
+    for count in args.patterns:
+        result.append((f"trigger_event_{count}",
+                       lambda count = count : bench_trigger_event(ws, count)))
+    result += [("load_config", lambda : bench_load_config(ws)),
+               ("boot_command", lambda : bench_boot_command(ws))]
+    return [(name, func) for name, func in result
+            if not args.only or any(name.startswith(prefix) for prefix in args.only)]
+
+
+def metadata(args):
+    """ what the results depend on, besides vmrunner itself """
+    try:
+        revision = subprocess.run(["git", "-C", here, "rev-parse", "--short", "HEAD"], check = True,
+                                  capture_output = True, text = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {"time" : time.time(),
+            "revision" : revision,
+            "python" : platform.python_version(),
+            "implementation" : platform.python_implementation(),
+            "platform" : platform.platform(),
+            "cpus" : os.cpu_count(),
+            "parameters" : {"lines" : args.lines, "rate" : args.rate, "length" : args.length,
+                            "control" : args.control, "repeat" : args.repeat}}
+
+
+def compare(results, path):
+    """ print how results changed from those saved in path """
+    with open(path, encoding = "utf-8") as f:
+        old = json.load(f)
+    if old["meta"]["parameters"] != results["meta"]["parameters"]:
+        print("Warning: the saved results were measured with other parameters: "
+              f"{old['meta']['parameters']}")
+    print(f"\nCompared to {path} (revision {old['meta']['revision']}):")
+    for name, metrics in results["results"].items():
+        for metric, value in metrics.items():
+            before = old["results"].get(name, {}).get(metric)
+            if before:
+                print(f"{name:>20}: {metric:>12} {before:12,.2f} -> {value:12,.2f} "
+                      f"({(value - before) / before * 100:+.1f}%)")
+
+
+def main():
+    """ run the suite """
+    parser = argparse.ArgumentParser(description = __doc__,
+                                     formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lines", type = int, default = 100000,
+                        help = "Lines of output from the stub per boot")
+    parser.add_argument("--rate", type = float, default = 0,
+                        help = "Lines per second from the stub, 0 for as fast as possible")
+    parser.add_argument("--length", type = int, default = 80, help = "Characters per line")
+    parser.add_argument("--control", type = float, default = 0.1,
+                        help = "Fraction of lines with terminal control sequences")
+    parser.add_argument("--patterns", type = int, nargs = "+", default = [0, 10, 100, 1000],
+                        help = "Numbers of on_output patterns for trigger_event")
+    parser.add_argument("--repeat", type = int, default = 3, help = "Runs per case")
+    parser.add_argument("--only", nargs = "+", metavar = "CASE",
+                        help = "Only run cases starting with these names")
+    parser.add_argument("--json", metavar = "PATH", help = "Write results to PATH")
+    parser.add_argument("--compare", metavar = "PATH",
+                        help = "Compare with results written by an earlier --json")
+    args = parser.parse_args()
+
+    os.environ.update({"STUB_LINES" : str(args.lines), "STUB_RATE" : str(args.rate),
+                       "STUB_LENGTH" : str(args.length), "STUB_CONTROL" : str(args.control)})
+
+    ws = workspace()
+    results = {"meta" : metadata(args), "results" : {}}
+    try:
+        for name, func in cases(ws, args):
+            runs = [func() for _ in range(args.repeat)]
+            medians = {metric : statistics.median(run[metric] for run in runs)
+                       for metric in runs[0]}
+            results["results"][name] = medians
+            print(f"{name:>20}: " + ", ".join(f"{value:,.2f} {metric}"
+                                              for metric, value in medians.items()))
+    finally:
+        ws.close()
+
+    if args.json:
+        with open(args.json, "w", encoding = "utf-8") as f:
+            json.dump(results, f, indent = 2)
+            f.write("\n")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+""" a stand-in for qemu printing synthetic SeaBIOS and IncludeOS output, for the benchmarks.
+
+Ignores its arguments, which are qemu's. The output is set through the environment:
+
+  STUB_LINES    - lines of service output after the banners (default 100000)
+  STUB_RATE     - lines per second, 0 for as fast as the pipe takes them (default 0)
+  STUB_LENGTH   - characters per line (default 80)
+  STUB_CONTROL  - fraction of lines with terminal control sequences, 0 to 1 (default 0.1)
+  STUB_SEED     - seed for choosing those lines, so every run prints the same (default 1)
+
+and ends with the service exit status line, so the VM exits with status 0 """
+
+# pylint: disable=invalid-name
+
+import os
+import random
+import sys
+import time
+
+SEABIOS = (b"\x1bc\x1b[?7l\x1b[2J\x1b[0mSeaBIOS (version 1.16.3-debian-1.16.3-2)\r\n"
+           b"Booting from ROM..\r\n\x1b[H\x1b[J\x1b[1;1H\n")
+
+INCLUDEOS = (b"* Multiboot begin: 0x9500\n"
+             b"================================================================================\n\n"
+             b"                           #include<os> // Literally\n\n"
+             b"================================================================================\n"
+             b"     [ Kernel ] Stack: 0x1ffbe8\n"
+             b"     [ x86_64 ] Initializing paging\n")
+
+EXIT = b"     [ Kernel ] service exited with status 0\n"
+
+# Batches are written at least this often when rate limited
+INTERVAL = 0.01
+
+
+def lines(count, length, control, seed):
+    """ count synthetic lines of about length characters, a control fraction of them colored """
+    rng = random.Random(seed)
+    plain = b"     [ Service ] "
+    colored = b"\x1b[32m[ OK ]\x1b[0m \x1b[1;33m"
+    for i in range(count):
+        prefix = colored if rng.random() < control else plain
+        text = prefix + f"{i} ".encode()
+        yield text + b"x" * max(length - len(text), 0) + b"\n"
+
+
+def main():
+    """ print the output """
+    count = int(os.environ.get("STUB_LINES", 100000))
+    rate = float(os.environ.get("STUB_RATE", 0))
+    length = int(os.environ.get("STUB_LENGTH", 80))
+    control = float(os.environ.get("STUB_CONTROL", 0.1))
+    seed = int(os.environ.get("STUB_SEED", 1))
+
+    out = sys.stdout.buffer
+    out.write(SEABIOS + INCLUDEOS)
+
+    batch = max(int(rate * INTERVAL), 1) if rate else 1024
+    pending = []
+    start = time.monotonic()
+    for i, line in enumerate(lines(count, length, control, seed), 1):
+        pending.append(line)
+        if len(pending) >= batch:
+            out.write(b"".join(pending))
+            pending.clear()
+            if rate:
+                out.flush()
+                delay = start + i / rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+    out.write(b"".join(pending) + EXIT)
+    out.flush()
+
+    # Like qemu, keep running until stopped
+    time.sleep(60)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+""" asyncio driver for vmrunner VMs """
+
+# pylint: disable=invalid-name, invalid-overridden-method, too-many-arguments, too-many-instance-attributes
+# pylint: disable=broad-exception-raised, broad-exception-caught
+# The event loop mirrors vm.boot's, awaiting where it blocks
+# pylint: disable=duplicate-code
+
+import asyncio
+import collections
+
+from . import vmrunner
+from .vmrunner import color, info, exit_codes, message, print_exception
+from .console import CHUNK_SIZE, EOT, READ_UNTIL_LIMIT, split_lines, until_marker
+from . import deadlines
+from .metrics import boot_metrics
+
+
+class async_vm(vmrunner.vm):
+    """ A VM driven by coroutines on an asyncio event loop.
+
+    boot, readline, writeline, flush, stop and wait are coroutines. boot starts the
+    hypervisor with asyncio.create_subprocess_exec and processes its output until the VM
+    exits. Callbacks registered with on_output, on_success, on_panic, on_timeout and on_exit
+    are plain functions, called just like for vm. Timeouts are called on the event loop,
+    from the deadline scheduler shared by all VMs, so a VM needs no threads of its own and
+    one event loop can supervise many VMs, e.g. with asyncio.gather. Async VMs never exit
+    the program, see vm.exit_status. """
+
+    def __init__(self, config = None, hyper_name = "qemu"):
+        super().__init__(config, hyper_name, exit_program = False)
+        self._loop = None
+        self._proc = None
+        self._sudo = False
+        self._terminated = False   # Set once the hypervisor has been told to stop
+        self._stop_task = None     # Task stopping the hypervisor through QMP or with sudo kill
+        self._lines = collections.deque() # Output lines read from the hypervisor, not consumed yet
+        self._partial = b""               # An unfinished line following them
+        self._panicked = False     # Set by panic, the rest of the panic is read by flush
+        self._exit_requested = False
+        self._keep_running = False
+
+    async def boot(self, timeout = 60, multiboot = True, debug = False,
+                   kernel_args = "booted with vmrunner", image_name = None,
+                   allow_sudo = False, enable_kvm = False, snapshot_at = None,
+                   metrics_file = None):
+        """ Boot the VM and process its output until it exits. See vm.boot for snapshot_at
+        and metrics_file. Saving the VM state blocks the event loop until it's written """
+        info ("Async VM boot, timeout: ", timeout, "multiboot: ", multiboot,
+              "Kernel_args: ", kernel_args, "image_name: ", image_name, allow_sudo, "allow_sudo")
+
+        self._allow_sudo = allow_sudo
+        self._enable_kvm = enable_kvm
+
+        # This might be a reboot
+        self._exit_status = None
+        self._exit_msg = ""
+        self._exit_complete = False
+        self._exit_requested = False
+        self._keep_running = False
+        self._panicked = False
+        self._terminated = False
+        self._stop_task = None
+        self._lines.clear()
+        self._partial = b""
+        self._timeout_after = timeout
+        self._metrics = boot_metrics()
+        self._metrics_file = metrics_file
+        self._watch_phases = True
+        self._loop = asyncio.get_running_loop()
+
+        self.cancel_deadlines()
+        self._counting = True
+        self._timer = None
+        if timeout:
+            info("setting timeout to",timeout,"seconds")
+            self._timer = self.deadline(timeout, self._on_timeout)
+        for expected in self._expected:
+            self.start_expecting(*expected)
+
+        # Boot via hypervisor. Building the command reads kernel headers, may build overlays
+        # and start virtiofsd, so it's done in a worker thread to keep the event loop responsive.
+        try:
+            self._hyper.set_snapshot(snapshot_at)
+            command = await asyncio.to_thread(self._hyper.boot_command, multiboot, debug,
+                                              kernel_args, image_name, allow_sudo, enable_kvm)
+            self._hyper.check_sudo(command)
+            self._sudo = command[0] == "sudo"
+            # pylint: disable-next=assignment-from-none
+            self._snapshot_at = self._hyper.snapshot_marker()
+            self._proc = await asyncio.create_subprocess_exec(*command,
+                                                              stdout = asyncio.subprocess.PIPE,
+                                                              stderr = asyncio.subprocess.STDOUT,
+                                                              stdin = asyncio.subprocess.PIPE)
+            self._metrics.mark("spawn")
+            info("Started process PID ", self._proc.pid)
+        except Exception as err:
+            message(color.WARNING("Exception raised while booting: "))
+            print_exception()
+            self.exit(exit_codes["BOOT_FAILED"], str(err))
+            self._finish()
+            return self
+
+        # Timed out or stopped while starting
+        if self._exit_status is not None:
+            self._terminate()
+
+        await self.flush()
+
+        # VM Done. Stop it if needed and print what's left of the output
+        info("Event loop done. Exit status:", self._exit_status, "poll:", self.poll())
+        self._terminate()
+        while line := await self.readline():
+            self.emit(line.rstrip())
+
+        await self.stop()
+        if self._exit_status is None and self.poll() and self._hyper.discard_snapshot():
+            message(color.WARNING("VM exited after restoring a saved state. The state is "
+                                "discarded, the next boot starts from scratch"))
+        self._finish()
+        return self
+
+    def _finish(self):
+        """ settle the exit status and call exit callbacks, like vm.exit """
+        self.cancel_deadlines()
+
+        if self._exit_status is None:
+            self._exit_status = self.poll()
+            self._exit_msg = "process exited"
+
+        if self.poll() is not None:
+            self._metrics.mark("reap")
+        self.finish_metrics()
+        self.log_exit()
+        self.flush_output()
+
+        info("Exit with status", self._exit_status,
+             "(",vmrunner.get_exit_code_name(self._exit_status),")")
+        info("Message:", self._exit_msg, "Keep running: ", self._keep_running)
+
+        if self._keep_running:
+            return
+
+        if self._on_exit:
+            info("Calling on_exit")
+            self._on_exit()
+
+        if self._exit_status == 0:
+            if self._on_exit_success:
+                info("Calling on_exit_success")
+                self._on_exit_success()
+
+            if self._echo:
+                message(color.SUCCESS(self._exit_msg))
+
+        self._exit_complete = True
+
+    def _terminate(self):
+        """ start stopping the hypervisor process, without waiting for it """
+
+        # Don't try to kill twice. Signalling again could reap the process behind asyncio's back.
+        if self._terminated or self._proc is None or self._proc.returncode is not None:
+            return
+
+        self._terminated = True
+        if self._hyper.has_qmp():
+            self._stop_task = self._loop.create_task(self._quit())
+        else:
+            self._signal()
+
+    def _signal(self):
+        """ terminate the hypervisor process, with sudo kill if it was started with sudo """
+        if not self._sudo:
+            info ("Stopping child process (no sudo required)")
+            try:
+                self._proc.terminate()
+            except ProcessLookupError:
+                pass
+        else:
+            self._stop_task = self._loop.create_task(self._stop_sudo())
+
+    async def _quit(self):
+        """ ask qemu to quit through QMP, like qemu.quit, falling back to signals """
+        if await asyncio.to_thread(self._hyper.request_quit):
+            try:
+                await asyncio.wait_for(self._proc.wait(), vmrunner.QUIT_TIMEOUT)
+                info ("Stopped", self._hyper.image_name(), "through QMP")
+                return
+            except asyncio.TimeoutError:
+                message(color.WARNING(f"Qemu didn't quit within {vmrunner.QUIT_TIMEOUT} seconds"))
+
+        if self._proc.returncode is None and not self._sudo:
+            self._proc.terminate()
+        elif self._proc.returncode is None:
+            await self._stop_sudo()
+
+    async def _stop_sudo(self):
+        """ terminate the children of a hypervisor started with sudo, like qemu.stop """
+        import psutil # pylint: disable=import-outside-toplevel
+        try:
+            children = psutil.Process(self._proc.pid).children()
+        except psutil.NoSuchProcess:
+            return
+
+        for child in children:
+            info (" + child process ", child.pid)
+            if self._proc.returncode is None:
+                kill = await asyncio.create_subprocess_exec("sudo", "kill", "-SIGTERM",
+                                                            str(child.pid))
+                await kill.wait()
+
+    async def stop(self):
+        """ stop hypervisor and wait for it to exit """
+        self.cancel_deadlines()
+        self._terminate()
+        if self._stop_task:
+            await self._stop_task
+        if self._proc:
+            await self._proc.wait()
+        if self._hyper.has_qmp():
+            self._hyper.close_qmp()
+        await asyncio.to_thread(self._hyper.close_virtiofs)
+        return self
+
+    async def flush(self):
+        """ read and process output until the VM has an exit status or all output has been read """
+        while self._exit_status is None:
+            try:
+                line = await self.readline()
+            except Exception as e:
+                message(color.WARNING(f"Exception thrown while waiting for vm output: {e}"))
+                break
+
+            # Empty line - all output has been read, e.g. the process exited
+            if not line:
+                break
+
+            # Saving the VM state may take a while, so it's done here in a worker thread,
+            # instead of by handle_line on the event loop
+            if self._snapshot_at and self._snapshot_at in line:
+                self._snapshot_at = None
+                await asyncio.to_thread(self._hyper.save_snapshot)
+
+            self.handle_line(line)
+
+            if self._panicked:
+                await self._read_panic()
+
+    async def wait(self):
+        """ wait for the hypervisor to exit, returns the exit status """
+        if self._proc:
+            await self._proc.wait()
+        return self._exit_status
+
+    def poll(self):
+        """ exit code of the hypervisor process, or None while it's running """
+        return self._proc.returncode if self._proc else None
+
+    def exit(self, status, msg, keep_running = False):
+        """ Stop the VM with exit status / msg. Set keep_running to skip the exit callbacks.
+            The VM is stopped, and callbacks are called, by boot once it's done """
+
+        # Exit may have been called allready
+        if self._exit_complete or self._exit_requested:
+            return
+
+        self._exit_requested = True
+        self._exit_status = status
+        self._exit_msg = msg
+        self._keep_running = keep_running
+        self._terminate()
+
+    def deadline(self, seconds, callback):
+        """ call callback on the event loop in seconds, unless the returned deadline is
+            cancelled. The deadline is kept by the scheduler shared with threaded VMs """
+        loop = self._loop
+        def call():
+            # Unless the VM finished while this was queued
+            if self._counting:
+                callback()
+        def call_soon():
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(call)
+        return deadlines.after(seconds, call_soon)
+
+    def timeout(self):
+        """ Default timeout event """
+        if vmrunner.VERB:
+            message(color.INFO("<timeout>"), "VM timed out")
+
+        self._exit_status = exit_codes["TIMEOUT"]
+        self._exit_msg = "vmrunner timed out after " + str(self._timeout_after) + " seconds"
+        self._terminate()
+        self.dump_recent("VM timed out")
+
+    def missed(self, output, seconds):
+        """ Default event for output expected by expect that wasn't seen in time """
+        self._exit_status = exit_codes["TIMEOUT"]
+        self._exit_msg = f"{output} not seen within {seconds} seconds"
+        self._terminate()
+        self.dump_recent(self._exit_msg)
+
+    def panic(self, _):
+        """ Default panic event. Reading the panic needs the event loop, so it's left to flush """
+        self._panicked = True
+
+    async def _read_panic(self):
+        """ read the panic reason and output until EOT, then exit """
+        self._panicked = False
+        panic_reason = await self.readline()
+        info("VM signalled PANIC. Reading until EOT (", hex(ord(vmrunner.EOT)), ")")
+        self.emit(panic_reason.rstrip(), "panic")
+        remaining_output = await self.read_until_EOT()
+        for line in remaining_output.split("\n"):
+            self.emit(line, "panic")
+
+        self.dump_recent("VM panicked")
+
+        self.exit(exit_codes["VM_PANIC"], panic_reason)
+
+    async def _read_more(self):
+        """ read the next chunk of output and split it into lines, returns False at end of file """
+        chunk = await self._proc.stdout.read(CHUNK_SIZE)
+        if not chunk:
+            if not self._partial:
+                return False
+            self._lines.append(self._partial)
+            self._partial = b""
+            return True
+
+        self._metrics.mark("first_byte")
+        lines, self._partial = split_lines(self._partial + chunk)
+        self._lines.extend(lines)
+        return True
+
+    async def readline(self):
+        """ Read a line from the VM's standard out, returns an empty string at end of file """
+        if self._proc is None:
+            return ""
+
+        while self._lines or await self._read_more():
+            if not self._lines:
+                continue
+
+            # Lines trimmed away entirely, like the end of the SeaBIOS banner, are skipped
+            line = self._hyper.decode_line(self._lines.popleft())
+            if line:
+                return line
+
+        return ""
+
+    async def read_until_EOT(self, limit = READ_UNTIL_LIMIT):
+        """ read output until EOT, keeping at most limit bytes. Output after the EOT is kept """
+        collector = until_marker(EOT, limit)
+
+        while self._lines or await self._read_more():
+            chunk = b"".join(self._lines)
+            self._lines.clear()
+
+            rest = collector.feed(chunk)
+            if rest is not None:
+                self._lines.extend(split_lines(rest)[0])
+                break
+
+        if collector.skipped:
+            message(color.WARNING(f"Output before EOT exceeded {limit} bytes, "
+                                  f"{collector.skipped} bytes dropped"))
+        return collector.data.decode("utf-8", errors="replace")
+
+    async def writeline(self, line):
+        """ Write a line to VM stdin """
+        if self._proc.returncode is not None:
+            raise Exception("Process completed")
+        self._proc.stdin.write((line + "\n").encode())
+        await self._proc.stdin.drain()
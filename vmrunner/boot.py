@@ -6,8 +6,6 @@
 import os
 import sys
 import argparse
-import subprocess
-import shutil
 
 from vmrunner.prettify import color
 
@@ -31,7 +29,8 @@ parser.add_argument("--create-bridge", dest="bridge", action="store_true",
 
 parser.add_argument("-g", "--grub", dest="grub", action="store_true",
                     help="Create image with GRUB bootloader that will boot provided " + \
-                        "binary. Requires --sudo.")
+                        "binary. Images are cached by kernel contents. Building one " + \
+                        "requires grub-mkimage, or grubify.sh and --sudo.")
 
 parser.add_argument("--grub-reuse", dest="grub_reuse", action="store_true",
                     help="Reuse existing GRUB image if exists. Avoids reinstalling " + \
@@ -54,18 +53,48 @@ parser.add_argument("--with-solo5-spt", dest="solo5_spt", action="store_true",
                     help="Run includeOS on solo5 kernel with spt tender as " + \
                         "monitor. Requires --sudo and --kvm.")
 
-parser.add_argument('vmargs', nargs='*', help="Arguments to pass on to the VM start / main")
+parser.add_argument("--jobs", dest="jobs", type = int, metavar = "N",
+                    help="Batch mode: boot all the given binaries or images, or glob patterns " + \
+                        "matching them, running up to N VMs at a time. Ends with a summary and " + \
+                        "exits non-zero if any VM failed.")
+
+parser.add_argument("--timeout", dest="timeout", type = float, metavar = "SECONDS",
+                    help="Stop a VM if it's still running after SECONDS. " + \
+                        "The default is no timeout.")
+
+parser.add_argument("--snapshot-at", dest="snapshot_at", nargs="?", metavar = "OUTPUT",
+                    const = "",
+                    help="Save the VM state the first time OUTPUT is printed, by default the " + \
+                        "IncludeOS banner, and restore it on later boots of the same binary " + \
+                        "with the same config instead of booting from scratch. Qemu only.")
+
+parser.add_argument("--metrics", dest="metrics", type = str, metavar = "PATH",
+                    help="Write timings of the boot phases, from starting the hypervisor to " + \
+                        "the exit status, to PATH as JSON. In batch mode, for all VMs.")
+
+parser.add_argument("--log", dest="log", type = str, metavar = "PATH",
+                    help="Also write VM output to PATH as JSON lines, with timestamps. " + \
+                        "Compressed if PATH ends in .gz or .xz.")
+
+parser.add_argument("--vm-output", dest="vm_output", type = str, metavar = "DEST",
+                    default = "terminal",
+                    help="Where VM output goes: 'terminal' (the default), 'color' for the " + \
+                        "terminal with colored prefixes, 'none' to discard it, or a file. " + \
+                        "Output is written in batches, not line by line.")
+
+parser.add_argument('vmargs', nargs='*', help="Arguments to pass on to the VM start / main. " + \
+                    "In batch mode, more binaries or images to boot.")
 
 args = parser.parse_args()
 
+if args.jobs is not None and args.jobs < 1:
+    parser.error("--jobs must be at least 1")
+
 
 # Pretty printing from this command
 nametag = "<boot>    "
 INFO = color.INFO(nametag)
 
-# Override VM output prepension
-color.VM_PREPEND = ""
-
 # in verbose mode we will set VERBOSE=1 for this environment
 VERB = False
 if args.verbose:
@@ -76,9 +105,20 @@ if args.verbose:
 elif "VERBOSE" in os.environ:
     del os.environ["VERBOSE"]
 
-# Note: importing vmrunner will make it start looking for VM's
-# vmrunner also relies on the verbose env var to be set on initialization
-from vmrunner import vmrunner # pylint: disable=wrong-import-position
+# Imports not needed for parsing arguments come last, which keeps boot --help fast
+# pylint: disable=wrong-import-position, wrong-import-order
+import glob
+import shutil
+import subprocess
+
+# Note: vmrunner relies on the verbose env var to be set on import. The default vm
+# from vmrunner.init() isn't needed, the VMs booted here are added with add_vm.
+from vmrunner import vmrunner
+# pylint: enable=wrong-import-position, wrong-import-order
+
+# --snapshot-at without OUTPUT saves at the IncludeOS banner
+if args.snapshot_at == "":
+    args.snapshot_at = vmrunner.includeos_signature
 
 # We can boot either a binary without bootloader, or an image with bootloader already attached
 has_bootloader = False
@@ -94,21 +134,13 @@ image_name = args.vm_location
 
 # if the binary argument is a directory, go there immediately and
 # then initialize stuff ...
-if os.path.isdir(args.vm_location):
+if not args.jobs and os.path.isdir(args.vm_location):
     image_name = os.path.abspath(args.vm_location)
     if VERB:
         print(INFO, "Changing directory to  " + image_name)
     os.chdir(os.path.abspath(args.vm_location))
 
 
-if len(vmrunner.vms) < 1:
-    # This should never happen - there should always be a default
-    print(color.FAIL("No vm object found in vmrunner - nothing to boot"))
-    sys.exit(-1)
-
-if VERB:
-    print(INFO, len(vmrunner.vms), "VM initialized. Commencing boot...")
-
 config = None
 if args.config:
     config = os.path.abspath(args.config)
@@ -140,7 +172,118 @@ elif args.solo5_spt:
     subprocess.call(['chmod', '+x', solo5_spt])
     subprocess.call(['sudo', "solo5-ifup.sh" ])
 
+def batch_locations(patterns):
+    """ expand glob patterns into the binaries / images to boot in batch mode """
+    locations = []
+    for pattern in patterns:
+        for location in sorted(glob.glob(pattern)) or [pattern]:
+            if location not in locations:
+                locations.append(location)
+    return locations
+
+def print_summary(results):
+    """ print a table of exit codes and durations for batch mode """
+    width = max(len(result.job.name) for result in results)
+    print()
+    print(INFO, f"{'VM':<{width}}  {'STATUS':<15} {'CODE':>4}  {'TIME':>8}")
+    for result in results:
+        status = result.status or "UNKNOWN"
+        line = (f"{result.job.name:<{width}}  {status:<15} {result.exit_code:>4}  "
+                f"{result.duration:>7.2f}s")
+        print(INFO, line if result.ok() else color.C_FAILED + line + color.C_ENDC)
+
+    failed = [result for result in results if not result.ok()]
+    aborted = [result for result in failed if result.status == "ABORT"]
+    if aborted:
+        print(color.FAIL(f"{len(failed)} of {len(results)} VMs failed, {len(aborted)} of them "
+                         "aborted"))
+    elif failed:
+        print(color.FAIL(f"{len(failed)} of {len(results)} VMs failed"))
+    else:
+        print(color.SUCCESS(f"All {len(results)} VMs passed"))
+    return not failed
+
+def open_log():
+    """ the console log asked for with --log, closed at exit """
+    if not args.log:
+        return None
+    import atexit # pylint: disable=import-outside-toplevel
+    from vmrunner import capture # pylint: disable=import-outside-toplevel
+    log = capture.console_log(args.log)
+    atexit.register(log.close)
+    return log
+
+def write_batch_metrics(results, path):
+    """ write the boot phase timings of each VM in batch mode to path as JSON """
+    import json # pylint: disable=import-outside-toplevel
+    data = [{"name" : result.job.name,
+             "image" : result.job.image,
+             "exit_status" : result.exit_code,
+             "status" : result.status,
+             "duration" : result.duration,
+             "phases" : result.metrics.as_dict() if result.metrics else None}
+            for result in results]
+    try:
+        with open(path, "w", encoding = "utf-8") as f:
+            json.dump(data, f, indent = 2)
+            f.write("\n")
+    except OSError as e:
+        print(color.WARNING(f"Couldn't write boot metrics to {path}: {e}"))
+
+def boot_batch(locations):
+    """ boot many binaries / images concurrently, returns the exit code for this command """
+    from vmrunner import pool # pylint: disable=import-outside-toplevel
+
+    if args.grub or args.grub_reuse or args.debug:
+        print(color.FAIL("--grub, --grub-reuse and --debug can't be combined with --jobs"))
+        return 1
+
+    if args.vm_output not in ("terminal", "color", "none"):
+        print(color.FAIL("--vm-output to a file can't be combined with --jobs, use --log"))
+        return 1
+
+    jobs = []
+    for location in locations:
+        if not os.path.isfile(location):
+            print(color.FAIL(f"{location} is not a file"))
+            return 1
+
+        # Images with a bootloader are booted as disks, anything else as a multiboot kernel
+        has_bootloader_ = os.path.splitext(location)[1] in image_extensions
+        jobs.append(pool.job(os.path.abspath(location), config,
+                             kernel_args = None if has_bootloader_ else "",
+                             timeout = args.timeout, name = location, hyper_name = hyper_name,
+                             multiboot = not has_bootloader_, allow_sudo = args.sudo,
+                             enable_kvm = args.kvm, snapshot_at = args.snapshot_at))
+
+    if VERB:
+        print(INFO, f"Booting {len(jobs)} VMs, {args.jobs} at a time")
+
+    results = pool.run_jobs(jobs, workers = args.jobs, echo = args.vm_output != "none",
+                            log = open_log(), colored = args.vm_output == "color",
+                            capture = False)
+    if args.metrics:
+        write_batch_metrics(results, args.metrics)
+    return 0 if print_summary(results) else vmrunner.exit_codes["PROGRAM_FAILURE"]
+
+if args.jobs:
+    sys.exit(boot_batch(batch_locations([args.vm_location] + args.vmargs)))
+
 vm = vmrunner.add_vm(config = config, hyper_name = hyper_name)
+if args.vm_output == "terminal":
+    vm.set_output(prefix = "")
+elif args.vm_output == "color":
+    vm.set_output(colored = True)
+elif args.vm_output == "none":
+    vm.set_output(echo = False)
+else:
+    from vmrunner import sinks # pylint: disable=import-outside-toplevel
+    vm.set_output(echo = False, sinks = [sinks.file_sink(args.vm_output)])
+if args.log:
+    vm.log_to(open_log(), os.path.basename(args.vm_location))
+
+if VERB:
+    print(INFO, "VM initialized. Commencing boot...")
 
 # Don't listen to events needed by testrunner
 vm.on_success(lambda x: None, do_exit = False)
@@ -173,6 +316,40 @@ else:
         print(INFO, f"Unrecognized file extension '{file_extension}'. " + \
                 "Trying to boot as kernel")
 
+def grub_image(grubify):
+    """ an image with GRUB booting image_name. Built without root if GRUB is installed,
+    otherwise by grubify, which needs sudo. Images come from the GRUB image cache, unless
+    it's disabled. Returns None if grubify has to build the image in place """
+    from vmrunner import grub # pylint: disable=import-outside-toplevel
+
+    rootless = grub.find_grub() is not None
+    if not rootless and not grubify:
+        print("Error: neither grub-mkimage nor grubify.sh found.")
+        sys.exit(1)
+
+    if not os.path.isfile(image_name):
+        print(f"Error: {image_name} is not a file.")
+        sys.exit(1)
+
+    output = os.path.join(os.getcwd(), os.path.basename(image_name) + ".grub.img")
+
+    if grub.cache_path() is None:
+        if not rootless:
+            return None
+        return grub.build_image(image_name, output, "grub.cfg")
+
+    cached = grub.cached_image(image_name, grubify, allow_build = rootless or args.sudo)
+    if cached is None:
+        print("Error: creating grub images require sudo. Allow with --sudo.")
+        sys.exit(1)
+
+    if VERB:
+        print(INFO, "Using GRUB image", cached)
+
+    # The guest may write to its disk, so it gets a copy of the cached image
+    shutil.copyfile(cached, output)
+    return output
+
 if (args.grub or args.grub_reuse):
     print(INFO, "Creating GRUB image from ", args.vm_location)
     opts = ""
@@ -181,23 +358,28 @@ if (args.grub or args.grub_reuse):
         opts += "-u "
 
     grubify_script = shutil.which("grubify.sh")
-    if not grubify_script:
-        print(f"Error: {grubify_script} not found or not executable.")
-        sys.exit(1)
-
-    if not args.sudo:
-        print("Error: creating grub images require sudo. Allow with --sudo.")
-        sys.exit(1)
-
 
     if not os.access('.', os.W_OK):
         print("Error: Cannot write to the current directory.")
         sys.exit(1)
 
-    subprocess.call(grubify_script + " " + opts + image_name, shell=True)
+    grub_image_name = None if args.grub_reuse else grub_image(grubify_script)
+
+    if grub_image_name is None:
+        if not grubify_script:
+            print("Error: grubify.sh not found or not executable.")
+            sys.exit(1)
+
+        if not args.sudo:
+            print("Error: creating grub images require sudo. Allow with --sudo.")
+            sys.exit(1)
+
+        subprocess.call(grubify_script + " " + opts + image_name, shell=True)
+
+        base_image_name = os.path.basename(image_name)
+        grub_image_name = os.path.join(os.getcwd(), base_image_name + ".grub.img")
 
-    base_image_name = os.path.basename(image_name)
-    image_name = os.path.join(os.getcwd(), base_image_name + ".grub.img")
+    image_name = grub_image_name
 
     if not os.path.exists(image_name):
         print(f"Error: {image_name} does not exist.")
@@ -206,12 +388,13 @@ if (args.grub or args.grub_reuse):
     has_bootloader = True
 
 if not has_bootloader:
-    vm.boot(timeout = None, multiboot = True, debug = args.debug,
+    vm.boot(timeout = args.timeout, multiboot = True, debug = args.debug,
             kernel_args = " ".join(args.vmargs), image_name = image_name,
-            allow_sudo = args.sudo, enable_kvm = args.kvm)
+            allow_sudo = args.sudo, enable_kvm = args.kvm, snapshot_at = args.snapshot_at,
+            metrics_file = args.metrics)
 else:
-    vm.boot(timeout = None, multiboot = False, debug = args.debug,
+    vm.boot(timeout = args.timeout, multiboot = False, debug = args.debug,
             kernel_args = None, image_name = image_name, allow_sudo = args.sudo,
-            enable_kvm = args.kvm)
+            enable_kvm = args.kvm, snapshot_at = args.snapshot_at, metrics_file = args.metrics)
 
 sys.exit(0)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+""" on-disk cache location and helpers for vmrunner """
+
+import os
+import json
+import threading
+
+
+def cache_dir(*parts):
+    """ directory for vmrunner's on-disk caches, with optional subdirectories, created
+    if needed. Defaults to $XDG_CACHE_HOME/vmrunner. Set VMRUNNER_CACHE_DIR to use another
+    location, or to an empty string to disable on-disk caching. Returns None if caching
+    is disabled or the directory can't be created """
+    base = os.environ.get("VMRUNNER_CACHE_DIR")
+    if base is None:
+        xdg_cache = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+        base = os.path.join(xdg_cache, "vmrunner")
+
+    if not base:
+        return None
+
+    path = os.path.join(base, *parts)
+    try:
+        os.makedirs(path, exist_ok = True)
+    except OSError:
+        return None
+    return path
+
+
+def load_json(name, *parts):
+    """ load a JSON file from the cache directory, or a subdirectory of it given by parts.
+    None if it's missing or unreadable """
+    directory = cache_dir(*parts)
+    if directory is None:
+        return None
+
+    try:
+        with open(os.path.join(directory, name), encoding = "utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def store_json(name, data, *parts):
+    """ atomically replace a JSON file in the cache directory, or a subdirectory of it given
+    by parts. Failures are ignored, the cache is only an optimization """
+    directory = cache_dir(*parts)
+    if directory is None:
+        return
+
+    import tempfile # pylint: disable=import-outside-toplevel
+    try:
+        fd, tmp = tempfile.mkstemp(dir = directory, prefix = "." + name)
+    except OSError:
+        return
+
+    try:
+        with os.fdopen(fd, "w", encoding = "utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp, os.path.join(directory, name))
+    except OSError:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+
+
+# File hashes, keyed by (path, size, mtime)
+_hashes = {}
+_hashes_lock = threading.Lock()
+
+
+def file_hash(path):
+    """ sha256 of a file's contents, remembered until the file changes """
+    import hashlib # pylint: disable=import-outside-toplevel
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+
+    with _hashes_lock:
+        if key in _hashes:
+            return _hashes[key]
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+
+    with _hashes_lock:
+        for stale in [k for k in _hashes if k[0] == path]:
+            del _hashes[stale]
+        _hashes[key] = digest.hexdigest()
+        return _hashes[key]
+
+
+def touch(path):
+    """ mark a cached file as recently used. False if it doesn't exist """
+    try:
+        os.utime(path)
+    except OSError:
+        return False
+    return True
+
+
+def size_limit(variable, default_mb):
+    """ a cache size limit in bytes, from the environment variable in MiB if it's set """
+    try:
+        return int(float(os.environ.get(variable, default_mb)) * 1024 * 1024)
+    except ValueError:
+        return int(default_mb * 1024 * 1024)
+
+
+def evict(directory, suffix, limit, keep = None, companions = None):
+    """ remove the least recently used files ending with suffix in directory, except keep,
+    until they take no more than limit bytes. companions, if given, maps a file to the paths
+    of files belonging to it, which count toward its size and are removed with it """
+    files = []
+    for entry in os.scandir(directory):
+        if entry.name.endswith(suffix) and entry.is_file():
+            stat = entry.stat()
+            paths = [entry.path] + (companions(entry.path) if companions else [])
+            size = stat.st_size + sum(os.path.getsize(path) for path in paths[1:]
+                                      if os.path.isfile(path))
+            files.append((stat.st_mtime_ns, size, paths))
+
+    total = sum(size for _, size, _ in files)
+    for _, size, paths in sorted(files):
+        if total <= limit:
+            break
+        if paths[0] == keep:
+            continue
+        try:
+            for path in paths:
+                os.unlink(path)
+            total -= size
+        except OSError:
+            pass
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+""" machine readable logs of VM console output """
+
+# pylint: disable=invalid-name
+
+import os
+import json
+import time
+import threading
+
+# Records are written in blocks of about this many bytes
+BUFFER_SIZE = 256 * 1024
+
+# Compression is tuned for speed over size: console output compresses well anyway
+COMPRESSION = {".gz" : "gzip", ".xz" : "lzma"}
+GZIP_LEVEL = 1
+LZMA_PRESET = 1
+
+
+def open_binary(path, compression = None):
+    """ open path for writing, compressed with "gzip" or "lzma" if set """
+    if compression == "gzip":
+        import gzip # pylint: disable=import-outside-toplevel
+        return gzip.open(path, "wb", compresslevel = GZIP_LEVEL)
+    if compression == "lzma":
+        import lzma # pylint: disable=import-outside-toplevel
+        return lzma.open(path, "wb", preset = LZMA_PRESET)
+    if compression:
+        raise Exception(f"Unknown compression {compression}, expected gzip or lzma") # pylint: disable=broad-exception-raised
+    return open(path, "wb") # pylint: disable=consider-using-with
+
+
+class console_log:
+    """ Console output of one or more VMs, as JSON lines.
+
+    Each record holds a monotonic timestamp, t, the id of the VM, vm, where the line came
+    from, source, and the line itself:
+
+      {"t": 8913.204017, "vm": "test_fs", "source": "console", "line": "SUCCESS"}
+
+    The first record, from vmrunner, also holds the wall clock time, to place the monotonic
+    timestamps. Records are buffered and written in blocks, compressed if the path ends in
+    .gz or .xz, or compression is set. VMs in different threads can share a log. It has to
+    be closed for everything to be written """
+
+    def __init__(self, path, compression = None, buffer_size = BUFFER_SIZE):
+        if compression is None:
+            compression = COMPRESSION.get(os.path.splitext(path)[1])
+        self.path = path
+        self._file = open_binary(path, compression)
+        self._buffer_size = buffer_size
+        self._pending = []
+        self._pending_size = 0
+        self._lock = threading.Lock()
+        self._write({"t" : time.monotonic(), "vm" : None, "source" : "vmrunner",
+                     "line" : "log started", "time" : time.time()})
+
+    def write(self, vm_id, source, line, when = None):
+        """ add a line of output from vm_id. source is e.g. "console", or "panic" for the
+        output read after a panic. when is a time.monotonic timestamp, by default now """
+        self._write({"t" : time.monotonic() if when is None else when, "vm" : vm_id,
+                     "source" : source, "line" : line})
+
+    def _write(self, record):
+        """ queue a record, writing the queue if it's full """
+        data = json.dumps(record, ensure_ascii = False).encode("utf-8", errors = "replace")
+        with self._lock:
+            if not self._file:
+                return
+            self._pending.append(data)
+            self._pending_size += len(data) + 1
+            if self._pending_size >= self._buffer_size:
+                self._flush()
+
+    def _flush(self):
+        """ write queued records, with the lock held """
+        if self._pending:
+            self._pending.append(b"")
+            self._file.write(b"\n".join(self._pending))
+            self._pending.clear()
+            self._pending_size = 0
+
+    def flush(self):
+        """ write queued records to the file """
+        with self._lock:
+            if self._file:
+                self._flush()
+                self._file.flush()
+
+    def close(self):
+        """ write queued records and close the file """
+        with self._lock:
+            if self._file:
+                self._flush()
+                self._file.close()
+                self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
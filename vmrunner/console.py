@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+""" console output processing for vmrunner """
+
+# pylint: disable=invalid-name, too-many-branches, too-many-statements, too-many-instance-attributes, too-few-public-methods
+
+import os
+import re
+import time
+import threading
+import collections
+import queue
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Size of each read from the hypervisor output pipe, unless the pipe itself is larger
+CHUNK_SIZE = 64 * 1024
+
+# Requested capacity of the hypervisor output pipe
+PIPE_SIZE = 1024 * 1024
+
+# Most reads output_reader queues before it waits for them to be consumed, after which the
+# pipe, and then the guest, wait too
+QUEUE_READS = 16
+
+# Longest unfinished line output_reader keeps, longer ones are handed over in pieces
+LINE_LIMIT = 1024 * 1024
+
+# Upper limit for unprivileged pipe sizes on Linux
+PIPE_MAX_SIZE = "/proc/sys/fs/pipe-max-size"
+
+ESC = 0x1b
+NEWLINE = 0x0a
+
+# The end-of-transmission character
+EOT = b"\x04"
+
+# Default size limit for output collected by read_until, e.g. panic dumps
+READ_UNTIL_LIMIT = 16 * 1024 * 1024
+
+# Parser states for control_stripper
+GROUND = 0        # Plain output
+ESCAPE = 1        # Seen ESC, waiting for the next byte
+CSI = 2           # Inside ESC [ ... until a final byte
+INTERMEDIATE = 3  # Inside ESC <intermediate bytes> ... until a final byte
+STRING = 4        # Inside OSC / DCS / SOS / PM / APC until BEL or ST
+STRING_ESC = 5    # Seen ESC inside a string, ST if followed by '\'
+
+# Final byte of a CSI sequence, or a newline aborting it
+csi_end = re.compile(rb"[\x40-\x7e\n]")
+
+# Final byte of an escape sequence with intermediates, or a newline aborting it
+intermediate_end = re.compile(rb"[\x30-\x7e\n]")
+
+# BEL or the ESC of an ST terminating a string, or a newline aborting it
+string_end = re.compile(rb"[\x07\x1b\n]")
+
+# Bytes following ESC that start a string sequence: OSC, DCS, SOS, PM and APC
+string_starts = frozenset(b"]PX^_")
+
+
+class control_stripper:
+    """ Removes (7-bit) terminal control sequences from a byte stream.
+
+    Output can be fed in chunks of any size. A control sequence split between
+    two chunks is remembered, so that the rest of it is removed from the next one.
+    A newline always ends a pending control sequence and is kept, which limits the
+    damage done by broken sequences to a single line. """
+
+    def __init__(self):
+        self._state = GROUND
+
+    def reset(self):
+        """ forget any partial control sequence """
+        self._state = GROUND
+
+    def feed(self, data):
+        """ strip control sequences from a chunk of bytes, returning the clean bytes """
+        state = self._state
+        out = []
+        pos = 0
+        end = len(data)
+
+        while pos < end:
+            if state == GROUND:
+                esc = data.find(ESC, pos)
+                if esc < 0:
+                    out.append(data[pos:])
+                    break
+                out.append(data[pos:esc])
+                pos = esc + 1
+                state = ESCAPE
+
+            elif state == ESCAPE:
+                byte = data[pos]
+                pos += 1
+                if byte == 0x5b: # '['
+                    state = CSI
+                elif byte in string_starts:
+                    state = STRING
+                elif 0x20 <= byte <= 0x2f:
+                    state = INTERMEDIATE
+                elif byte == NEWLINE:
+                    out.append(b"\n")
+                    state = GROUND
+                elif byte == ESC:
+                    state = ESCAPE
+                else:
+                    # Two byte sequence, e.g. ESC c
+                    state = GROUND
+
+            elif state in (CSI, INTERMEDIATE):
+                pattern = csi_end if state == CSI else intermediate_end
+                match = pattern.search(data, pos)
+                if match is None:
+                    break
+                pos = match.end()
+                if data[pos - 1] == NEWLINE:
+                    out.append(b"\n")
+                state = GROUND
+
+            elif state == STRING:
+                match = string_end.search(data, pos)
+                if match is None:
+                    break
+                pos = match.end()
+                byte = data[pos - 1]
+                if byte == ESC:
+                    state = STRING_ESC
+                else:
+                    if byte == NEWLINE:
+                        out.append(b"\n")
+                    state = GROUND
+
+            else: # STRING_ESC
+                if data[pos] == 0x5c: # '\'
+                    pos += 1
+                    state = GROUND
+                else:
+                    # Not an ST, the ESC starts a new sequence
+                    state = ESCAPE
+
+        self._state = state
+        return b"".join(out)
+
+
+def grow_pipe(fd, size = PIPE_SIZE):
+    """ try to enlarge the pipe fd to size bytes, returning the resulting capacity """
+    set_size = getattr(fcntl, "F_SETPIPE_SZ", None)
+    if set_size is None:
+        return CHUNK_SIZE
+
+    try:
+        return fcntl.fcntl(fd, set_size, size)
+    except OSError:
+        pass
+
+    # Unprivileged processes can't go beyond the system wide maximum
+    try:
+        with open(PIPE_MAX_SIZE, encoding = "utf-8") as f:
+            return fcntl.fcntl(fd, set_size, min(size, int(f.read())))
+    except (OSError, ValueError):
+        return fcntl.fcntl(fd, fcntl.F_GETPIPE_SZ)
+
+
+class until_marker:
+    """ Collects chunks of bytes until a single byte marker is found.
+
+    Each chunk is searched with bytes.find and collected into a bytearray. At most
+    limit bytes are kept in data, anything beyond that is dropped until the marker and
+    counted in skipped """
+
+    def __init__(self, marker = EOT, limit = READ_UNTIL_LIMIT):
+        self.marker = marker
+        self.limit = limit
+        self.data = bytearray()
+        self.skipped = 0
+
+    def feed(self, chunk):
+        """ take a chunk. Returns what followed the marker once it's found, None before """
+        end = chunk.find(self.marker)
+        size = len(chunk) if end < 0 else end
+
+        room = self.limit - len(self.data)
+        if room >= size:
+            self.data += chunk[:size]
+        else:
+            self.data += chunk[:max(room, 0)]
+            self.skipped += size - max(room, 0)
+
+        return chunk[end + 1:] if end >= 0 else None
+
+
+def read_until(read, marker = EOT, limit = READ_UNTIL_LIMIT):
+    """ collect chunks of bytes from read() until a single byte marker is found, see
+    until_marker. Returns the collected bytes, what was read after the marker and the
+    number of bytes dropped. read() must return b"" at end of file. """
+    collector = until_marker(marker, limit)
+
+    while True:
+        chunk = read()
+        if not chunk:
+            return bytes(collector.data), b"", collector.skipped
+
+        rest = collector.feed(chunk)
+        if rest is not None:
+            return bytes(collector.data), rest, collector.skipped
+
+
+def split_lines(data):
+    """ split data into complete lines, each ended by a newline or an EOT, and the
+    unfinished rest. An EOT only ends a line if no newline follows it """
+    lines = data.split(b"\n")
+    partial = lines.pop()
+    lines = [line + b"\n" for line in lines]
+
+    if EOT in partial:
+        end = partial.rfind(EOT) + 1
+        lines.append(partial[:end])
+        partial = partial[end:]
+
+    return lines, partial
+
+
+class output_reader:
+    """ Drains hypervisor output from a pipe in a background thread.
+
+    The pipe is enlarged and emptied with large reads, so a chatty guest doesn't stall
+    on a full pipe while the event loop is busy. Output is split into lines, which are
+    handed over through a queue in batches of one read each. The queue holds up to QUEUE_READS
+    batches, so a consumer that falls behind holds up the guest. An EOT also ends a line,
+    so that it's seen even if no newline follows. Lines are kept as bytes and only
+    decoded by the consumer once complete, so multi-byte UTF-8 characters split
+    between two reads are decoded correctly. """
+
+    def __init__(self, pipe, pipe_size = PIPE_SIZE):
+        self._pipe = pipe
+        self._fd = pipe.fileno()
+        self._read_size = max(grow_pipe(self._fd, pipe_size), CHUNK_SIZE)
+        self._batches = queue.Queue(maxsize = QUEUE_READS)
+        self._lines = collections.deque()
+        self._eof = False
+        self.first_read = None # Monotonic time the first output was read
+        self._thread = threading.Thread(target = self._run, name = "vmrunner-output", daemon = True)
+
+    def start(self):
+        """ start reading in the background """
+        self._thread.start()
+        return self
+
+    def _run(self):
+        """ reader thread: read, split into lines and queue until end of file """
+        partial = [] # The unfinished line, in the pieces it was read in
+        partial_size = 0
+        while True:
+            try:
+                chunk = os.read(self._fd, self._read_size)
+            except OSError:
+                chunk = b""
+
+            if not chunk:
+                break
+
+            if self.first_read is None:
+                self.first_read = time.monotonic()
+
+            # Only joined once the line ends, so a long line isn't copied on every read
+            if b"\n" in chunk or EOT in chunk:
+                batch, rest = split_lines(b"".join(partial + [chunk]))
+                partial, partial_size = ([rest], len(rest)) if rest else ([], 0)
+            else:
+                partial.append(chunk)
+                partial_size += len(chunk)
+                batch = []
+                if partial_size >= LINE_LIMIT:
+                    batch = [b"".join(partial)]
+                    partial, partial_size = [], 0
+
+            if batch:
+                self._batches.put(batch)
+
+        if partial:
+            self._batches.put([b"".join(partial)])
+
+        # End of file marker
+        self._batches.put(None)
+
+    def _fill(self):
+        """ block until there are lines to consume, returns False at end of file """
+        while not self._lines:
+            if self._eof:
+                return False
+
+            batch = self._batches.get()
+            if batch is None:
+                self._eof = True
+            else:
+                self._lines.extend(batch)
+
+        return True
+
+    def readline(self):
+        """ get the next line, blocking until one is available. Returns b"" at end of file """
+        if not self._fill():
+            return b""
+
+        return self._lines.popleft()
+
+    def read_chunk(self):
+        """ get all output read so far as one block, blocking until there is some.
+        Returns b"" at end of file """
+        if not self._fill():
+            return b""
+
+        data = b"".join(self._lines)
+        self._lines.clear()
+        return data
+
+    def unread(self, data):
+        """ put data back, to be read again before any other output """
+        lines, last = split_lines(data)
+        if last:
+            self._lines.appendleft(last)
+        self._lines.extendleft(reversed(lines))
+
+    def read_until(self, marker = EOT, limit = READ_UNTIL_LIMIT):
+        """ read output until marker, see read_until. Output after the marker is kept """
+        data, rest, skipped = read_until(self.read_chunk, marker, limit)
+        if rest:
+            self.unread(rest)
+        return data, skipped
+
+    def eof(self):
+        """ true if all output has been read """
+        return self._eof and not self._lines
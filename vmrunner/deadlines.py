@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+""" deadlines for many VMs, served by one shared scheduler thread """
+
+# pylint: disable=invalid-name, too-many-instance-attributes
+
+import sys
+import time
+import heapq
+import queue
+import itertools
+import threading
+
+from .prettify import color
+
+# Most worker threads to call blocking deadlines on, so that one VM that's slow to stop
+# doesn't hold up the timeouts of others
+WORKERS = 8
+
+class deadline:
+    """ A callback due at a monotonic time, see after. It can be cancelled, or moved with
+    extend, until it fires """
+
+    def __init__(self, scheduler_, when, callback, blocking):
+        self.when = when
+        self._scheduler = scheduler_
+        self._callback = callback
+        self._blocking = blocking
+        self.entry = None # The current heap entry, older ones are skipped
+        self.pending = True # Until the deadline fires or is cancelled
+        self._done = threading.Event()
+
+    def cancel(self):
+        """ drop the deadline unless it fired already. Returns True if it was dropped """
+        with self._scheduler.lock:
+            if not self.pending:
+                return False
+            self.pending = False
+        self._done.set()
+        return True
+
+    def extend(self, seconds):
+        """ move the deadline seconds later, unless it fired already. Returns True if moved """
+        with self._scheduler.lock:
+            if not self.pending:
+                return False
+            self._scheduler.push(self, self.when + seconds)
+        return True
+
+    def reset(self, seconds):
+        """ move the deadline to seconds from now, unless it fired already. Returns True if
+        moved """
+        with self._scheduler.lock:
+            if not self.pending:
+                return False
+            self._scheduler.push(self, time.monotonic() + seconds)
+        return True
+
+    def remaining(self):
+        """ seconds until the deadline, 0 once it's due, None once it fired or was cancelled """
+        if not self.pending:
+            return None
+        return max(self.when - time.monotonic(), 0)
+
+    def wait(self, timeout = None):
+        """ wait until the deadline is cancelled, or has fired and its callback returned.
+        Returns False if timeout seconds passed first """
+        return self._done.wait(timeout)
+
+    def fire(self):
+        """ call the callback, called by the scheduler once the deadline is due """
+        if self._blocking:
+            self._scheduler.hand_off(self)
+        else:
+            self.call()
+
+    def call(self):
+        """ call the callback now, from the calling thread """
+        try:
+            self._callback()
+        except SystemExit:
+            pass # E.g. vm.exit, which would only end this thread
+        except Exception: # pylint: disable=broad-exception-caught
+            import traceback # pylint: disable=import-outside-toplevel
+            print(color.WARNING("Exception raised in deadline callback: "))
+            traceback.print_exc(limit = 10, file = sys.stdout)
+        finally:
+            self._done.set()
+
+
+class _scheduler:
+    """ Keeps deadlines in a heap, and calls them when they're due from one background thread,
+    which is started with the first deadline. However many VMs are running, they share this
+    thread instead of having a timer thread each.
+
+    Callbacks run on the scheduler thread and should return quickly. Blocking ones, like
+    stopping a VM, are handed to worker threads, started as they're needed, up to WORKERS.
+    Cancelled and moved deadlines leave their old heap entries
+    behind, which are skipped when they come up """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._wakeup = threading.Condition(self.lock)
+        self._heap = []
+        self._counter = itertools.count()
+        self._thread = None
+        self._queue = queue.SimpleQueue() # Deadlines for the workers
+        self._workers = 0
+        self._busy = 0 # Workers calling a deadline
+        self._queued = 0 # Deadlines handed off, but not yet taken by a worker
+
+    def after(self, seconds, callback, blocking = False):
+        """ call callback in seconds, from a worker thread if blocking is set. Returns the
+        deadline """
+        with self.lock:
+            deadline_ = deadline(self, None, callback, blocking)
+            self.push(deadline_, time.monotonic() + seconds)
+            if self._thread is None:
+                self._thread = threading.Thread(target = self._run, name = "vmrunner-deadlines",
+                                                daemon = True)
+                self._thread.start()
+        return deadline_
+
+    def push(self, deadline_, when):
+        """ (re)schedule deadline_ at when, with the lock held """
+        deadline_.when = when
+        deadline_.entry = (when, next(self._counter), deadline_)
+        heapq.heappush(self._heap, deadline_.entry)
+        if self._heap[0] is deadline_.entry:
+            self._wakeup.notify()
+
+    def _next_due(self):
+        """ wait for the next deadline to come due and take it off the heap """
+        with self.lock:
+            while True:
+                # Skip entries of cancelled, fired and moved deadlines
+                while self._heap and (not self._heap[0][2].pending or
+                                      self._heap[0] is not self._heap[0][2].entry):
+                    heapq.heappop(self._heap)
+
+                if not self._heap:
+                    self._wakeup.wait()
+                    continue
+
+                delay = self._heap[0][0] - time.monotonic()
+                if delay > 0:
+                    self._wakeup.wait(delay)
+                    continue
+
+                deadline_ = heapq.heappop(self._heap)[2]
+                deadline_.pending = False
+                return deadline_
+
+    def _run(self):
+        while True:
+            self._next_due().fire()
+
+    def hand_off(self, deadline_):
+        """ have a worker call deadline_, starting another one if all are busy """
+        with self.lock:
+            self._queued += 1
+            if self._queued > self._workers - self._busy and self._workers < WORKERS:
+                self._workers += 1
+                threading.Thread(target = self._work, name = "vmrunner-deadline",
+                                 daemon = True).start()
+        self._queue.put(deadline_)
+
+    def _work(self):
+        while True:
+            deadline_ = self._queue.get()
+            with self.lock:
+                self._queued -= 1
+                self._busy += 1
+            try:
+                deadline_.call()
+            except BaseException: # pylint: disable=broad-exception-caught
+                # Keep the worker, or deadlines handed to it later would never be called
+                import traceback # pylint: disable=import-outside-toplevel
+                traceback.print_exc(limit = 10, file = sys.stdout)
+            finally:
+                with self.lock:
+                    self._busy -= 1
+
+    def size(self):
+        """ number of heap entries, including ones left by cancelled or moved deadlines """
+        with self.lock:
+            return len(self._heap)
+
+scheduler = _scheduler()
+
+
+def after(seconds, callback, blocking = False):
+    """ call callback in seconds, unless the returned deadline is cancelled first. See
+    _scheduler.after """
+    return scheduler.after(seconds, callback, blocking)
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+""" in-process ELF header inspection for vmrunner """
+
+# pylint: disable=invalid-name, too-few-public-methods, too-many-instance-attributes
+
+import os
+import struct
+import threading
+
+ELF_MAGIC = b"\x7fELF"
+
+# e_ident[EI_CLASS] and e_ident[EI_DATA]
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+ELFDATA2MSB = 2
+
+ET_EXEC = 2
+ET_DYN = 3
+
+# p_type of the program header naming the dynamic linker, which makes ET_DYN files position
+# independent executables rather than shared libraries
+PT_INTERP = 3
+
+# The multiboot header must be 4-byte aligned within the first 8 KiB of the file,
+# the multiboot2 header 8-byte aligned within the first 32 KiB
+MULTIBOOT_MAGIC = 0x1BADB002
+MULTIBOOT_SEARCH = 8192
+MULTIBOOT2_MAGIC = 0xE85250D6
+MULTIBOOT2_SEARCH = 32768
+
+machines = {3 : "Intel 80386",
+            8 : "MIPS",
+            40 : "ARM",
+            62 : "x86-64",
+            183 : "ARM aarch64",
+            243 : "RISC-V"}
+
+types = {1 : "relocatable",
+         2 : "executable",
+         3 : "shared object",
+         4 : "core file"}
+
+
+class elf_info:
+    """ What the headers of a file say about it. Files that aren't ELF have is_elf
+    set to False, but may still have a multiboot header """
+
+    def __init__(self, path):
+        self.path = path
+        self.is_elf = False
+        self.bits = None           # 32 or 64
+        self.little_endian = None
+        self.machine = None        # e_machine, see machines
+        self.type = None           # e_type, see types
+        self.entry = None
+        self.interpreter = False   # Has a PT_INTERP program header
+        self.multiboot = False     # Has a valid multiboot header
+        self.multiboot2 = False    # Has a valid multiboot2 header
+
+    def is_pie(self):
+        """ true if this is a position independent executable """
+        return self.is_elf and self.type == ET_DYN and self.interpreter
+
+    def is_executable(self, bits = None):
+        """ true if this is an ELF executable, position independent or not, of the given
+        class if bits is set """
+        return (self.is_elf and (self.type == ET_EXEC or self.is_pie()) and
+                bits in (None, self.bits))
+
+    def describe(self):
+        """ a one line description, similar to the output of 'file' """
+        if not self.is_elf:
+            desc = "data"
+        else:
+            kind = "pie executable" if self.is_pie() else types.get(self.type, f"type {self.type}")
+            desc = (f"ELF {self.bits}-bit {'LSB' if self.little_endian else 'MSB'} {kind}, "
+                    f"{machines.get(self.machine, f'machine {self.machine}')}, "
+                    f"entry point {self.entry:#x}")
+        if self.multiboot:
+            desc += ", multiboot"
+        if self.multiboot2:
+            desc += ", multiboot2"
+        return desc
+
+    def __repr__(self):
+        return f"<elf_info {self.path}: {self.describe()}>"
+
+
+def find_header(data, magic, limit, align, valid):
+    """ true if data has magic at an aligned offset below limit, with valid(offset) true """
+    pattern = struct.pack("<I", magic)
+    pos = data.find(pattern, 0, limit)
+    while pos >= 0:
+        if pos % align == 0 and valid(pos):
+            return True
+        pos = data.find(pattern, pos + 1, limit)
+    return False
+
+
+def parse(path, data):
+    """ parse the start of a file into an elf_info """
+    result = elf_info(path)
+
+    # Multiboot headers: magic, flags, checksum summing to zero
+    def multiboot_valid(pos):
+        if pos + 12 > len(data):
+            return False
+        return sum(struct.unpack_from("<III", data, pos)) & 0xffffffff == 0
+
+    # Multiboot2 headers: magic, architecture, header length, checksum summing to zero
+    def multiboot2_valid(pos):
+        if pos + 16 > len(data):
+            return False
+        return sum(struct.unpack_from("<IIII", data, pos)) & 0xffffffff == 0
+
+    result.multiboot = find_header(data, MULTIBOOT_MAGIC, MULTIBOOT_SEARCH, 4, multiboot_valid)
+    result.multiboot2 = find_header(data, MULTIBOOT2_MAGIC, MULTIBOOT2_SEARCH, 8, multiboot2_valid)
+
+    if len(data) < 64 or not data.startswith(ELF_MAGIC):
+        return result
+
+    elf_class, elf_data = data[4], data[5]
+    if elf_class not in (ELFCLASS32, ELFCLASS64) or elf_data not in (ELFDATA2LSB, ELFDATA2MSB):
+        return result
+
+    result.is_elf = True
+    result.bits = 32 if elf_class == ELFCLASS32 else 64
+    result.little_endian = elf_data == ELFDATA2LSB
+
+    # e_type, e_machine, e_version, e_entry, e_phoff, e_shoff, e_flags, e_ehsize, e_phentsize
+    # and e_phnum follow e_ident
+    order = "<" if result.little_endian else ">"
+    layout = order + ("HHIIIIIHHH" if result.bits == 32 else "HHIQQQIHHH")
+    if len(data) < 16 + struct.calcsize(layout):
+        return result
+    (result.type, result.machine, _, result.entry, phoff, _, _, _, phentsize,
+     phnum) = struct.unpack_from(layout, data, 16)
+
+    # Program headers start with p_type. Only those within data are looked at, they
+    # normally follow the ELF header
+    for i in range(phnum):
+        pos = phoff + i * phentsize
+        if phentsize < 4 or pos + 4 > len(data):
+            break
+        if struct.unpack_from(order + "I", data, pos)[0] == PT_INTERP:
+            result.interpreter = True
+            break
+    return result
+
+
+# Memoized results, keyed by (path, size, mtime)
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def inspect(path):
+    """ inspect the headers of the file at path. Results are memoized by path, size and
+    modification time, so a file is only read again after it changes. Raises OSError
+    if the file can't be read """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+
+    with _cache_lock:
+        if key in _cache:
+            return _cache[key]
+
+    with open(path, "rb") as f:
+        result = parse(path, f.read(max(MULTIBOOT_SEARCH, MULTIBOOT2_SEARCH)))
+
+    with _cache_lock:
+        # Results for older versions of the file won't be needed again
+        for stale in [k for k in _cache if k[0] == path]:
+            del _cache[stale]
+        _cache[key] = result
+    return result
+
+
+def clear_cache():
+    """ forget all memoized results """
+    with _cache_lock:
+        _cache.clear()
+
+
+def describe(path):
+    """ describe the file at path, or why it can't be read """
+    try:
+        return inspect(path).describe()
+    except OSError as e:
+        return f"cannot open {path}: {e.strerror}"
+
+
+def is_executable(path, bits = None):
+    """ true if path is a readable ELF executable, of the given class if bits is set """
+    try:
+        return inspect(path).is_executable(bits)
+    except OSError:
+        return False
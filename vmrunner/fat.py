@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+""" FAT12 / FAT16 filesystem writer, for building disk images without mounting them """
+
+# pylint: disable=invalid-name, too-many-instance-attributes
+
+import os
+import struct
+
+SECTOR_SIZE = 512
+RESERVED_SECTORS = 1
+NUM_FATS = 2
+ROOT_ENTRIES = 512
+MIN_ROOT_ENTRIES = 16
+ENTRY_SIZE = 32
+
+# The FAT type follows from the cluster count alone. Stay clear of the limits, 4085 and
+# 65525 clusters, which some drivers compute slightly differently
+FAT12_MAX_CLUSTERS = 4000
+FAT16_MIN_CLUSTERS = 4200
+FAT16_MAX_CLUSTERS = 65500
+
+MEDIA_FIXED = 0xF8
+
+ATTR_DIRECTORY = 0x10
+ATTR_ARCHIVE = 0x20
+ATTR_LFN = 0x0F
+
+# Timestamps are fixed to 1980-01-01 00:00, the FAT epoch, so images are reproducible
+DOS_DATE = (1 << 5) | 1
+DOS_TIME = 0
+
+SHORT_NAME_CHARS = set("ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789!#$%&'()-@^_`{}~")
+
+
+class node:
+    """ a file or directory in a filesystem being built """
+
+    def __init__(self, name, source = None, directory = False):
+        self.name = name
+        self.source = source        # bytes, or the path of a file to copy
+        self.directory = directory
+        self.children = {}
+        self.cluster = 0
+        # Directory entries: (long name or None, short name, long name entries, node)
+        self.entries = []
+
+    def size(self):
+        """ size of a file in bytes """
+        if isinstance(self.source, (bytes, bytearray)):
+            return len(self.source)
+        return os.path.getsize(self.source)
+
+    def walk(self):
+        """ this node and all nodes below it, parents first """
+        yield self
+        for child in self.children.values():
+            yield from child.walk()
+
+
+def valid_short_part(part, length):
+    """ true if part fits an 8.3 name component as is, ignoring case """
+    return len(part) <= length and all(c in SHORT_NAME_CHARS for c in part.upper())
+
+
+def short_name(name, taken):
+    """ the 11 byte 8.3 name for name, and whether a long name entry is needed to keep
+    the name as is. Lower case names get long name entries, not every reader honours the
+    lower case flags of 8.3 names """
+    base, dot, ext = name.rpartition(".")
+    if not dot:
+        base, ext = name, ""
+
+    if base and "." not in base and valid_short_part(base, 8) and valid_short_part(ext, 3):
+        short = (base.upper().ljust(8) + ext.upper().ljust(3)).encode("ascii")
+        if short not in taken:
+            return short, name != name.upper()
+
+    # Generate a numbered short name, e.g. INCLUD~1 for includeos_service
+    def clean(part):
+        return "".join(c if c in SHORT_NAME_CHARS else "_" for c in part.upper().replace(" ", ""))
+
+    base, ext = clean(base or name), clean(ext)[:3]
+    for number in range(1, 1000000):
+        suffix = f"~{number}"
+        short = (base[:8 - len(suffix)] + suffix).ljust(8) + ext.ljust(3)
+        short = short.encode("ascii")
+        if short not in taken:
+            return short, True
+    raise Exception(f"No short name available for {name}") # pylint: disable=broad-exception-raised
+
+
+def lfn_checksum(short):
+    """ checksum of a short name, stored in its long name entries """
+    checksum = 0
+    for byte in short:
+        checksum = (((checksum & 1) << 7) + (checksum >> 1) + byte) & 0xFF
+    return checksum
+
+
+def lfn_entries(name, short):
+    """ long name entries for name, in the order they are stored """
+    encoded = name.encode("utf-16-le")
+    chars = [encoded[i:i + 2] for i in range(0, len(encoded), 2)]
+    count = (len(chars) + 12) // 13
+    if len(chars) % 13:
+        chars += [b"\x00\x00"] + [b"\xff\xff"] * (count * 13 - len(chars) - 1)
+
+    checksum = lfn_checksum(short)
+    entries = []
+    for sequence in range(1, count + 1):
+        part = chars[(sequence - 1) * 13 : sequence * 13]
+        order = sequence | (0x40 if sequence == count else 0)
+        entries.append(struct.pack("<B10sBBB12sH4s", order, b"".join(part[0:5]), ATTR_LFN, 0,
+                                   checksum, b"".join(part[5:11]), 0, b"".join(part[11:13])))
+    return list(reversed(entries))
+
+
+def dir_entry(short, attr, cluster = 0, size = 0):
+    """ a short name directory entry """
+    return struct.pack("<11sBBBHHHHHHHI", short, attr, 0, 0, DOS_TIME, DOS_DATE, DOS_DATE,
+                       0, DOS_TIME, DOS_DATE, cluster, size)
+
+
+class filesystem:
+    """ A FAT12 or FAT16 filesystem, built from files in memory or on disk and written out
+    in one go. Directories are created as needed, file names may be long names. FAT12 is
+    used if the files fit, which keeps small filesystems small """
+
+    def __init__(self, label = "NO NAME", volume_id = 0, root_entries = ROOT_ENTRIES):
+        """ root_entries is the size of the root directory, None to make it just large enough
+        for the files in it """
+        self.label = label.upper()[:11].ljust(11).encode("ascii")
+        self.volume_id = volume_id
+        self.root_entries = root_entries
+        self.root = node("", directory = True)
+        self.fat_bits = None
+        self.sectors_per_cluster = None
+        self.clusters = None
+        self.fat_sectors = None
+        self.chains = []            # (first cluster, cluster count) of each file
+
+    def add_directory(self, path):
+        """ add a directory, and its parents. Returns its node """
+        directory = self.root
+        for name in [part for part in path.split("/") if part]:
+            child = directory.children.get(name)
+            if child is None:
+                child = node(name, directory = True)
+                directory.children[name] = child
+            elif not child.directory:
+                raise Exception(f"{path}: {name} is a file") # pylint: disable=broad-exception-raised
+            directory = child
+        return directory
+
+    def add_file(self, path, source):
+        """ add a file with contents source, bytes or the path of a file to copy """
+        parent, _, name = path.strip("/").rpartition("/")
+        directory = self.add_directory(parent)
+        if name in directory.children:
+            raise Exception(f"{path} already exists") # pylint: disable=broad-exception-raised
+        directory.children[name] = node(name, source)
+
+    @staticmethod
+    def name_entries(directory):
+        """ decide the short names of the files in a directory, and which need long names """
+        if len(directory.children) > len(set(n.upper() for n in directory.children)):
+            raise Exception(f"Names differing only in case in /{directory.name}") # pylint: disable=broad-exception-raised
+
+        taken = set()
+        directory.entries = []
+        for name, child in directory.children.items():
+            short, long_name = short_name(name, taken)
+            taken.add(short)
+            # Long names take one entry per 13 characters, on top of the short entry
+            long_entries = (len(name.encode("utf-16-le")) // 2 + 12) // 13 if long_name else 0
+            directory.entries.append((name if long_name else None, short, long_entries, child))
+
+    def layout(self, free_bytes = 0):
+        """ decide the names, cluster size and cluster of every file, leaving at least
+        free_bytes unused. Returns the size of the filesystem in bytes """
+        for directory in self.root.walk():
+            if directory.directory:
+                self.name_entries(directory)
+
+        # The root directory fills whole sectors
+        needed = sum(1 + entry[2] for entry in self.root.entries)
+        if self.root_entries is None:
+            self.root_entries = max(needed, MIN_ROOT_ENTRIES)
+        per_sector = SECTOR_SIZE // ENTRY_SIZE
+        self.root_entries = -(-self.root_entries // per_sector) * per_sector
+        if needed > self.root_entries:
+            raise Exception(f"More than {self.root_entries} root directory entries") # pylint: disable=broad-exception-raised
+
+        nodes = [n for n in self.root.walk() if n is not self.root]
+        for sectors_per_cluster in (1, 2, 4, 8, 16, 32, 64):
+            cluster_size = SECTOR_SIZE * sectors_per_cluster
+            needed = [(n, max(1, -(-self.entry_bytes(n) // cluster_size)) if n.directory
+                       else -(-n.size() // cluster_size)) for n in nodes]
+            used = sum(count for _, count in needed)
+            clusters = max(used + -(-free_bytes // cluster_size), 1)
+            if clusters <= FAT12_MAX_CLUSTERS:
+                self.fat_bits = 12
+                break
+            if clusters <= FAT16_MAX_CLUSTERS:
+                self.fat_bits = 16
+                clusters = max(clusters, FAT16_MIN_CLUSTERS)
+                break
+        else:
+            raise Exception("Files don't fit in a FAT16 filesystem") # pylint: disable=broad-exception-raised
+
+        self.sectors_per_cluster = sectors_per_cluster
+        self.clusters = clusters
+        fat_bytes = -(-(clusters + 2) * self.fat_bits // 8)
+        self.fat_sectors = -(-fat_bytes // SECTOR_SIZE)
+
+        # Files are contiguous, in the order they were added, parents first
+        self.chains = []
+        cluster = 2
+        for n, count in needed:
+            n.cluster = cluster if count else 0
+            if count:
+                self.chains.append((cluster, count))
+            cluster += count
+        return self.size()
+
+    def entry_bytes(self, directory):
+        """ bytes taken by the entries of a directory, with . and .. """
+        return (2 + sum(1 + entry[2] for entry in directory.entries)) * ENTRY_SIZE
+
+    def data_sector(self):
+        """ first sector of the data area, relative to the start of the filesystem """
+        return RESERVED_SECTORS + NUM_FATS * self.fat_sectors + self.root_sectors()
+
+    def root_sectors(self):
+        """ size of the root directory in sectors """
+        return self.root_entries * ENTRY_SIZE // SECTOR_SIZE
+
+    def sectors(self):
+        """ size of the filesystem in sectors """
+        return self.data_sector() + self.clusters * self.sectors_per_cluster
+
+    def size(self):
+        """ size of the filesystem in bytes """
+        return self.sectors() * SECTOR_SIZE
+
+    def cluster_offset(self, cluster):
+        """ offset of a cluster, relative to the start of the filesystem """
+        return (self.data_sector() + (cluster - 2) * self.sectors_per_cluster) * SECTOR_SIZE
+
+    def boot_sector(self, hidden_sectors):
+        """ the boot sector with the BIOS parameter block """
+        sectors = self.sectors()
+        sector = bytearray(SECTOR_SIZE)
+        sector[0:3] = b"\xeb\x3c\x90"
+        sector[3:11] = b"VMRUNNER"
+        struct.pack_into("<HBHBHHBHHHII", sector, 11, SECTOR_SIZE, self.sectors_per_cluster,
+                         RESERVED_SECTORS, NUM_FATS, self.root_entries,
+                         sectors if sectors < 0x10000 else 0, MEDIA_FIXED, self.fat_sectors,
+                         32, 64, hidden_sectors, sectors if sectors >= 0x10000 else 0)
+        struct.pack_into("<BBBI11s8s", sector, 36, 0x80, 0, 0x29, self.volume_id, self.label,
+                         f"FAT{self.fat_bits}".ljust(8).encode("ascii"))
+        # Not bootable: print nothing, ask the BIOS to try the next device
+        sector[62:64] = b"\xcd\x18"
+        sector[510:512] = b"\x55\xaa"
+        return sector
+
+    def fat(self):
+        """ the file allocation table """
+        table = [0] * (self.clusters + 2)
+        end_of_chain = (1 << self.fat_bits) - 1
+        table[0] = (end_of_chain & ~0xFF) | MEDIA_FIXED
+        table[1] = end_of_chain
+        for start, count in self.chains:
+            for cluster in range(start, start + count - 1):
+                table[cluster] = cluster + 1
+            table[start + count - 1] = end_of_chain
+
+        if self.fat_bits == 16:
+            data = struct.pack(f"<{len(table)}H", *table)
+        else:
+            # Two 12-bit entries share three bytes
+            table += [0] * (len(table) % 2)
+            data = bytearray()
+            for i in range(0, len(table), 2):
+                data += (table[i] | table[i + 1] << 12).to_bytes(3, "little")
+        return bytes(data).ljust(self.fat_sectors * SECTOR_SIZE, b"\0")
+
+    def directory_data(self, directory, parent):
+        """ the entries of a directory """
+        data = bytearray()
+        if directory is not self.root:
+            data += dir_entry(b".          ", ATTR_DIRECTORY, cluster = directory.cluster)
+            data += dir_entry(b"..         ", ATTR_DIRECTORY,
+                              cluster = 0 if parent is self.root else parent.cluster)
+
+        for long_name, short, _, child in directory.entries:
+            if long_name:
+                data += b"".join(lfn_entries(long_name, short))
+            if child.directory:
+                data += dir_entry(short, ATTR_DIRECTORY, child.cluster)
+            else:
+                data += dir_entry(short, ATTR_ARCHIVE, child.cluster, child.size())
+        return data
+
+    def write(self, f, offset = 0, hidden_sectors = 0):
+        """ write the filesystem to the open file f at offset. hidden_sectors is the start
+        of the partition, if the filesystem is in one. Call layout first """
+        if self.clusters is None:
+            self.layout()
+
+        f.seek(offset)
+        f.write(self.boot_sector(hidden_sectors))
+
+        fat = self.fat()
+        for i in range(NUM_FATS):
+            f.seek(offset + (RESERVED_SECTORS + i * self.fat_sectors) * SECTOR_SIZE)
+            f.write(fat)
+
+        # Unused space is never written, the file may be sparse
+        root = self.directory_data(self.root, None)
+        f.seek(offset + (RESERVED_SECTORS + NUM_FATS * self.fat_sectors) * SECTOR_SIZE)
+        f.write(root.ljust(self.root_sectors() * SECTOR_SIZE, b"\0"))
+
+        parents = {child : n for n in self.root.walk() for child in n.children.values()}
+        for n in self.root.walk():
+            if n is self.root or not n.cluster:
+                continue
+            f.seek(offset + self.cluster_offset(n.cluster))
+            if n.directory:
+                data = self.directory_data(n, parents[n])
+                cluster_size = self.sectors_per_cluster * SECTOR_SIZE
+                f.write(data.ljust(-(-len(data) // cluster_size) * cluster_size, b"\0"))
+            elif isinstance(n.source, (bytes, bytearray)):
+                f.write(n.source)
+            else:
+                with open(n.source, "rb") as source:
+                    while block := source.read(1 << 20):
+                        f.write(block)
+
+        # Make sure the file covers the whole filesystem, even if the end is unused
+        end = offset + self.size()
+        f.seek(0, os.SEEK_END)
+        if f.tell() < end:
+            f.truncate(end)
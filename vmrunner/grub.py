@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+""" rootless GRUB image builder, and a content-addressed cache of GRUB images """
+
+# pylint: disable=invalid-name
+
+import os
+import sys
+import shutil
+import struct
+import functools
+import subprocess
+
+from . import cache
+from . import fat
+
+# Subdirectory of the cache directory holding the images
+GRUB_CACHE_DIR = "grub"
+
+# Bump to invalidate images built by earlier versions
+GRUB_CACHE_VERSION = 1
+
+# Images are evicted, least recently used first, when the cache grows beyond this.
+# Override with VMRUNNER_GRUB_CACHE_MB
+DEFAULT_MAX_MB = 1024
+
+IMAGE_SUFFIX = ".grub.img"
+
+# Offsets in GRUB's i386-pc boot sector, boot.img, patched the way grub-install does
+BOOT_KERNEL_SECTOR = 0x5C      # LBA of the first sector of core.img
+BOOT_DRIVE_CHECK = 0x66        # Jump over the workaround for BIOSes passing a bad boot drive
+BOOT_PARTITION_TABLE = 0x1BE
+BOOT_SIGNATURE = 0x1FE
+
+# The first sector of core.img ends with a blocklist: where to load the rest of it from
+CORE_BLOCKLIST = fat.SECTOR_SIZE - 12
+CORE_SEGMENT = 0x820
+
+# core.img is embedded between the MBR and the partition, which starts at 1 MiB
+PARTITION_START = 2048
+PARTITION_TYPE_FAT12 = 0x01
+PARTITION_TYPE_FAT16 = 0x0E    # LBA addressed
+
+GRUB_PREFIX = "(hd0,msdos1)/boot/grub"
+GRUB_MODULES = ["biosdisk", "part_msdos", "fat", "normal", "configfile", "serial",
+                "terminal", "multiboot", "multiboot2"]
+
+KERNEL_PATH = "boot/includeos_service"
+
+GRUB_CFG = """set default="0"
+set timeout=0
+serial --unit=0 --speed=9600
+terminal_input serial; terminal_output serial
+
+menuentry IncludeOS {
+  multiboot /boot/includeos_service
+}
+"""
+
+def cache_path():
+    """ directory holding cached images, None if on-disk caching is disabled """
+    return cache.cache_dir(GRUB_CACHE_DIR)
+
+
+def max_bytes():
+    """ the size the cache is trimmed to after adding an image """
+    return cache.size_limit("VMRUNNER_GRUB_CACHE_MB", DEFAULT_MAX_MB)
+
+
+@functools.cache
+def find_grub():
+    """ grub-mkimage and the directory with GRUB's i386-pc images and modules, None if they
+    aren't installed. Set VMRUNNER_GRUB_DIR to use GRUB from another directory """
+    for name in ("grub-mkimage", "grub2-mkimage"):
+        mkimage = shutil.which(name)
+        if not mkimage:
+            continue
+
+        prefix = os.path.dirname(os.path.dirname(os.path.realpath(mkimage)))
+        directories = [os.environ.get("VMRUNNER_GRUB_DIR"),
+                       os.path.join(prefix, "lib", "grub", "i386-pc"),
+                       os.path.join(prefix, "lib", "grub2", "i386-pc"),
+                       "/usr/lib/grub/i386-pc",
+                       "/usr/lib/grub2/i386-pc",
+                       "/usr/share/grub2/i386-pc"]
+        for directory in directories:
+            if directory and os.path.isfile(os.path.join(directory, "boot.img")):
+                return mkimage, directory
+    return None
+
+
+def core_image(mkimage, directory):
+    """ GRUB's core.img, made to be embedded right after the MBR """
+    try:
+        core = subprocess.run([mkimage, "-O", "i386-pc", "-d", directory, "-p", GRUB_PREFIX]
+                              + GRUB_MODULES, capture_output = True, check = True).stdout
+    except subprocess.CalledProcessError as e:
+        raise Exception(f"{mkimage} failed: {e.stderr.decode(errors = 'replace').strip()}") from e # pylint: disable=broad-exception-raised
+
+    core = bytearray(core.ljust(-(-len(core) // fat.SECTOR_SIZE) * fat.SECTOR_SIZE, b"\0"))
+    sectors = len(core) // fat.SECTOR_SIZE
+    if sectors < 2 or 1 + sectors > PARTITION_START:
+        raise Exception(f"Unexpected core.img size from {mkimage}: {len(core)} bytes") # pylint: disable=broad-exception-raised
+
+    # The rest of core.img follows its first sector on disk
+    struct.pack_into("<QHH", core, CORE_BLOCKLIST, 2, sectors - 1, CORE_SEGMENT)
+    return core
+
+
+def boot_sector(directory, filesystem):
+    """ GRUB's boot.img, pointing at core.img in sector 1, with a partition table holding
+    one bootable partition for filesystem """
+    with open(os.path.join(directory, "boot.img"), "rb") as f:
+        sector = bytearray(f.read(fat.SECTOR_SIZE))
+
+    sector[BOOT_DRIVE_CHECK : BOOT_DRIVE_CHECK + 2] = b"\x90\x90"
+    struct.pack_into("<Q", sector, BOOT_KERNEL_SECTOR, 1)
+
+    # Status, CHS start, type, CHS end, LBA start, sectors. CHS is unused, marked as such
+    struct.pack_into("<B3sB3sII", sector, BOOT_PARTITION_TABLE, 0x80, b"\xfe\xff\xff",
+                     PARTITION_TYPE_FAT12 if filesystem.fat_bits == 12 else PARTITION_TYPE_FAT16,
+                     b"\xfe\xff\xff", PARTITION_START, filesystem.sectors())
+    sector[BOOT_SIGNATURE : BOOT_SIGNATURE + 2] = b"\x55\xaa"
+    return sector
+
+
+def build_image(kernel, output, grub_cfg = None):
+    """ write a disk image with GRUB booting kernel to output, without mounting it or
+    needing root. GRUB's stages go in front of a FAT16 partition holding the kernel, GRUB's
+    modules and grub.cfg, which boots the kernel over the serial console unless a custom
+    grub_cfg is given. The image is written to a temporary file and renamed, so concurrent
+    builds don't interfere """
+    import tempfile # pylint: disable=import-outside-toplevel
+
+    grub = find_grub()
+    if grub is None:
+        raise Exception("GRUB for i386-pc not found. Install grub-mkimage and GRUB's " # pylint: disable=broad-exception-raised
+                        "i386-pc modules, or point VMRUNNER_GRUB_DIR at them")
+    mkimage, directory = grub
+
+    filesystem = fat.filesystem(label = "INCLUDEOS")
+    filesystem.add_file(KERNEL_PATH, kernel)
+    if grub_cfg and os.path.isfile(grub_cfg):
+        filesystem.add_file("boot/grub/grub.cfg", grub_cfg)
+    else:
+        filesystem.add_file("boot/grub/grub.cfg", GRUB_CFG.encode())
+
+    # Modules not in core.img are loaded on demand from here, like after grub-install
+    for name in sorted(os.listdir(directory)):
+        if name.endswith((".mod", ".lst")):
+            filesystem.add_file("boot/grub/i386-pc/" + name, os.path.join(directory, name))
+    filesystem.layout()
+
+    core = core_image(mkimage, directory)
+    output = os.path.abspath(output)
+    fd, tmp = tempfile.mkstemp(dir = os.path.dirname(output),
+                               prefix = "." + os.path.basename(output) + ".")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(boot_sector(directory, filesystem))
+            f.write(core)
+            filesystem.write(f, PARTITION_START * fat.SECTOR_SIZE,
+                             hidden_sectors = PARTITION_START)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, output)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    return output
+
+
+def image_key(kernel, tools, options = (), grub_cfg = None):
+    """ cache key for the image built from kernel. Covers everything the image depends on:
+    the kernel, the files of the tools building it, their options and a custom grub.cfg """
+    import hashlib # pylint: disable=import-outside-toplevel
+    digest = hashlib.sha256()
+    digest.update(f"v{GRUB_CACHE_VERSION}\0".encode())
+    digest.update(cache.file_hash(kernel).encode() + b"\0")
+    for tool in tools:
+        digest.update(cache.file_hash(tool).encode() + b"\0")
+    digest.update("\0".join(options).encode() + b"\0")
+    if grub_cfg and os.path.isfile(grub_cfg):
+        digest.update(cache.file_hash(grub_cfg).encode())
+    return digest.hexdigest()
+
+
+def lookup(key):
+    """ path of the cached image for key, None if it isn't cached. Marks the image as
+    recently used """
+    directory = cache_path()
+    if directory is None:
+        return None
+
+    path = os.path.join(directory, key + IMAGE_SUFFIX)
+    return path if cache.touch(path) else None
+
+
+def evict(limit = None, keep = None):
+    """ remove the least recently used images, except keep, until the cache is no larger
+    than limit bytes """
+    directory = cache_path()
+    if directory is not None:
+        cache.evict(directory, IMAGE_SUFFIX, max_bytes() if limit is None else limit, keep)
+
+
+def build_grubify(kernel, key, grubify, options = (), grub_cfg = None):
+    """ run grubify.sh in a scratch directory and move the result into the cache. Builds are
+    serialized, since grubify mounts the image on a fixed mount point """
+    import fcntl # pylint: disable=import-outside-toplevel
+    import tempfile # pylint: disable=import-outside-toplevel
+
+    directory = cache_path()
+    with open(os.path.join(directory, ".lock"), "w", encoding = "utf-8") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        # Someone else may have built it while we waited
+        path = lookup(key)
+        if path:
+            return path
+
+        scratch = tempfile.mkdtemp(dir = directory, prefix = ".build-")
+        try:
+            if grub_cfg and os.path.isfile(grub_cfg):
+                shutil.copyfile(grub_cfg, os.path.join(scratch, "grub.cfg"))
+
+            kernel = os.path.abspath(kernel)
+            subprocess.run([grubify] + list(options) + [kernel], cwd = scratch, check = True)
+
+            built = os.path.join(scratch, os.path.basename(kernel) + IMAGE_SUFFIX)
+            if not os.path.isfile(built):
+                raise Exception(f"{grubify} didn't create {built}") # pylint: disable=broad-exception-raised
+
+            path = os.path.join(directory, key + IMAGE_SUFFIX)
+            os.replace(built, path)
+        finally:
+            # Files created by grubify through sudo may not be ours to remove
+            shutil.rmtree(scratch, ignore_errors = True)
+
+    evict(keep = path)
+    return path
+
+
+def cached_image(kernel, grubify = None, options = (), grub_cfg = "grub.cfg", allow_build = True):
+    """ path of a GRUB image booting kernel, built only if the kernel, the tools building it
+    or grub.cfg changed since the last build. Images are built with build_image if GRUB is
+    installed, otherwise with grubify, which needs sudo. Returns None if the image isn't
+    cached and allow_build is False, or if on-disk caching is disabled """
+    if cache_path() is None:
+        return None
+
+    grub = find_grub()
+    if grub:
+        mkimage, directory = grub
+        tools = [mkimage] + [os.path.join(directory, name) for name in ("boot.img", "moddep.lst")
+                             if os.path.isfile(os.path.join(directory, name))]
+        key = image_key(kernel, tools, ["rootless"] + list(options), grub_cfg)
+    elif grubify:
+        key = image_key(kernel, [grubify], options, grub_cfg)
+    else:
+        raise Exception("Neither GRUB nor grubify.sh found") # pylint: disable=broad-exception-raised
+
+    path = lookup(key)
+    if path or not allow_build:
+        return path
+
+    if grubify and not grub:
+        return build_grubify(kernel, key, grubify, options, grub_cfg)
+
+    path = build_image(kernel, os.path.join(cache_path(), key + IMAGE_SUFFIX), grub_cfg)
+    evict(keep = path)
+    return path
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3):
+        print(f"Usage: {sys.argv[0]} KERNEL [IMAGE]")
+        print("Create a bootable GRUB image for a multiboot compatible KERNEL, without root")
+        sys.exit(1)
+
+    print(build_image(sys.argv[1], sys.argv[2] if len(sys.argv) == 3 else
+                      os.path.basename(sys.argv[1]) + IMAGE_SUFFIX, "grub.cfg"))
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+""" host capability probe for vmrunner """
+
+# pylint: disable=invalid-name, too-many-instance-attributes
+
+import os
+import re
+import grp
+import shutil
+import platform
+import subprocess
+import threading
+
+from . import cache
+
+KVM_DEVICE = "/dev/kvm"
+CPUINFO = "/proc/cpuinfo"
+BOOT_ID = "/proc/sys/kernel/random/boot_id"
+NESTED_PARAMS = ["/sys/module/kvm_intel/parameters/nested",
+                 "/sys/module/kvm_amd/parameters/nested"]
+
+# Name of the on-disk cache file
+CACHE_FILE = "host.json"
+
+cpu_flags = re.compile(r"^flags\s*:.*\b(vmx|svm)\b", re.MULTILINE)
+
+
+def read_file(path):
+    """ contents of a small text file, None if it can't be read """
+    try:
+        with open(path, encoding = "utf-8", errors = "replace") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+class host_info:
+    """ What the host offers for running VMs.
+
+    Device access and group membership belong to this process and are always probed.
+    The CPU's virtualization extensions and the accelerators supported by each qemu
+    binary are also kept in the on-disk cache, which is valid until the host reboots. """
+
+    def __init__(self):
+        self.system = platform.system()
+        self.machine = platform.machine()
+        self.hvf = self.system == "Darwin"
+
+        self.kvm_device = os.path.exists(KVM_DEVICE)
+        self.kvm_access = self.kvm_device and os.access(KVM_DEVICE, os.R_OK | os.W_OK)
+
+        try:
+            self.kvm_group = True
+            self.in_kvm_group = grp.getgrnam("kvm").gr_gid in os.getgroups()
+        except KeyError:
+            self.kvm_group = False
+            self.in_kvm_group = False
+
+        self.nested = any((read_file(path) or "").strip() in ("Y", "1") for path in NESTED_PARAMS)
+
+        self._boot_id = (read_file(BOOT_ID) or "").strip()
+        self._cached = cache.load_json(CACHE_FILE) or {}
+        if not self._boot_id or self._cached.get("boot_id") != self._boot_id:
+            self._cached = {"boot_id" : self._boot_id, "accelerators" : {}}
+
+        if "cpu_virt" in self._cached:
+            self.cpu_virt = self._cached["cpu_virt"]
+        else:
+            match = cpu_flags.search(read_file(CPUINFO) or "")
+            self.cpu_virt = match.group(1) if match else None
+            self._cached["cpu_virt"] = self.cpu_virt
+            self._store()
+
+        self._accelerators = {}
+        self._lock = threading.Lock()
+
+    def _store(self):
+        """ update the on-disk cache, if the results can be tied to this boot of the host """
+        if self._boot_id:
+            cache.store_json(CACHE_FILE, self._cached)
+
+    def kvm_capable(self):
+        """ true if the CPU has virtualization extensions """
+        return self.cpu_virt is not None
+
+    def kvm_usable(self):
+        """ true if KVM can be used by this process without sudo """
+        return self.kvm_capable() and self.kvm_access
+
+    def accelerators(self, qemu_binary = "qemu-system-x86_64"):
+        """ accelerators supported by a qemu binary, e.g. ["kvm", "tcg"]. Empty if the binary
+        isn't found. The binary is only run if it changed since it was last asked """
+        path = shutil.which(qemu_binary)
+        if path is None:
+            return []
+
+        stat = os.stat(path)
+        key = f"{os.path.realpath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+        with self._lock:
+            if key in self._accelerators:
+                return self._accelerators[key]
+
+            accels = self._cached["accelerators"].get(key)
+            if accels is None:
+                try:
+                    # Prints a heading followed by one accelerator per line
+                    output = subprocess.run([path, "-accel", "help"], capture_output = True,
+                                            text = True, timeout = 10, check = True).stdout
+                    accels = [line.strip() for line in output.splitlines()[1:] if line.strip()]
+                except (OSError, subprocess.SubprocessError):
+                    accels = []
+                self._cached["accelerators"][key] = accels
+                self._store()
+
+            self._accelerators[key] = accels
+            return accels
+
+    def describe(self):
+        """ a one line summary """
+        return (f"{self.system} {self.machine}, cpu virtualization: {self.cpu_virt or 'none'}, "
+                f"nested: {self.nested}, /dev/kvm: "
+                f"{'rw' if self.kvm_access else 'present' if self.kvm_device else 'missing'}, "
+                f"kvm group member: {self.in_kvm_group}, hvf: {self.hvf}")
+
+
+_host = None
+_host_lock = threading.Lock()
+
+
+def probe():
+    """ capabilities of this host, probed once per process and shared by all hypervisors """
+    global _host # pylint: disable=global-statement
+    with _host_lock:
+        if _host is None:
+            _host = host_info()
+        return _host
+
+
+def reset():
+    """ forget the probe results, e.g. after changing group membership or loading kvm """
+    global _host # pylint: disable=global-statement
+    with _host_lock:
+        _host = None
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+""" output pattern matching for vmrunner events """
+
+# pylint: disable=invalid-name
+
+import re
+
+# Characters that give a pattern a meaning beyond its literal text
+regex_chars = frozenset(".^$*+?{}[]\\|()")
+
+
+def is_literal(pattern):
+    """ true if pattern only matches its own text """
+    return not regex_chars.intersection(pattern)
+
+
+class output_matcher:
+    """ Ordered mapping from output patterns to callbacks.
+
+    Each pattern is compiled when it's registered. Matching a line runs all the
+    patterns at once through one combined alternation, which is rebuilt on the
+    first match after new patterns were added. Only when the combined expression
+    finds something are the patterns checked one by one, to collect every
+    callback that matched in registration order. Literal patterns are checked
+    with a plain substring search. Patterns that can't be combined, e.g. because
+    they use groups or inline flags, are always checked on their own. """
+
+    def __init__(self, callbacks = None):
+        self._callbacks = {}
+        self._matchers = {}
+        self._combined = None
+        self._separate = []
+        self._dirty = False
+
+        for pattern, callback in (callbacks or {}).items():
+            self[pattern] = callback
+
+    def __setitem__(self, pattern, callback):
+        if pattern not in self._callbacks:
+            # Literal patterns have no search function
+            self._matchers[pattern] = None if is_literal(pattern) else re.compile(pattern).search
+            self._dirty = True
+        self._callbacks[pattern] = callback
+
+    def __getitem__(self, pattern):
+        return self._callbacks[pattern]
+
+    def __delitem__(self, pattern):
+        del self._callbacks[pattern]
+        del self._matchers[pattern]
+        self._dirty = True
+
+    def __contains__(self, pattern):
+        return pattern in self._callbacks
+
+    def __iter__(self):
+        return iter(self._callbacks)
+
+    def __len__(self):
+        return len(self._callbacks)
+
+    def items(self):
+        """ (pattern, callback) pairs in registration order """
+        return self._callbacks.items()
+
+    def _compile(self):
+        """ combine all patterns that can share one expression """
+        combinable = []
+        self._separate = []
+
+        for pattern, search in self._matchers.items():
+            if search is None:
+                combinable.append(re.escape(pattern))
+            elif search.__self__.groups == 0 and not search.__self__.flags & ~re.UNICODE:
+                combinable.append(pattern)
+            else:
+                self._separate.append(pattern)
+
+        self._combined = None
+        if combinable:
+            try:
+                self._combined = re.compile("|".join(f"(?:{p})" for p in combinable))
+            except re.error:
+                self._separate = list(self._callbacks)
+
+        self._dirty = False
+
+    def match(self, line):
+        """ returns the callbacks for all patterns found in line, in registration order """
+        if self._dirty:
+            self._compile()
+
+        if self._combined is not None and self._combined.search(line):
+            return [self._callbacks[pattern] for pattern, search in self._matchers.items()
+                    if (search(line) if search else pattern in line)]
+
+        # Literal patterns end up here if combining failed
+        return [self._callbacks[pattern] for pattern in self._separate
+                if (search(line) if (search := self._matchers[pattern]) else pattern in line)]
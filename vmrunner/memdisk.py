@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+""" incremental memdisk builder: a FAT image of the memdisk directory, and the assembly
+including it in an IncludeOS binary """
+
+# pylint: disable=invalid-name
+
+import os
+import sys
+import json
+import argparse
+
+from . import fat
+
+MEMDISK_DIR = "memdisk"
+FILENAME = "memdisk.fat"
+ASM_FILE = "memdisk.asm"
+LABEL = "INC_MEMDISK"
+
+# Bump when the image layout changes, to rebuild images made by earlier versions
+MANIFEST_VERSION = 1
+
+# The assembly trick to get the memdisk into the ELF binary
+ASM_TEMPLATE = """USE32
+ALIGN 32
+
+section .diskdata
+contents:
+    incbin  "{filename}"
+
+"""
+
+
+def manifest_path(filename):
+    """ the manifest kept next to an image """
+    return filename + ".manifest"
+
+
+def load_manifest(filename):
+    """ the manifest of the last build of an image, empty if there is none """
+    try:
+        with open(manifest_path(filename), encoding = "utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return manifest if manifest.get("version") == MANIFEST_VERSION else {}
+
+
+def file_hash(path):
+    """ sha256 of a file's contents """
+    import hashlib # pylint: disable=import-outside-toplevel
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def scan(directory, previous = None):
+    """ the directories and files below directory, with the size, modification time and
+    hash of each file. Files with the size and modification time they had in previous,
+    an earlier scan, aren't hashed again """
+    previous = previous or {}
+    directories = []
+    files = {}
+    for parent, subdirectories, names in os.walk(directory):
+        subdirectories.sort()
+        relative = os.path.relpath(parent, directory)
+        if relative != ".":
+            directories.append(relative.replace(os.sep, "/"))
+
+        for name in sorted(names):
+            path = os.path.join(parent, name)
+            key = os.path.relpath(path, directory).replace(os.sep, "/")
+            stat = os.stat(path)
+            known = previous.get(key)
+            if known and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+                files[key] = known
+            else:
+                files[key] = [stat.st_size, stat.st_mtime_ns, file_hash(path)]
+    return directories, files
+
+
+def image_stat(filename):
+    """ size and modification time of an image, None if it doesn't exist """
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def write_atomic(path, data):
+    """ replace the file at path with data """
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def build(directory = MEMDISK_DIR, filename = FILENAME, asm_file = ASM_FILE, force = False):
+    """ make filename a FAT image with the contents of directory, and asm_file the assembly
+    including it. Nothing is written if directory has the same contents as at the last build,
+    and the image is still the one built then. Returns True if the image was rebuilt """
+    if not os.path.isdir(directory):
+        raise Exception(f"Directory '{directory}' not found") # pylint: disable=broad-exception-raised
+
+    manifest = load_manifest(filename)
+    directories, files = scan(directory, manifest.get("files"))
+    contents = {"directories" : directories,
+                "files" : {path : entry[2] for path, entry in files.items()},
+                "label" : LABEL}
+    asm = ASM_TEMPLATE.format(filename = filename).encode()
+
+    unchanged = (not force and manifest.get("contents") == contents
+                 and manifest.get("image") == image_stat(filename))
+
+    asm_current = False
+    try:
+        with open(asm_file, "rb") as f:
+            asm_current = f.read() == asm
+    except OSError:
+        pass
+    if not asm_current:
+        write_atomic(asm_file, asm)
+
+    if unchanged:
+        # Remember new modification times of files with the same contents
+        if manifest["files"] != files:
+            manifest["files"] = files
+            write_atomic(manifest_path(filename), json.dumps(manifest, indent = 1).encode())
+        return False
+
+    filesystem = fat.filesystem(label = LABEL, root_entries = None)
+    for path in directories:
+        filesystem.add_directory(path)
+    for path in files:
+        filesystem.add_file(path, os.path.join(directory, path))
+    filesystem.layout()
+
+    tmp = f"{filename}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            filesystem.write(f)
+        os.replace(tmp, filename)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+    # Written last: an interrupted build leaves no manifest claiming it's up to date
+    manifest = {"version" : MANIFEST_VERSION,
+                "contents" : contents,
+                "files" : files,
+                "image" : image_stat(filename)}
+    write_atomic(manifest_path(filename), json.dumps(manifest, indent = 1).encode())
+    return True
+
+
+def main():
+    """ build the memdisk in the current directory, like create_memdisk.sh did """
+    parser = argparse.ArgumentParser(
+        description = "Stuff everything in the memdisk directory into a FAT disk image, and "
+        "create assembly including it in a binary. Nothing is rewritten if the directory is "
+        "unchanged since the last build.")
+    parser.add_argument("-f", "--force", action = "store_true",
+                        help = "Rebuild the image even if nothing changed")
+    parser.add_argument("-d", "--directory", default = MEMDISK_DIR,
+                        help = f"Directory to put in the image, default {MEMDISK_DIR}")
+    parser.add_argument("-o", "--output", default = FILENAME,
+                        help = f"The image to create, default {FILENAME}")
+    parser.add_argument("--asm", default = ASM_FILE,
+                        help = f"The assembly file to create, default {ASM_FILE}")
+    args = parser.parse_args()
+
+    try:
+        rebuilt = build(args.directory, args.output, args.asm, args.force)
+    except Exception as e: # pylint: disable=broad-exception-caught
+        print(e)
+        sys.exit(1)
+
+    if rebuilt:
+        print(f">>> Created {args.output}, {os.path.getsize(args.output)} bytes")
+    else:
+        print(f">>> {args.directory} unchanged, keeping {args.output}")
+
+
+if __name__ == "__main__":
+    main()
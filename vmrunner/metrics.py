@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+""" boot phase timings for vmrunner VMs """
+
+# pylint: disable=invalid-name
+
+import time
+import json
+
+# Boot phases, in the order they normally happen:
+#   spawn       - the hypervisor process was started
+#   first_byte  - its first output was read
+#   bios        - the SeaBIOS banner was seen
+#   signature   - the IncludeOS banner, includeos_signature, was seen
+#   first_match - output first matched an on_output callback
+#   exit_line   - the service printed its exit status
+#   reap        - the hypervisor process was gone
+PHASES = ("spawn", "first_byte", "bios", "signature", "first_match", "exit_line", "reap")
+
+
+class boot_metrics:
+    """ Monotonic timestamps of the phases of one boot.
+
+    start is taken when the boot begins, and each phase is recorded the first time it
+    happens, with mark. Phases that didn't happen, like the BIOS banner when booting with
+    solo5 or from a saved VM state, stay None """
+
+    def __init__(self, start = None):
+        self.start = time.monotonic() if start is None else start
+        self.started_at = time.time()
+        self.times = dict.fromkeys(PHASES)
+
+    def mark(self, phase, when = None):
+        """ record phase as happening at when, by default now, unless it's recorded already """
+        if self.times[phase] is None:
+            self.times[phase] = time.monotonic() if when is None else when
+
+    def elapsed(self, phase):
+        """ seconds from start until phase, None if it hasn't happened """
+        when = self.times[phase]
+        return None if when is None else when - self.start
+
+    def as_dict(self):
+        """ seconds from start until each phase """
+        return {phase : self.elapsed(phase) for phase in PHASES}
+
+    def summary(self):
+        """ the phases that happened, as one line """
+        return ", ".join(f"{phase} {seconds:.3f}s" for phase, seconds in self.as_dict().items()
+                         if seconds is not None)
+
+    def write_json(self, path, **details):
+        """ write the phases to path as JSON, along with details like the exit status """
+        data = {"started_at" : self.started_at, **details, "phases" : self.as_dict()}
+        with open(path, "w", encoding = "utf-8") as f:
+            json.dump(data, f, indent = 2)
+            f.write("\n")
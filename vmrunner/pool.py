@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+""" run many vmrunner VMs concurrently """
+
+# pylint: disable=invalid-name, too-many-arguments, too-few-public-methods, too-many-instance-attributes, broad-exception-caught
+
+import os
+import time
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from . import vmrunner
+
+
+class job:
+    """ A VM to boot: image, config and boot arguments """
+
+    def __init__(self, image, config = None, kernel_args = "booted with vmrunner", timeout = 60,
+                 name = None, hyper_name = "qemu", **boot_args):
+        self.image = image
+        self.config = config
+        self.kernel_args = kernel_args
+        self.timeout = timeout
+        self.name = name or os.path.basename(image)
+        self.hyper_name = hyper_name
+        self.boot_args = boot_args
+
+
+class result:
+    """ The outcome of a job """
+
+    def __init__(self, job_, exit_code, msg, start, end, output, metrics = None):
+        self.job = job_
+        self.exit_code = exit_code
+        self.status = vmrunner.get_exit_code_name(exit_code)
+        self.msg = msg
+        self.start = start
+        self.end = end
+        self.duration = end - start
+        self.output = output
+        self.metrics = metrics # Boot phase timings, see metrics.py
+
+    def ok(self):
+        """ true if the VM exited successfully, possibly with warnings """
+        return self.exit_code in (vmrunner.exit_codes["SUCCESS"], vmrunner.exit_codes["UNSAFE"])
+
+
+def skipped(job_, start):
+    """ the result of a job skipped because its pool was aborted """
+    return result(job_, vmrunner.exit_codes["ABORT"], "Aborted before starting", start,
+                  time.monotonic(), [])
+
+
+class vm_pool:
+    """ Runs jobs on up to workers VMs at a time, each VM driven from its own thread.
+
+    VMs in the pool never exit the program: each job's exit status and message are
+    collected in a result, together with timings and the captured VM output. VMs
+    are registered in vmrunner.vms while running, so they're stopped on signals.
+    A signal also aborts the pool, so jobs that haven't started yet never do, their
+    results have the ABORT exit code.
+    With log, a capture.console_log, the output of all VMs is logged there too,
+    with the job names as VM ids. colored is passed on to sinks.terminal_sink. Without
+    capture, results only hold the last lines of output, see vm.keep_recent, which bounds
+    the memory used by long running VMs. With prewarm, up to that many qemu processes are
+    kept started for jobs booting the same image with the same config, see vm.prewarm. """
+
+    def __init__(self, workers = None, echo = False, prefix = True, log = None, colored = None,
+                 capture = True, prewarm = 0):
+        self._workers = workers or os.cpu_count()
+        self._echo = echo
+        self._prefix = prefix
+        self._log = log
+        self._colored = colored
+        self._capture = capture
+        self._prewarm = prewarm
+        self._executor = ThreadPoolExecutor(max_workers = self._workers,
+                                            thread_name_prefix = "vmrunner-pool")
+        self._aborted = threading.Event()
+        # Signal handlers can only be installed from the main thread
+        vmrunner.add_signal_callback(self.abort)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.shutdown()
+
+    def shutdown(self, wait = True):
+        """ stop accepting jobs, optionally waiting for the running ones """
+        vmrunner.remove_signal_callback(self.abort)
+        self._executor.shutdown(wait = wait)
+
+    def abort(self, _signum = None):
+        """ skip the jobs that haven't started. Running VMs are left to the caller, e.g. the
+        signal handler stopping vmrunner.vms """
+        self._aborted.set()
+        self._executor.shutdown(wait = False, cancel_futures = True)
+
+    def aborted(self):
+        """ true once the pool was aborted """
+        return self._aborted.is_set()
+
+    def submit(self, job_):
+        """ queue a job, returns a concurrent.futures.Future for its result. Jobs cancelled
+        by abort are cancelled futures, see outcome """
+        if self.aborted():
+            future = Future()
+            future.cancel()
+            return future
+        return self._executor.submit(self._run, job_)
+
+    def outcome(self, job_, future):
+        """ the result of job_ from its future, an aborted result if it was cancelled """
+        if future.cancelled():
+            return skipped(job_, time.monotonic())
+        return future.result()
+
+    def run(self, jobs, on_result = None):
+        """ run all jobs, returning results in job order. on_result is called as jobs finish """
+        futures = [self.submit(job_) for job_ in jobs]
+        if on_result:
+            for job_, future in zip(jobs, futures):
+                future.add_done_callback(lambda f, job_ = job_: on_result(self.outcome(job_, f)))
+        return [self.outcome(job_, future) for job_, future in zip(jobs, futures)]
+
+    def _run(self, job_):
+        """ boot one VM and wait for it to finish """
+        start = time.monotonic()
+        if self.aborted():
+            return skipped(job_, start)
+        vm_ = None
+        exit_code = vmrunner.exit_codes["PROGRAM_FAILURE"]
+        msg = ""
+
+        try:
+            vm_ = vmrunner.vm(config = job_.config, hyper_name = job_.hyper_name,
+                              exit_program = False)
+            prefix = f"[{job_.name}] " if self._prefix else ""
+            vm_.set_output(echo = self._echo, prefix = prefix, capture = self._capture,
+                           colored = self._colored)
+            if self._log:
+                vm_.log_to(self._log, job_.name)
+            vm_.prewarm(self._prewarm)
+
+            vmrunner.register_vm(vm_)
+            # The signal handler stops VMs registered before the pool was aborted
+            if self.aborted():
+                return skipped(job_, start)
+
+            vm_.boot(timeout = job_.timeout, kernel_args = job_.kernel_args,
+                     image_name = job_.image, **job_.boot_args)
+            exit_code = vm_.wait()
+            msg = vm_.exit_msg()
+
+        except (Exception, SystemExit) as e:
+            if isinstance(e, SystemExit) and isinstance(e.code, int):
+                exit_code = e.code
+            elif vm_ is None:
+                exit_code = vmrunner.exit_codes["PARSE_ERROR"]
+            msg = str(e)
+            if vm_ is not None:
+                vm_.stop()
+
+        finally:
+            vmrunner.unregister_vm(vm_)
+
+        if exit_code is None:
+            exit_code = vmrunner.exit_codes["PROGRAM_FAILURE"]
+
+        output = []
+        if vm_ is not None:
+            output = vm_.output() if self._capture else vm_.recent_output()
+        metrics = vm_.metrics() if vm_ is not None else None
+        return result(job_, exit_code, msg, start, time.monotonic(), output, metrics)
+
+
+def run_jobs(jobs, workers = None, echo = False, on_result = None, log = None, colored = None,
+             capture = True, prewarm = 0):
+    """ run jobs on a vm_pool with up to workers VMs at a time, returns their results """
+    with vm_pool(workers, echo, log = log, colored = colored, capture = capture,
+                 prewarm = prewarm) as pool:
+        return pool.run(jobs, on_result)
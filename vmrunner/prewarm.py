@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+""" qemu processes started ahead of time, paused, for the next boots to claim """
+
+# pylint: disable=invalid-name
+
+import os
+import json
+import atexit
+import weakref
+import threading
+import collections
+
+from .prettify import color
+
+# Processes are kept for this many configurations at most, least recently claimed ones are
+# stopped first
+MAX_KEYS = 4
+
+
+def key(config, boot_args):
+    """ key for VMs with config booted with boot_args, vm.boot's multiboot, debug,
+    kernel_args, image_name, allow_sudo and enable_kvm. Relative paths and the chainloader
+    depend on the working directory and environment, so they're part of it """
+    return json.dumps([config, boot_args, os.getcwd(), os.environ.get("INCLUDEOS_CHAINLOADER")],
+                      sort_keys = True, default = str)
+
+
+def _stamp(paths):
+    """ size and modification time of each of paths, None for missing ones """
+    stamps = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            stamps.append((path, stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            stamps.append((path, None))
+    return stamps
+
+
+class warm_pool:
+    """ qemu hypervisors started paused, with -S, waiting on their QMP socket.
+
+    claim hands out a hypervisor started for the same key, which only needs to be resumed,
+    and has the pool start another one in the background, so the next boot finds one ready
+    too. Hypervisors are started by one background thread, with the factory passed to claim,
+    and are only handed out if the files they were booted from haven't changed since. They
+    keep running until claimed, or stopped at exit """
+
+    def __init__(self, max_keys = MAX_KEYS):
+        self._max_keys = max_keys
+        self._idle = collections.OrderedDict() # key -> [(hypervisor, stamps)]
+        self._wanted = collections.OrderedDict() # key -> (count, factory) to start
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+        self._closed = False
+
+    def claim(self, key_, count, factory):
+        """ a paused hypervisor started for key_, None if there is none ready. Afterwards the
+        pool starts hypervisors with factory until count are ready for key_ """
+        stale = []
+        claimed = None
+        with self._lock:
+            idle = self._idle.get(key_, [])
+            while idle and not claimed:
+                hyper, stamps = idle.pop(0)
+                if hyper.poll() is None and _stamp(path for path, *_ in stamps) == stamps:
+                    claimed = hyper
+                else:
+                    stale.append(hyper)
+            self._idle[key_] = idle
+            self._idle.move_to_end(key_)
+            self._wanted[key_] = (count, factory)
+            self._wakeup.notify()
+            if self._thread is None:
+                self._thread = threading.Thread(target = self._run, name = "vmrunner-prewarm",
+                                                daemon = True)
+                self._thread.start()
+                # Processes have to be stopped before tempfile removes their QMP sockets at exit.
+                # Exit hooks run in reverse order, and the one removing temporary directories
+                # is registered by weakref with the first finalizer
+                weakref.finalize(self, lambda : None)
+                atexit.register(self.close)
+
+        for hyper in stale:
+            hyper.stop()
+        return claimed
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._wanted and not self._closed:
+                    self._wakeup.wait()
+                if self._closed:
+                    return
+                key_, (count, factory) = self._wanted.popitem(last = False)
+                if len(self._idle.get(key_, [])) >= count:
+                    continue
+
+            try:
+                hyper = factory()
+            except Exception as e: # pylint: disable=broad-exception-caught
+                print(color.WARNING(f"Couldn't start a paused VM ahead of time: {e}"))
+                continue
+
+            evicted = []
+            with self._lock:
+                closed = self._closed
+                if not closed:
+                    self._idle.setdefault(key_, []).append((hyper, _stamp(hyper.input_files())))
+                    # Maybe more are needed, unless a claim asked for something else meanwhile
+                    self._wanted.setdefault(key_, (count, factory))
+                    while len(self._idle) > self._max_keys:
+                        _, old = self._idle.popitem(last = False)
+                        evicted += [old_hyper for old_hyper, _ in old]
+            for old_hyper in evicted:
+                old_hyper.stop()
+            if closed:
+                hyper.stop()
+                return
+
+    def close(self, timeout = 10):
+        """ stop the hypervisors that weren't claimed, waiting up to timeout seconds for one
+        being started """
+        with self._lock:
+            self._closed = True
+            self._wanted.clear()
+            self._wakeup.notify()
+            idle = [hyper for hypers in self._idle.values() for hyper, _ in hypers]
+            self._idle.clear()
+        for hyper in idle:
+            hyper.stop()
+        if self._thread:
+            self._thread.join(timeout)
+
+pool = warm_pool()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+""" client for qemu's QMP control socket """
+
+# pylint: disable=invalid-name, too-many-instance-attributes
+
+import os
+import json
+import time
+import socket
+import threading
+
+
+class qmp_error(Exception):
+    """ an error reply to a QMP command """
+
+    def __init__(self, command, error):
+        self.command = command
+        self.error_class = error.get("class")
+        self.desc = error.get("desc", str(error))
+        super().__init__(f"QMP {command} failed: {self.desc}")
+
+
+class qmp_client:
+    """ A blocking QMP connection over a unix socket.
+
+    Either qemu listens, with -qmp unix:PATH,server=on, and connect connects to it, or listen
+    creates the socket for qemu to connect to, with -qmp unix:PATH, and connect accepts. The
+    latter needs no retries and works with qemu running as root.
+
+    Commands may be run from several threads, or from coroutines with execute_async. Replies
+    are matched to commands in order. Events arriving in between are kept in events, oldest
+    first """
+
+    def __init__(self, path, timeout = 10):
+        self.path = path
+        self.timeout = timeout
+        self.events = []
+        self.greeting = None
+        self._server = None
+        self._sock = None
+        self._file = None
+        self._lock = threading.RLock()
+
+    def listen(self):
+        """ create the socket for qemu to connect to """
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            server.bind(self.path)
+            server.listen(1)
+        except OSError:
+            server.close()
+            raise
+        self._server = server
+        return self
+
+    def connected(self):
+        """ True once connect has succeeded, until close """
+        return self._sock is not None
+
+    def connect(self, wait = 0):
+        """ connect and negotiate capabilities, unless connected already. Retries for up to
+        wait seconds while qemu hasn't created the socket yet, or waits as long for qemu to
+        connect after listen """
+        with self._lock:
+            if self._sock:
+                return self
+
+            if self._server:
+                self._server.settimeout(max(wait, 0.001))
+                try:
+                    sock, _ = self._server.accept()
+                except socket.timeout as e:
+                    raise TimeoutError(f"qemu didn't connect to {self.path}") from e
+                sock.settimeout(self.timeout)
+            else:
+                sock = self._connect(wait)
+
+            self._sock = sock
+            self._file = sock.makefile("rb")
+            self.greeting = self._read()
+            if "QMP" not in self.greeting:
+                self.close()
+                raise Exception(f"Unexpected QMP greeting: {self.greeting}") # pylint: disable=broad-exception-raised
+            self.execute("qmp_capabilities")
+            return self
+
+    def _connect(self, wait):
+        """ a socket connected to qemu, retrying for up to wait seconds """
+        deadline = time.monotonic() + wait
+        delay = 0.001
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.path)
+                return sock
+            except (FileNotFoundError, ConnectionRefusedError):
+                sock.close()
+                if time.monotonic() + delay > deadline:
+                    raise
+                time.sleep(delay)
+                delay = min(delay * 2, 0.1)
+
+    def _read(self):
+        """ the next message from qemu """
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError("QMP connection closed")
+        return json.loads(line)
+
+    def execute(self, command, arguments = None):
+        """ run a command, returning its reply. Raises qmp_error on an error reply """
+        message = {"execute" : command}
+        if arguments:
+            message["arguments"] = arguments
+
+        with self._lock:
+            if not self._sock:
+                raise ConnectionError("QMP not connected")
+            self._sock.sendall(json.dumps(message).encode() + b"\n")
+
+            while True:
+                reply = self._read()
+                if "event" in reply:
+                    self.events.append(reply)
+                    continue
+                if "error" in reply:
+                    raise qmp_error(command, reply["error"])
+                return reply.get("return")
+
+    async def execute_async(self, command, arguments = None):
+        """ execute for coroutines, without blocking the event loop """
+        import asyncio # pylint: disable=import-outside-toplevel
+        return await asyncio.to_thread(self.execute, command, arguments)
+
+    def close(self):
+        """ close the connection, and the socket made by listen """
+        if self._file:
+            self._file.close()
+            self._file = None
+        if self._sock:
+            # Wakes up a thread waiting for a reply
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._sock.close()
+            self._sock = None
+        if self._server:
+            self._server.close()
+            self._server = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
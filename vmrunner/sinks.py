@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+""" destinations for VM output: the terminal, files, memory, a ring of recent lines or nowhere """
+
+# pylint: disable=invalid-name
+
+import os
+import sys
+import atexit
+import threading
+import weakref
+import collections
+
+from . import deadlines
+from .prettify import color
+
+# Buffered sinks write when this many bytes are pending, and at least this often
+BUFFER_SIZE = 64 * 1024
+FLUSH_INTERVAL = 0.1
+
+# Default bounds of ring_sink
+RING_LINES = 200
+RING_CHARS = 64 * 1024
+
+# Set VMRUNNER_COLOR=1 to color the terminal output of VMs by default
+COLOR = os.environ.get("VMRUNNER_COLOR", "") not in ("", "0")
+
+
+class sink:
+    """ Where lines of VM output go. Lines are passed without a trailing newline """
+
+    def write(self, line): # pylint: disable=unused-argument
+        """ take a line of output """
+        raise Exception("Abstract class method called. Use a subclass") # pylint: disable=broad-exception-raised
+
+    def flush(self):
+        """ make sure lines written so far have reached their destination """
+
+    def close(self):
+        """ flush, and release what the sink holds on to """
+        self.flush()
+
+
+class null_sink(sink):
+    """ Discards output, for headless runs """
+
+    def write(self, line):
+        pass
+
+
+class memory_sink(sink):
+    """ Keeps output in lines """
+
+    def __init__(self):
+        self.lines = []
+
+    def write(self, line):
+        self.lines.append(line)
+
+
+class ring_sink(sink):
+    """ Keeps the last max_lines lines of output, and no more than max_chars characters of
+    them, so memory use stays bounded however long a VM runs. A longer line is cut to its
+    last max_chars characters """
+
+    def __init__(self, max_lines = RING_LINES, max_chars = RING_CHARS):
+        self.max_lines = max_lines
+        self.max_chars = max_chars
+        self._lines = collections.deque()
+        self._size = 0
+
+    def write(self, line):
+        if len(line) > self.max_chars:
+            line = line[-self.max_chars:]
+        self._lines.append(line)
+        self._size += len(line)
+        while len(self._lines) > self.max_lines or self._size > self.max_chars:
+            self._size -= len(self._lines.popleft())
+
+    def lines(self):
+        """ the lines kept, oldest first """
+        return list(self._lines)
+
+
+class _flusher:
+    """ Flushes buffered sinks every FLUSH_INTERVAL seconds, from the deadline scheduler's
+    thread, and at exit """
+
+    def __init__(self):
+        self._sinks = weakref.WeakSet()
+        self._lock = threading.Lock()
+        self._started = False
+
+    def add(self, sink_):
+        """ flush sink_ periodically from now on """
+        with self._lock:
+            self._sinks.add(sink_)
+            if not self._started:
+                self._started = True
+                deadlines.after(FLUSH_INTERVAL, self._tick)
+                atexit.register(self.flush_all)
+
+    def _tick(self):
+        self.flush_all()
+        deadlines.after(FLUSH_INTERVAL, self._tick)
+
+    def flush_all(self):
+        """ flush every buffered sink """
+        with self._lock:
+            sinks = list(self._sinks)
+        for sink_ in sinks:
+            try:
+                sink_.flush()
+            except (OSError, ValueError):
+                pass # E.g. a stream closed at exit
+
+flusher = _flusher()
+
+
+def flush_all():
+    """ write out what buffered sinks are holding back, e.g. before printing other output """
+    flusher.flush_all()
+
+
+class stream_sink(sink):
+    """ Writes output to a text stream in batches.
+
+    Lines are joined and written when BUFFER_SIZE bytes are pending, and otherwise within
+    FLUSH_INTERVAL seconds by a background thread shared by all stream sinks, so a chatty
+    guest costs one write per batch instead of one per line. prefix is put in front of
+    every line. The stream isn't closed by close unless owned is set """
+
+    def __init__(self, stream, prefix = "", buffer_size = BUFFER_SIZE, owned = False):
+        self._stream = stream
+        self._prefix = prefix
+        self._buffer_size = buffer_size
+        self._owned = owned
+        self._pending = []
+        self._pending_size = 0
+        self._lock = threading.Lock()
+        flusher.add(self)
+
+    def write(self, line):
+        with self._lock:
+            self._pending.append(line)
+            self._pending_size += len(line) + len(self._prefix) + 1
+            if self._pending_size >= self._buffer_size:
+                self._write()
+
+    def _write(self):
+        """ write pending lines, with the lock held """
+        if not self._pending:
+            return
+        prefix = "\n" + self._prefix
+        self._stream.write(self._prefix + prefix.join(self._pending) + "\n")
+        self._pending.clear()
+        self._pending_size = 0
+
+    def flush(self):
+        with self._lock:
+            self._write()
+            self._stream.flush()
+
+    def close(self):
+        self.flush()
+        if self._owned:
+            self._stream.close()
+
+
+class terminal_sink(stream_sink):
+    """ Writes output to standard output. Lines are prefixed by color.VM, "<vm> " in green
+    unless color.VM_PREPEND was changed, or with prefix if it's given. prefix is colored if
+    colored is set, or by default if VMRUNNER_COLOR is set """
+
+    def __init__(self, prefix = None, colored = None, buffer_size = BUFFER_SIZE):
+        self._vm_prefix = prefix is None
+        if colored is None:
+            colored = COLOR
+        if colored and prefix:
+            prefix = color.C_GREEN + prefix + color.C_ENDC
+        super().__init__(sys.stdout, prefix or "", buffer_size)
+
+    def write(self, line):
+        super().write(color.VM(line) if self._vm_prefix else line)
+
+
+class file_sink(stream_sink):
+    """ Writes output to a file, replacing it unless append is set """
+
+    def __init__(self, path, append = False, buffer_size = BUFFER_SIZE):
+        # pylint: disable-next=consider-using-with
+        stream = open(path, "a" if append else "w", encoding = "utf-8", errors = "replace")
+        super().__init__(stream, "", buffer_size, owned = True)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+""" saved VM states for fast boots, keyed by everything that went into booting the VM """
+
+# pylint: disable=invalid-name
+
+import os
+import json
+import time
+import shlex
+import shutil
+
+from . import cache
+
+# Subdirectory of the cache directory holding saved states
+SNAPSHOT_CACHE_DIR = "snapshots"
+
+# Bump to invalidate states saved by earlier versions
+SNAPSHOT_VERSION = 2
+
+# States are evicted, least recently used first, when the cache grows beyond this.
+# Override with VMRUNNER_SNAPSHOT_CACHE_MB
+DEFAULT_MAX_MB = 2048
+
+STATE_SUFFIX = ".state"
+
+# Overlays saved with a state are named after it, <state>.<n> + OVERLAY_SUFFIX
+OVERLAY_SUFFIX = ".qcow2"
+
+# How long saving a state may take
+SAVE_TIMEOUT = 60
+
+
+def cache_path():
+    """ directory holding saved states, None if on-disk caching is disabled """
+    return cache.cache_dir(SNAPSHOT_CACHE_DIR)
+
+
+def state_key(command, marker, files = (), drives = ()):
+    """ key for the state of a VM booted with command until marker was seen. files are
+    hashed by content, drives, which may be large, by size and modification time """
+    import hashlib # pylint: disable=import-outside-toplevel
+    inputs = {"version" : SNAPSHOT_VERSION,
+              "command" : command,
+              "marker" : marker,
+              "files" : [[path, cache.file_hash(path)] for path in files],
+              "drives" : []}
+    for path in drives:
+        stat = os.stat(path)
+        inputs["drives"].append([os.path.abspath(path), stat.st_size, stat.st_mtime_ns])
+    return hashlib.sha256(json.dumps(inputs).encode()).hexdigest()
+
+
+def lookup(key):
+    """ path of the saved state for key, None if there is none. Marks it as recently used """
+    directory = cache_path()
+    if directory is None:
+        return None
+    path = os.path.join(directory, key + STATE_SUFFIX)
+    return path if cache.touch(path) else None
+
+
+def path_for(key):
+    """ where the state for key is saved, None if on-disk caching is disabled """
+    directory = cache_path()
+    return None if directory is None else os.path.join(directory, key + STATE_SUFFIX)
+
+
+def overlay_path(path, index):
+    """ where the index'th overlay of the state saved in path is kept """
+    return f"{path}.{index}{OVERLAY_SUFFIX}"
+
+
+def saved_overlays(path):
+    """ paths of the overlays saved with the state in path """
+    return [entry.path for entry in os.scandir(os.path.dirname(path) or ".")
+            if entry.path.startswith(path + ".") and entry.name.endswith(OVERLAY_SUFFIX)]
+
+
+def discard(path):
+    """ remove a saved state and its overlays, e.g. one qemu failed to load """
+    for file in [path] + saved_overlays(path):
+        try:
+            os.unlink(file)
+        except OSError:
+            pass
+
+
+def restore_overlays(path, overlays):
+    """ replace the fresh overlays of a VM about to restore the state saved in path with the
+    ones saved with it. Returns False if they're missing, and the state can't be used """
+    saved = [overlay_path(path, index) for index in range(len(overlays))]
+    if not all(os.path.isfile(file) for file in saved):
+        return False
+    for file, overlay in zip(saved, overlays):
+        shutil.copyfile(file, overlay)
+    return True
+
+
+def incoming_args(path):
+    """ qemu arguments restoring a saved state """
+    return ["-incoming", "exec:cat " + shlex.quote(path)]
+
+
+def save(client, path, overlays = ()):
+    """ pause the VM behind a QMP client, write its state to path and resume it. The state
+    is written to a temporary file first, so a failed save leaves nothing behind. The files of
+    overlays are copied next to it while the VM is paused, as the state may refer to what the
+    guest wrote to them. They're published before the state, so a state found by lookup always
+    has its overlays """
+    tmp = f"{path}.{os.getpid()}.tmp"
+    client.execute("stop")
+    try:
+        client.execute("migrate", {"uri" : "exec:cat > " + shlex.quote(tmp)})
+
+        deadline = time.monotonic() + SAVE_TIMEOUT
+        delay = 0.001
+        while True:
+            status = client.execute("query-migrate")
+            state = status.get("status")
+            if state == "completed":
+                break
+            if state in ("failed", "cancelled"):
+                raise Exception("Saving VM state failed: " + status.get("error-desc", state)) # pylint: disable=broad-exception-raised
+            if time.monotonic() > deadline:
+                client.execute("migrate_cancel")
+                raise Exception(f"Saving VM state took more than {SAVE_TIMEOUT} seconds") # pylint: disable=broad-exception-raised
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+
+        # qemu flushed the overlays when the migration completed
+        for index, overlay in enumerate(overlays):
+            shutil.copyfile(overlay, overlay_path(tmp, index))
+        for index in range(len(overlays)):
+            os.replace(overlay_path(tmp, index), overlay_path(path, index))
+        os.replace(tmp, path)
+    except BaseException:
+        discard(tmp)
+        discard(path)
+        raise
+    finally:
+        client.execute("cont")
+
+    evict(path)
+    return path
+
+
+def evict(keep):
+    """ trim the saved states, with their overlays, to the size limit, except keep. Removes
+    overlays left without a state too """
+    directory = os.path.dirname(keep)
+    cache.evict(directory, STATE_SUFFIX,
+                cache.size_limit("VMRUNNER_SNAPSHOT_CACHE_MB", DEFAULT_MAX_MB), keep = keep,
+                companions = saved_overlays)
+    for entry in os.scandir(directory):
+        state = entry.path[:-len(OVERLAY_SUFFIX)].rsplit(".", 1)[0]
+        if entry.name.endswith(OVERLAY_SUFFIX) and not os.path.exists(state):
+            try:
+                # Skip overlays published just now, whose state may be about to follow
+                if time.time() - entry.stat().st_mtime < SAVE_TIMEOUT:
+                    continue
+                os.unlink(entry.path)
+            except OSError:
+                pass
@@ -6,16 +6,20 @@
 import json
 import sys
 import os
+import copy
 import glob
+import threading
 
 from builtins import str
-from jsonschema import Draft4Validator, validators
+
+from vmrunner import cache
 
 
 # Fetched from:
 # http://python-jsonschema.readthedocs.io/en/latest/faq/
 def extend_with_default(validator_class):
     """ make the validator fill in defaults from the schema """
+    from jsonschema import validators # pylint: disable=import-outside-toplevel
     validate_properties = validator_class.VALIDATORS["properties"]
 
     def set_defaults(validator_, properties, instance, schema):
@@ -32,41 +36,110 @@ def extend_with_default(validator_class):
     )
 
 vm_schema = None
+vm_schema_hash = None
 verbose = False
 
-validator = extend_with_default(Draft4Validator)
+# jsonschema takes a while to import, so the validator is created on first use
+validator = None
+
+def get_validator():
+    """ the schema validator class, which fills in defaults """
+    global validator # pylint: disable=global-statement
+    if validator is None:
+        from jsonschema import Draft4Validator # pylint: disable=import-outside-toplevel
+        validator = extend_with_default(Draft4Validator)
+    return validator
 
 package_path = os.path.dirname(os.path.realpath(__file__))
 default_schema = package_path + "/vm.schema.json"
 
+# Bump to invalidate configs cached on disk by earlier versions
+CONFIG_CACHE_VERSION = 1
+
+# Subdirectory of the cache directory holding validated configs
+CONFIG_CACHE_DIR = "configs"
+
+# Compiled validator for vm_schema, and validated configs by content hash
+_schema_validator = None
+_configs = {}
+_lock = threading.Lock()
+
+def content_hash(*parts):
+    """ hex digest of some bytes, used to key cached schemas and configs """
+    import hashlib # pylint: disable=import-outside-toplevel
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part)
+    return digest.hexdigest()
+
 def load_schema(filename = default_schema):
     """ load json schema from file """
-    global vm_schema # pylint: disable=global-statement
-    with open(filename, encoding="utf8") as f:
-        vm_schema = json.loads(f.read())
+    global vm_schema, vm_schema_hash, _schema_validator # pylint: disable=global-statement
+    with open(filename, "rb") as f:
+        data = f.read()
+    schema = json.loads(data.decode("utf8"))
+    with _lock:
+        # vm_schema is set last: callers checking it without the lock use vm_schema_hash
+        vm_schema_hash = content_hash(data)
+        _schema_validator = None
+        vm_schema = schema
+
+def schema_validator():
+    """ validator for vm_schema, compiled once and reused for every config """
+    global _schema_validator # pylint: disable=global-statement
+    if not vm_schema:
+        load_schema()
+    with _lock:
+        if _schema_validator is None:
+            _schema_validator = get_validator()(vm_schema)
+        return _schema_validator
+
+def clear_cache():
+    """ forget validated configs kept in memory. Configs cached on disk are keyed by the
+    content of both the config and the schema, so they never go stale """
+    with _lock:
+        _configs.clear()
 
 def validate_vm_spec(filename):
-    """ validate vm spec against schema """
-    vm_spec = None
+    """ validate vm spec against schema. Returns the spec with defaults filled in.
+    Specs that passed validation before are returned from the cache """
+    if not vm_schema:
+        load_schema()
 
     # Load and parse as JSON
     try:
-        with open(filename, encoding="utf8") as f:
-            vm_spec = json.loads(f.read())
+        with open(filename, "rb") as f:
+            data = f.read()
     except Exception as e:
         raise Exception("JSON load / parse Error for " + filename + ": " + str(e)) from e # pylint: disable=broad-exception-raised
 
-    if not vm_schema:
-        load_schema()
+    key = content_hash(str(CONFIG_CACHE_VERSION).encode(), vm_schema_hash.encode(), data)
+
+    with _lock:
+        vm_spec = _configs.get(key)
+    if vm_spec is None:
+        vm_spec = cache.load_json(key + ".json", CONFIG_CACHE_DIR)
+
+    if vm_spec is None:
+        try:
+            vm_spec = json.loads(data.decode("utf8"))
+        except Exception as e:
+            raise Exception("JSON load / parse Error for " + filename + ": " + str(e)) from e # pylint: disable=broad-exception-raised
+
+        # Validate JSON according to schema
+        schema_validator().validate(vm_spec)
+        cache.store_json(key + ".json", vm_spec, CONFIG_CACHE_DIR)
 
-    # Validate JSON according to schema
-    validator(vm_schema).validate(vm_spec)
+    with _lock:
+        _configs[key] = vm_spec
 
-    return vm_spec
+    # Callers are free to modify the config they get
+    return copy.deepcopy(vm_spec)
 
 
-def load_config(path_, verbose_ = verbose):
-    """ load VM config from file """
+def load_config(path_, verbose_ = verbose, first = False):
+    """ load VM config from file. For a directory, returns the valid configs in it,
+    or only the first valid one if first is set """
     # Single JSON-file  must conform to VM-schema
     if os.path.isfile(path_):
         return validate_vm_spec(path_)
@@ -87,6 +160,8 @@ def load_config(path_, verbose_ = verbose):
             valid_vms.append(spec)
             if verbose_:
                 print("OK")
+            if first:
+                break
         except Exception as e: # pylint: disable=broad-exception-caught
             if verbose_:
                 print("FAIL " + str(e))
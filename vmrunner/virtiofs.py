@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+""" virtiofsd daemons serving shared directories to VMs """
+
+# pylint: disable=invalid-name
+
+import os
+import time
+import atexit
+import tempfile
+import threading
+import subprocess
+
+from .prettify import color
+
+# How long virtiofsd may take to create its socket
+START_TIMEOUT = 10
+
+
+class daemon:
+    """ A virtiofsd process sharing a directory through a socket in a directory of its own """
+
+    def __init__(self, shared):
+        self.shared = shared
+        self._tmp_dir = tempfile.TemporaryDirectory(prefix = "virtiofs-") # pylint: disable=consider-using-with
+        self.socket = os.path.join(self._tmp_dir.name, "virtiofsd.sock")
+        args = ["virtiofsd", "--socket", self.socket, "--shared-dir", shared, "--sandbox", "none"]
+        self.proc = subprocess.Popen(args, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL) # pylint: disable=consider-using-with
+
+    def alive(self):
+        """ true while the process is running """
+        return self.proc.poll() is None
+
+    def wait_ready(self, timeout = START_TIMEOUT):
+        """ wait for the socket to show up, checking less and less often. Raises if virtiofsd
+        exits or takes more than timeout seconds """
+        deadline = time.monotonic() + timeout
+        delay = 0.001
+        while not os.path.exists(self.socket):
+            if not self.alive():
+                raise Exception(f"VirtioFSD exited with status {self.proc.returncode} " # pylint: disable=broad-exception-raised
+                                f"before creating its socket, sharing {self.shared}")
+            if time.monotonic() > deadline:
+                self.stop()
+                raise Exception(f"VirtioFSD didn't create its socket within {timeout} seconds") # pylint: disable=broad-exception-raised
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+        return self
+
+    def stop(self):
+        """ terminate the process and remove its socket """
+        if self.alive():
+            self.proc.terminate()
+        try:
+            self.proc.wait(timeout = 1)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+        self._tmp_dir.cleanup()
+
+
+# Idle daemons kept for reuse, by the real path of their shared directory
+_idle = {}
+_idle_lock = threading.Lock()
+_atexit_registered = False
+
+
+def acquire(shared, reuse = False):
+    """ a ready daemon sharing shared, for one VM at a time. With reuse set, the standby
+    daemon started for shared by release is used if there is one """
+    if reuse:
+        with _idle_lock:
+            daemon_ = _idle.pop(os.path.realpath(shared), None)
+        if daemon_ and daemon_.alive():
+            return daemon_.wait_ready()
+        if daemon_:
+            daemon_.stop()
+    return daemon(shared).wait_ready()
+
+
+def release(daemon_, reuse = False):
+    """ done with daemon_ once its VM has exited, it's stopped. virtiofsd serves one VM
+    connection and exits or is about to once it's gone, so with reuse set a fresh daemon is
+    started in its place, ready for the next acquire of its directory """
+    global _atexit_registered # pylint: disable=global-statement
+    daemon_.stop()
+    if not reuse:
+        return
+
+    try:
+        standby = daemon(daemon_.shared)
+    except OSError as e:
+        print(color.WARNING(f"Couldn't restart VirtioFSD: {e}"))
+        return
+
+    with _idle_lock:
+        replaced = _idle.pop(os.path.realpath(standby.shared), None)
+        _idle[os.path.realpath(standby.shared)] = standby
+        if not _atexit_registered:
+            _atexit_registered = True
+            atexit.register(stop_idle)
+    if replaced:
+        replaced.stop()
+
+
+def stop_idle():
+    """ stop the daemons kept for reuse """
+    with _idle_lock:
+        daemons = list(_idle.values())
+        _idle.clear()
+    for daemon_ in daemons:
+        daemon_.stop()
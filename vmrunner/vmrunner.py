@@ -3,7 +3,7 @@
 """ vmrunner is hypervisor-agnostic tool and library for running
     and testing IncludeOS unikernels """
 
-# pylint: disable=line-too-long, too-many-lines, invalid-name, fixme, broad-exception-raised, broad-exception-caught, too-many-arguments, too-many-branches, too-many-statements, too-many-instance-attributes, too-many-locals
+# pylint: disable=line-too-long, too-many-lines, invalid-name, fixme, broad-exception-raised, broad-exception-caught, too-many-arguments, too-many-branches, too-many-statements, too-many-instance-attributes, too-many-locals, too-many-public-methods
 
 from builtins import hex
 from builtins import chr
@@ -14,56 +14,94 @@ import sys
 import subprocess
 import threading
 import re
-import traceback
 import signal
-import tempfile
+import functools
+import copy
 from enum import Enum
-import grp
-import platform
-import psutil
 
 from vmrunner import validate_vm
+from . import elf
+from . import host
 from .prettify import color
+from .console import control_stripper, output_reader, READ_UNTIL_LIMIT
+from .matcher import output_matcher, is_literal
+from . import deadlines
+from .metrics import boot_metrics
+from .sinks import terminal_sink, memory_sink, ring_sink, flush_all, RING_LINES, RING_CHARS
 
 package_path = os.path.dirname(os.path.realpath(__file__))
 
-# Use INCLUDEOS_VMRUNNER from environment if set, otherwise get from package metadata
-INCLUDEOS_VMRUNNER = os.environ.get('INCLUDEOS_VMRUNNER', None)
-if INCLUDEOS_VMRUNNER is None:
-    from importlib.metadata import files
-    for p_ in files('vmrunner'):
-        if '__init__.py' in str(p_):
-            INCLUDEOS_VMRUNNER=os.path.dirname(os.path.realpath(p_.locate()))
+# Importing vmrunner has no side effects. Paths are resolved on first use, and the default
+# vm is created and signal handlers installed by init(). The module attributes
+# INCLUDEOS_VMRUNNER, default_config, chainloader and vms are provided by __getattr__.
 
-assert INCLUDEOS_VMRUNNER is not None
+@functools.cache
+def vmrunner_path():
+    """ Use INCLUDEOS_VMRUNNER from environment if set, otherwise get from package metadata """
+    path = os.environ.get('INCLUDEOS_VMRUNNER', None)
+    if path is None:
+        from importlib.metadata import files, PackageNotFoundError # pylint: disable=import-outside-toplevel
+        try:
+            for p_ in files('vmrunner') or []:
+                if '__init__.py' in str(p_):
+                    path = os.path.dirname(os.path.realpath(p_.locate()))
+        except PackageNotFoundError:
+            # Not installed, e.g. running from a source tree
+            path = package_path
+
+    assert path is not None
+    return path
 
-default_config = INCLUDEOS_VMRUNNER  + "/vm.userspace.json"
+def default_config_path():
+    """ the default config, which user configs are merged into """
+    return vmrunner_path() + "/vm.userspace.json"
 
 default_json = "./vm.json"
 
-# Use INCLUDEOS_CHAINLOADER from environment if set, otherwise look for nix propagatedBuildInputs
-chainloader = os.environ.get('INCLUDEOS_CHAINLOADER', None)
-if chainloader is None:
-    propagatedBuildInputs = os.environ.get('propagatedBuildInputs', None)
-    if propagatedBuildInputs is not None:
-        for c_path in propagatedBuildInputs.split(' '):
-            chainloader_candidate = c_path + "/bin/chainloader"
-            if os.path.isfile(chainloader_candidate):
-                chainloader = c_path + "/bin"
-                break
+@functools.cache
+def find_chainloader():
+    """ Use INCLUDEOS_CHAINLOADER from environment if set, otherwise look for nix propagatedBuildInputs """
+    chainloader = os.environ.get('INCLUDEOS_CHAINLOADER', None)
+    if chainloader is None:
+        propagatedBuildInputs = os.environ.get('propagatedBuildInputs', None)
+        if propagatedBuildInputs is not None:
+            for c_path in propagatedBuildInputs.split(' '):
+                chainloader_candidate = c_path + "/bin/chainloader"
+                if os.path.isfile(chainloader_candidate):
+                    chainloader = c_path + "/bin"
+                    break
 
-if chainloader is not None:
-    chainloader = chainloader + "/chainloader"
+    if chainloader is not None:
+        chainloader = chainloader + "/chainloader"
+
+    return chainloader
 
 # Provide a list of VM's with validated specs
-# (One default vm added at the end)
-vms = []
+# (One default vm is added by init(), at index 0)
+_vms = []
+_vms_lock = threading.RLock()
+_default_vm = None
+_handlers_installed = False
+_signal_callbacks = [] # Called on SIGINT / SIGTERM, before the vms are stopped
+
+def __getattr__(name):
+    """ resolve module attributes lazily """
+    if name == "INCLUDEOS_VMRUNNER":
+        return vmrunner_path()
+    if name == "default_config":
+        return default_config_path()
+    if name == "chainloader":
+        return find_chainloader()
+    if name == "vms":
+        return init()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 panic_signature = re.escape(r"\x15\x07\t**** PANIC ****")
 
 # TODO: Consider adding hidden control characters here
 #       to make it even less likely that this will appear in the wild
 includeos_signature = "#include<os> // Literally"
+bios_signature = "SeaBIOS (version"
 
 nametag = "<VMRunner>"
 INFO = color.INFO(nametag)
@@ -97,37 +135,26 @@ def info(*args):
     """ verbose printing function with multiple args """
     default_logger.info(args)
 
-# Example on Ubuntu:
-# ELF 32-bit LSB executable, Intel 80386, version 1 (SYSV), statically linked, not stripped
-# ELF 64-bit LSB executable, x86-64, version 1 (SYSV), statically linked, not stripped
-#
-# Example on mac (same files):
-# ELF 32-bit LSB executable, Intel 80386, version 1 (SYSV), statically linked, not stripped, with debug_info
-# ELF 64-bit LSB executable, x86-64, version 1 (SYSV), statically linked, not stripped, with debug_info
-#
-# Mac native:
-# Mach-O 64-bit x86_64 executable, flags:<NOUNDEFS|DYLDLINK|TWOLEVEL|WEAK_DEFINES|BINDS_TO_WEAK|PIE>
-
 def file_type(filename):
-    """ calls the 'file' tool to determine file type """
-    with subprocess.Popen(['file',filename],stdout=subprocess.PIPE,stderr=subprocess.STDOUT) as p:
-        output, _ = p.communicate()
-        return output.decode("utf-8")
+    """ describes the file type, like the 'file' tool does for ELF files """
+    return elf.describe(filename)
 
 def is_Elf64(filename):
     """ returns true if the file is an elf64 executable """
-    magic = file_type(filename)
-    return "ELF" in magic and "executable" in magic and "64-bit" in magic
+    return elf.is_executable(filename, 64)
 
 def is_Elf32(filename):
     """ returns true if the file is an elf32 executable """
-    magic = file_type(filename)
-    return "ELF" in magic and "executable" in magic and "32-bit" in magic
+    return elf.is_executable(filename, 32)
 
 
 # The end-of-transmission character
 EOT = chr(4)
 
+# How long to wait for qemu to connect to its QMP socket, and to exit when asked to quit
+QMP_CONNECT_TIMEOUT = 5
+QUIT_TIMEOUT = 5
+
 # Exit codes used by this program
 exit_codes = {"SUCCESS" : 0,
               "PROGRAM_FAILURE" : 1,
@@ -148,8 +175,16 @@ def get_exit_code_name (exit_code):
             return name
     return "UNKNOWN ERROR"
 
+def message(*args):
+    """ print one of vmrunner's own messages, after any VM output the sinks are still holding
+        back, so that the two are printed in order """
+    flush_all()
+    print(*args)
+
 def print_exception():
     """ We want to catch the exceptions from callbacks, but still tell the test writer what went wrong """
+    import traceback # pylint: disable=import-outside-toplevel
+    flush_all()
     exc_type, exc_value, exc_traceback = sys.exc_info()
     traceback.print_exception(exc_type, exc_value, exc_traceback,
                               limit=10, file=sys.stdout)
@@ -184,12 +219,27 @@ class hypervisor:
         self._enable_kvm = False # must be explicitly turned on at boot.
         self._sudo = False       # Set to true if sudo is available
         self._proc = None        # A running subprocess
+        self._reader = None      # Background reader for the subprocess output
         self._tmp_dirs = []      # A list of tmp dirs created using tempfile module. Used for socket creation for automatic cleanup and garbage collection
 
     # pylint: disable-next=unused-argument
+    def boot_command(self, multiboot=False, debug=False, kernel_args="", image_name="", allow_sudo = False, enable_kvm = False):
+        """ Prepare to boot a VM, returning the hypervisor command line """
+        abstract()
+
     def boot_in_hypervisor(self, multiboot=False, debug=False, kernel_args="", image_name="", allow_sudo = False, enable_kvm = False):
         """ Boot a VM, returning a hypervisor handle for reuse """
-        abstract()
+        # pylint: disable-next=assignment-from-no-return
+        command = self.boot_command(multiboot, debug, kernel_args, image_name, allow_sudo, enable_kvm)
+
+        try:
+            self.start_process(command)
+            info("Started process PID ",self._proc.pid)
+        except Exception as e:
+            print(color.WARNING(f"Starting subprocess threw exception: {e}"))
+            raise e
+
+        return self
 
     def stop(self):
         """ Stop the VM booted by boot """
@@ -199,6 +249,17 @@ class hypervisor:
         """ Read a line of output from vm """
         abstract()
 
+    def decode_line(self, data):
+        """ Turn a line of raw output into a string """
+        return data.decode("utf-8", errors="replace")
+
+    def read_until_EOT(self, limit = READ_UNTIL_LIMIT):
+        """ read output from hypervisor until EOT character found, keeping at most limit bytes """
+        data, skipped = self._reader.read_until(EOT.encode(), limit)
+        if skipped:
+            message(color.WARNING(f"Output before EOT exceeded {limit} bytes, {skipped} bytes dropped"))
+        return data.decode("utf-8", errors="replace")
+
     # pylint: disable-next=unused-argument
     def available(self, config_data = None):
         """ Verify that the hypervisor is available """
@@ -220,8 +281,8 @@ class hypervisor:
         """ Name of image """
         abstract()
 
-    def start_process(self, cmdlist):
-        """ Start hypervisor process """
+    def check_sudo(self, cmdlist):
+        """ Verify that a hypervisor command only uses sudo if allowed """
 
         if cmdlist[0] == "sudo": # and have_sudo():
 
@@ -231,6 +292,10 @@ class hypervisor:
             print(color.WARNING("Running with sudo"))
             self._sudo = True
 
+    def start_process(self, cmdlist):
+        """ Start hypervisor process """
+
+        self.check_sudo(cmdlist)
 
         # Start a subprocess
         # pylint: disable-next=consider-using-with
@@ -239,12 +304,44 @@ class hypervisor:
                                       stderr = subprocess.STDOUT,
                                       stdin = subprocess.PIPE)
 
+        # Output is drained in the background and handed over line by line
+        self._reader = output_reader(self._proc.stdout).start()
+
         return self._proc
 
     def has_process(self):
         """ Returns true if a hypervisor process has been started (but it may have crashed/exited) """
         return self._proc is not None
 
+    def has_qmp(self):
+        """ Returns true if the VM can be controlled through QMP, see qemu.qmp_args """
+        return False
+
+    def close_virtiofs(self):
+        """ Stop or release any virtiofsd serving the VM, see qemu.init_virtiofs """
+
+    def first_output(self):
+        """ Monotonic time the first output was read, None if there has been none """
+        return self._reader.first_read if self._reader else None
+
+    def set_snapshot(self, marker):
+        """ restore the VM state saved when marker was seen on an earlier boot, or save it
+        when marker is seen on this one. Hypervisors without saved states boot normally """
+        if marker:
+            print(color.WARNING(f"{self.name()} can't save VM states, booting normally"))
+
+    def snapshot_marker(self):
+        """ the output marker to save the VM state at, None if no state is to be saved """
+        return None
+
+    def save_snapshot(self):
+        """ save the VM state, for later boots to restore """
+
+    def discard_snapshot(self):
+        """ discard the VM state this boot was restored from, e.g. when restoring failed.
+        Returns True if there was one """
+        return False
+
 Solo5Tender = Enum('Solo5Type', ['hvt', 'spt'])
 
 class solo5(hypervisor):
@@ -287,12 +384,8 @@ class solo5(hypervisor):
         """ returns net argument for solo5 """
         return ["--net=tap100"]
 
-    def get_final_output(self):
-        """ gets final output from hypervisor process """
-        return self._proc.communicate()
-
-    def boot_in_hypervisor(self, multiboot = False, debug = False, kernel_args = "", image_name = "", allow_sudo = False, enable_kvm = False):
-        """ start hypervisor with the selected configuration (boot the VM) """
+    def boot_command(self, multiboot = False, debug = False, kernel_args = "", image_name = "", allow_sudo = False, enable_kvm = False):
+        """ hypervisor command line for the selected configuration """
 
         self._allow_sudo = allow_sudo
         self._enable_kvm = enable_kvm
@@ -323,12 +416,8 @@ class solo5(hypervisor):
         command += [self._image_name]
         command += [kernel_args]
 
-        try:
-            self.info("Starting ", command)
-            self.start_process(command)
-            self.info("Started process PID ",self._proc.pid)
-        except Exception as e:
-            raise e
+        self.info("Starting ", command)
+        return command
 
     def stop(self):
 
@@ -348,6 +437,7 @@ class solo5(hypervisor):
                 self._proc.terminate()
             else:
                 # Find and terminate all child processes, since parent is "sudo"
+                import psutil # pylint: disable=import-outside-toplevel
                 parent = psutil.Process(self._proc.pid)
                 children = parent.children()
 
@@ -371,24 +461,9 @@ class solo5(hypervisor):
             self._proc.wait()
         return self
 
-    def read_until_EOT(self):
-        """ read from stdout until EOT """
-        chars = ""
-
-        while not self._proc.poll():
-            char = self._proc.stdout.read(1)
-            if char == chr(4):
-                return chars
-            chars += char
-
-        return chars
-
-
     def readline(self):
-        """ read from stdout """
-        if self._proc.poll():
-            raise Exception("Process completed")
-        return self._proc.stdout.readline().decode("utf-8", errors="replace")
+        """ read from stdout, returns an empty string when all output has been read """
+        return self.decode_line(self._reader.readline())
 
 
     def writeline(self, line):
@@ -417,7 +492,7 @@ class qemu(hypervisor):
     def __init__(self, config):
         super().__init__(config)
         self._proc = None
-        self._virtiofsd_proc = None
+        self._virtiofsd = None # A virtiofs.daemon
         self._stopped = False
         self._sudo = False
         self._image_name = self._config if "image" in self._config else self.name() + " vm"
@@ -426,10 +501,25 @@ class qemu(hypervisor):
         self._kvm_present = False # Set when KVM detected
 
         # TODO: Consider regex expecting a version number here
-        self._bios_signature = "SeaBIOS (version"
+        self._bios_signature = bios_signature
         self._past_bios = False
         self._reboots = 0
 
+        # Saved VM states, see set_snapshot
+        self._snapshot_at = None       # Output marker the state is saved at
+        self._snapshot_path = None     # The state to save, or the one restored
+        self._snapshot_restored = False
+
+        # QMP control channel, see qmp_args
+        self._qmp = None
+        self._start_paused = False # Set by start_paused
+        self._kernel_files = [] # Files the VM is booted from, see input_files
+        self._drives = config.get("drives", []) # The last boot's, with any disk image booted
+        self._overlays = [] # Overlay files of the last boot, saved with VM states
+
+        # State for filtering all control characters from output
+        self._stripper = control_stripper()
+
         # Pretty printing
         self.info = Logger(color.INFO("<" + type(self).__name__ + ">"))
 
@@ -462,6 +552,35 @@ class qemu(hypervisor):
                         + ",if=none" + ",media=" + media_type + ",id=" + driveno,
                 "-device",  device + ",drive=" + driveno +",serial=foo"]
 
+    def qemu_img(self):
+        """ qemu-img binary, preferably the one next to a custom qemu binary """
+        if "qemu" in self._config:
+            sibling = os.path.join(os.path.dirname(self._config["qemu"]), "qemu-img")
+            if os.access(sibling, os.X_OK):
+                return sibling
+        return "qemu-img"
+
+    def create_overlay(self, filename, drive_format):
+        """ creates a throwaway qcow2 overlay backed by filename, which then never sees the
+        guest's writes. The overlay lives in a tmp dir removed with the hypervisor """
+        import tempfile # pylint: disable=import-outside-toplevel
+        tmp_overlay_dir = tempfile.TemporaryDirectory(prefix="overlay-") # pylint: disable=consider-using-with
+        self._tmp_dirs.append(tmp_overlay_dir)
+
+        backing = os.path.abspath(filename)
+        overlay = os.path.join(tmp_overlay_dir.name, os.path.basename(backing) + ".qcow2")
+        command = [self.qemu_img(), "create", "-q", "-f", "qcow2", "-b", backing, "-F", drive_format, overlay]
+        info("Creating overlay:", " ".join(command))
+
+        try:
+            subprocess.run(command, check = True, capture_output = True, text = True)
+        except subprocess.CalledProcessError as e:
+            raise Exception(f"Creating an overlay for {filename} failed: {e.stderr.strip()}") from e
+        except OSError as e:
+            raise Exception(f"Creating an overlay for {filename} failed: {e}") from e
+
+        return overlay
+
     # -initrd "file1 arg=foo,file2"
     # This syntax is only available with multiboot.
 
@@ -477,8 +596,8 @@ class qemu(hypervisor):
             qemu_ifup = scripts + "qemu-ifup"
             qemu_ifdown = scripts + "qemu-ifdown"
         else:
-            qemu_ifup = INCLUDEOS_VMRUNNER + "/bin/qemu-ifup"
-            qemu_ifdown = INCLUDEOS_VMRUNNER + "/bin/qemu-ifdown"
+            qemu_ifup = vmrunner_path() + "/bin/qemu-ifup"
+            qemu_ifdown = vmrunner_path() + "/bin/qemu-ifdown"
 
         # FIXME: this needs to get removed, e.g. fetched from the schema
         names = {"virtio" : "virtio-net", "vmxnet" : "vmxnet3", "vmxnet3" : "vmxnet3"}
@@ -524,21 +643,18 @@ class qemu(hypervisor):
 
         return qemu_args
 
-    def init_virtiofs(self, socket, shared, mem):
-        """ initializes virtiofs by launching virtiofsd and creating a virtiofs device """
+    def init_virtiofs(self, shared, mem, reuse = False):
+        """ initializes virtiofs by launching virtiofsd, or using one started ahead of time
+            for shared if reuse is set, and creating a virtiofs device """
         if not os.path.exists(shared):
             raise Exception("Shared directory for VirtioFS does not exist")
 
-        virtiofsd_args = ["virtiofsd", "--socket", socket, "--shared-dir", shared, "--sandbox", "none"]
-        self._virtiofsd_proc = subprocess.Popen(virtiofsd_args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) # pylint: disable=consider-using-with
-
-        if self._virtiofsd_proc.poll():
-            raise Exception("VirtioFSD failed to start")
-
-        info("Successfully started VirtioFSD!")
+        from . import virtiofs # pylint: disable=import-outside-toplevel
+        self.close_virtiofs()
+        self._virtiofsd = virtiofs.acquire(shared, reuse)
+        socket = self._virtiofsd.socket
 
-        while not os.path.exists(socket):
-            info("Waiting for VirtioFSD socket to show up")
+        info("VirtioFSD is ready, PID", self._virtiofsd.proc.pid)
 
         qemu_args = ["-machine", "memory-backend=mem0"]
         qemu_args += ["-chardev", f"socket,id=virtiofsd0,path={socket}"]
@@ -561,44 +677,40 @@ class qemu(hypervisor):
             return False
 
 
+        # The host is only probed once per process, see host.py
+        caps = host.probe()
+
         if not self._allow_sudo:
-            if "kvm" in (g.gr_name for g in grp.getgrall()):
-                _in_kvm_group = grp.getgrnam("kvm").gr_gid in os.getgroups()
-                if not _in_kvm_group:
+            if caps.kvm_group:
+                if not caps.in_kvm_group:
                     raise Exception("KVM was requested, but user is not in the 'kvm' group")
             else:
                 raise Exception("KVM is enabled, which requires sudo, but sudo is not enabled")
 
-        command = "egrep -m 1 '^flags.*(vmx|svm)' /proc/cpuinfo"
-        try:
-            subprocess.check_output(command, shell = True)
+        if caps.kvm_capable():
             self.info("KVM ON")
             return True
 
-        except Exception:
-            self.info("KVM OFF")
-            return False
+        self.info("KVM OFF")
+        return False
 
     # Check if we should use the hvf accel (MacOS only)
     def hvf_present(self):
         """ returns true if Hypervisor.framework is available (Darwin/mac only) """
-        return platform.system() == "Darwin"
+        return host.probe().hvf
 
     # Start a process and preserve in- and output pipes
     # Note: if the command failed, we can't know until we have exit status,
     # but we can't wait since we expect no exit. Checking for program start error
     # is therefore deferred to the callee
 
-    def get_final_output(self):
-        """ get final output from hypervisor process """
-        return self._proc.communicate()
-
-    def boot_in_hypervisor(self, multiboot=True, debug = False, kernel_args = "", image_name = None, allow_sudo = False, enable_kvm = False):
-        """" boot VM in hypervisor """
+    def boot_command(self, multiboot=True, debug = False, kernel_args = "", image_name = None, allow_sudo = False, enable_kvm = False):
+        """ hypervisor command line for booting the VM """
 
         self._allow_sudo = allow_sudo
         self._enable_kvm = enable_kvm
         self._stopped = False
+        self._stripper.reset()
 
         info ("Booting with multiboot:", multiboot, "kernel_args: ", kernel_args, "image_name:", image_name,
               "allow_sudo:", allow_sudo)
@@ -615,6 +727,8 @@ class qemu(hypervisor):
         self._image_name = image_name
 
         disk_args = []
+        drives = self._config.get("drives", [])
+        kernel_files = [] # Files the VM is booted from, see prepare_snapshot
 
         debug_args = []
         if debug:
@@ -630,19 +744,21 @@ class qemu(hypervisor):
             if not kernel_args:
                 kernel_args = "\"\""
 
-            info ("File magic: ", file_type(image_name))
+            kernel_files = [image_name]
+            info ("File magic: ", elf.describe(image_name))
 
             if is_Elf64(image_name):
+                chainloader = find_chainloader()
                 info ("Found 64-bit ELF, need chainloader" )
                 print("Looking for chainloader: ")
                 if chainloader is None or not os.path.isfile(chainloader):
-                    print("Error: couldn't find chainloader. Try -g for grub, or create an .img with vmbuild.")
-                    sys.exit(1)
+                    raise Exception("Couldn't find chainloader. Try -g for grub, or create an .img with vmbuild.")
 
-                print("Found", chainloader, "Type: ",  file_type(chainloader))
+                print("Found", chainloader, "Type: ",  elf.describe(chainloader))
                 if not is_Elf32(chainloader):
                     print(color.WARNING("Chainloader doesn't seem to be a 32-bit ELF executable"))
                 kernel_args = ["-kernel", chainloader, "-append", kernel_args, "-initrd", image_name + " " + kernel_args]
+                kernel_files.append(chainloader)
             elif is_Elf32(image_name):
                 info ("Found 32-bit elf, trying direct boot")
                 kernel_args = ["-kernel", image_name, "-append", kernel_args]
@@ -655,29 +771,35 @@ class qemu(hypervisor):
             kernel_args = []
             image_in_config = False
 
-            # If the provided image name is also defined in vm.json, use vm.json
-            if "drives" in self._config:
-                for disk in self._config["drives"]:
-                    if disk["file"] == image_name:
-                        image_in_config = True
-                if not image_in_config:
-                    info ("Provided image", image_name, "not found in config. Appending.")
-                    self._config["drives"].insert(0, {"file" : image_name, "type":"ide", "format":"raw", "media":"disk"})
-            else:
-                self._config["drives"] =[{"file" : image_name, "type":"ide", "format":"raw", "media":"disk"}]
+            # If the provided image name is also defined in vm.json, use vm.json. The config
+            # isn't changed, it may be shared, e.g. with VMs started ahead of time
+            drives = list(drives)
+            for disk in drives:
+                if disk["file"] == image_name:
+                    image_in_config = True
+            if not image_in_config:
+                info ("Provided image", image_name, "not found in config. Appending.")
+                drives.insert(0, {"file" : image_name, "type":"ide", "format":"raw", "media":"disk"})
 
             info ("Booting", image_name, "with a bootable disk image")
+        self._drives = drives
 
-        if "drives" in self._config:
-            for disk in self._config["drives"]:
-                disk_args += self.drive_arg(disk["file"], disk["type"], disk["format"], disk["media"])
+        self._overlays = []
+        for disk in drives:
+            drive_file, drive_format = disk["file"], disk["format"]
+            if "overlay" in disk and disk["overlay"]:
+                drive_file, drive_format = self.create_overlay(disk["file"], disk["format"]), "qcow2"
+                self._overlays.append(drive_file)
+            disk_args += self.drive_arg(drive_file, disk["type"], drive_format, disk["media"])
 
         mod_args = []
         if "modules" in self._config:
             mod_args += self.mod_args(self._config["modules"])
+            kernel_files += [mod["path"] for mod in self._config["modules"]]
 
         if "bios" in self._config:
             kernel_args.extend(["-bios", self._config["bios"]])
+            kernel_files.append(self._config["bios"])
 
         if "uuid" in self._config:
             kernel_args.extend(["--uuid", str(self._config["uuid"])])
@@ -724,13 +846,9 @@ class qemu(hypervisor):
 
         virtiofs_args = []
         if "virtiofs" in self._config:
-            tmp_virtiofs_dir = tempfile.TemporaryDirectory(prefix="virtiofs-") # pylint: disable=consider-using-with
-            self._tmp_dirs.append(tmp_virtiofs_dir)
-            socket_path = os.path.join(tmp_virtiofs_dir.name, "virtiofsd.sock")
-
-            shared = self._config["virtiofs"]["shared"]
-
-            virtiofs_args = self.init_virtiofs(socket_path, shared, self._config["mem"])
+            virtiofs = self._config["virtiofs"]
+            virtiofs_args = self.init_virtiofs(virtiofs["shared"], self._config["mem"],
+                                               virtiofs.get("reuse", False))
 
         virtiopmem_args = []
         if "virtiopmem" in self._config:
@@ -739,6 +857,13 @@ class qemu(hypervisor):
                 size = virtiopmem["size"]
                 virtiopmem_args += self.init_pmem(image, size, pmem_id)
 
+        # Saving VM states needs QMP too
+        qmp_args = []
+        if self._config.get("qmp") or self._snapshot_at or self._start_paused:
+            qmp_args = self.qmp_args()
+        else:
+            self.close_qmp()
+
         # custom qemu binary/location
         qemu_binary = "qemu-system-x86_64"
         if "qemu" in self._config:
@@ -769,20 +894,199 @@ class qemu(hypervisor):
         command += kernel_args
         command += disk_args + debug_args + net_args + mem_arg + mod_args
         command += vga_arg + trace_arg + pci_arg + virtiocon_args + virtiofs_args
-        command += virtiopmem_args
+        command += virtiopmem_args + qmp_args
+
+        if self._start_paused:
+            command.append("-S")
 
         #command_str = " ".join(command)
         #command_str.encode('ascii','ignore')
         #command = command_str.split(" ")
 
+        self._kernel_files = kernel_files
+        if self._snapshot_at:
+            command = self.prepare_snapshot(command, kernel_files)
+
         info("Command:", " ".join(command))
+        return command
+
+    def set_snapshot(self, marker):
+        self._snapshot_at = marker
+        self._snapshot_path = None
+        self._snapshot_restored = False
+
+    def snapshot_marker(self):
+        if self._snapshot_path and not self._snapshot_restored:
+            return self._snapshot_at
+        return None
 
+    def prepare_snapshot(self, command, kernel_files):
+        """ add arguments to command restoring the VM state saved for it, or letting it be
+        saved. The state is keyed by the command line, with temporary directories
+        normalized, the contents of kernel_files and the size and age of the drives. Overlays
+        are saved with the state, as it may refer to what the guest wrote to them """
+        if command[0] == "sudo":
+            print(color.WARNING("VM states can't be saved with sudo, booting normally"))
+            return command
+
+        import shutil # pylint: disable=import-outside-toplevel
+        from . import snapshot # pylint: disable=import-outside-toplevel
+
+        normalized = []
+        for arg in command:
+            for tmp_dir in self._tmp_dirs:
+                arg = arg.replace(tmp_dir.name, "<tmp>")
+            normalized.append(arg)
+
+        # Drives change without their paths changing, and so may the qemu binary
+        drives = self.drive_files()
+        binary = shutil.which(command[0])
+        if binary:
+            drives.append(binary)
+
+        key = snapshot.state_key(normalized, self._snapshot_at, kernel_files, drives)
+        path = snapshot.lookup(key)
+        if path and snapshot.restore_overlays(path, self._overlays):
+            info("Restoring VM state from", path)
+            self._snapshot_path = path
+            self._snapshot_restored = True
+            return command + snapshot.incoming_args(path)
+
+        self._snapshot_path = snapshot.path_for(key)
+        if not self._snapshot_path:
+            print(color.WARNING("VM states can't be saved with caching disabled, booting normally"))
+            return command
+
+        info("Saving VM state at", repr(self._snapshot_at), "to", self._snapshot_path)
+        return command
+
+    def save_snapshot(self):
+        if not self.snapshot_marker():
+            return
+        from . import snapshot # pylint: disable=import-outside-toplevel
+        path, self._snapshot_path = self._snapshot_path, None
         try:
-            self.start_process(command)
-            self.info("Started process PID ",self._proc.pid)
-        except Exception as e:
-            print(self.info,"Starting subprocess threw exception:", e)
-            raise e
+            snapshot.save(self.qmp_client(), path, self._overlays)
+            info("Saved VM state to", path)
+        except Exception as e: # pylint: disable=broad-exception-caught
+            # E.g. virtiofs and vfio devices can't be migrated
+            message(color.WARNING(f"Saving VM state failed, booting normally next time: {e}"))
+
+    def discard_snapshot(self):
+        if not self._snapshot_restored:
+            return False
+        from . import snapshot # pylint: disable=import-outside-toplevel
+        snapshot.discard(self._snapshot_path)
+        self._snapshot_restored = False
+        return True
+
+    def drive_files(self):
+        """ image files of the VM's drives and pmem devices """
+        drives = [disk["file"] for disk in self._drives]
+        drives += [pmem["image"] for pmem in self._config.get("virtiopmem", [])]
+        return drives
+
+    def input_files(self):
+        """ files the last boot command booted from: kernel, chainloader, modules, BIOS and
+        drives """
+        return self._kernel_files + self.drive_files()
+
+    def start_paused(self, multiboot, debug, kernel_args, image_name, allow_sudo, enable_kvm):
+        """ start qemu with the VM paused, returning once qemu is ready and connected to QMP.
+        The VM starts running with resume, see prewarm.py """
+        self._start_paused = True
+        try:
+            self.boot_in_hypervisor(multiboot, debug, kernel_args, image_name, allow_sudo, enable_kvm)
+            self.qmp_client()
+        except Exception:
+            self.stop()
+            raise
+        finally:
+            self._start_paused = False
+        return self
+
+    def qmp_args(self):
+        """ create a QMP socket for the next boot, returning the arguments connecting qemu to it.
+        vmrunner listens and qemu connects, which works with qemu running as root too """
+        self.close_qmp()
+        import tempfile # pylint: disable=import-outside-toplevel
+        from . import qmp # pylint: disable=import-outside-toplevel
+        tmp_qmp_dir = tempfile.TemporaryDirectory(prefix="qmp-") # pylint: disable=consider-using-with
+        self._tmp_dirs.append(tmp_qmp_dir)
+        self._qmp = qmp.qmp_client(os.path.join(tmp_qmp_dir.name, "qmp.sock")).listen()
+        return ["-qmp", "unix:" + self._qmp.path]
+
+    def has_qmp(self):
+        return self._qmp is not None
+
+    def qmp_client(self):
+        """ the QMP connection to the running VM, connected on first use """
+        if not self._qmp:
+            raise Exception("The VM has no QMP socket. Enable it with \"qmp\" in the config")
+        if self._proc and self._proc.poll() is not None:
+            raise Exception("The VM has exited")
+        return self._qmp.connect(wait = QMP_CONNECT_TIMEOUT)
+
+    def qmp_execute(self, command, arguments = None):
+        """ run a QMP command on the running VM, returning its reply """
+        return self.qmp_client().execute(command, arguments)
+
+    def pause(self):
+        """ pause the VM's CPUs """
+        return self.qmp_execute("stop")
+
+    def resume(self):
+        """ resume the VM's CPUs after pause """
+        return self.qmp_execute("cont")
+
+    def system_reset(self):
+        """ reset the VM, like pressing the reset button """
+        return self.qmp_execute("system_reset")
+
+    def query_status(self):
+        """ run state of the VM, e.g. {"running": True, "status": "running"} """
+        return self.qmp_execute("query-status")
+
+    def stats(self, target = "vm"):
+        """ statistics for target, "vm" or "vcpu", from accelerators providing them, like KVM """
+        return self.qmp_execute("query-stats", {"target" : target})
+
+    def request_quit(self):
+        """ ask qemu to exit through QMP, without waiting for it. Returns True if asked """
+        if not self._qmp:
+            return False
+        from . import qmp # pylint: disable=import-outside-toplevel
+        try:
+            client = self.qmp_client()
+        except Exception as e: # pylint: disable=broad-exception-caught
+            info("No QMP connection to quit with:", e)
+            return False
+
+        try:
+            client.execute("quit")
+        except ConnectionError:
+            pass # qemu may be gone before replying
+        except (OSError, ValueError, qmp.qmp_error) as e:
+            info("QMP quit failed:", e)
+            return False
+        return True
+
+    def quit(self, timeout = QUIT_TIMEOUT):
+        """ ask qemu to exit through QMP and wait for it. Returns True if it exited in time """
+        if not self._proc or not self.request_quit():
+            return False
+        try:
+            self._proc.wait(timeout)
+        except subprocess.TimeoutExpired:
+            message(color.WARNING(f"Qemu didn't quit within {timeout} seconds"))
+            return False
+        return True
+
+    def close_qmp(self):
+        """ close the QMP connection and socket """
+        if self._qmp:
+            self._qmp.close()
+            self._qmp = None
 
     def stop(self):
 
@@ -797,11 +1101,14 @@ class qemu(hypervisor):
 
         if self._proc and self._proc.poll() is None :
 
-            if not self._sudo:
+            if self.quit():
+                info ("Stopped", self._image_name, "through QMP")
+            elif not self._sudo:
                 info ("Stopping child process (no sudo required)")
                 self._proc.terminate()
             else:
                 # Find and terminate all child processes, since parent is "sudo"
+                import psutil # pylint: disable=import-outside-toplevel
                 parent = psutil.Process(self._proc.pid)
                 children = parent.children()
 
@@ -817,31 +1124,35 @@ class qemu(hypervisor):
             # Wait for termination (avoids the need to reset the terminal etc.)
             self.wait()
 
+        self.close_qmp()
+        self.close_virtiofs()
         return self
 
+    def close_virtiofs(self):
+        """ stop virtiofsd, or keep it for the next VM sharing its directory, see virtiofs.py """
+        if self._virtiofsd:
+            from . import virtiofs # pylint: disable=import-outside-toplevel
+            virtiofs.release(self._virtiofsd, self._config["virtiofs"].get("reuse", False))
+            self._virtiofsd = None
+
     def wait(self):
         """ wait for hypervisor process to exit """
         if self._proc:
             self._proc.wait()
         return self
 
-    def read_until_EOT(self):
-        """ read output from hypervisor until EOT character found """
-        chars = ""
-
-        while not self._proc.poll():
-            char = self._proc.stdout.read(1).decode("utf-8", errors="replace")
-            if char == chr(4):
-                return chars
-            chars += char
-
-        return chars
-
-
 
     def readline(self, filter_all_control_chars = False):
-        if self._proc.poll():
-            raise Exception("Process completed")
+        """ read a line of hypervisor output, returns an empty string when all output has been read """
+        while data := self._reader.readline():
+            # Lines trimmed away entirely, like the end of the SeaBIOS banner, are skipped
+            line = self.decode_line(data, filter_all_control_chars)
+            if line:
+                return line
+        return ""
+
+    def decode_line(self, data, filter_all_control_chars = False):
+        """ turn a line of raw hypervisor output into a string, trimming control sequences """
 
         # SeaBIOS emits a lot of control characters, which looses important information,
         # like the number of reboots and the earliest output from IncludeOS. It also ruins your
@@ -855,7 +1166,7 @@ class qemu(hypervisor):
         # plain string matching.
         #
         if not filter_all_control_chars:
-            line = self._proc.stdout.readline().decode("utf-8", errors="replace")
+            line = data.decode("utf-8", errors="replace")
 
             # Known control sequences to be trimmed
             SeaBIOS_start = "\x1bc\x1b[?7l\x1b[2J\x1b[0m"
@@ -865,7 +1176,7 @@ class qemu(hypervisor):
             if SeaBIOS_start + "SeaBIOS" in line:
                 line = line.split(SeaBIOS_start, 1)[-1]
                 if self._reboots > 0:
-                    print(color.WARNING(f"Reboot detected, #{self._reboots}"))
+                    message(color.WARNING(f"Reboot detected, #{self._reboots}"))
                 self._reboots += 1
 
             # Trim the end sequence (it's on its own line, so remove the whole thing)
@@ -875,46 +1186,15 @@ class qemu(hypervisor):
             return line
 
         # Alternative path in case we want to filter all control chars from other sources as well.
-        control_sequence_pattern = re.compile(r'\x1b.*?[a-zA-Z]')
-
-        # We need to process each character as a raw byte to preserve unicode
-        clean_buffer = bytearray()
-        control_buffer = bytearray()
-        inside_control_sequence = False
-        while True:
-
-            # TODO: find out how slow this is.
-            # if it's not reading from an in-process buffer we should buffer here.
-            char = self._proc.stdout.read(1)
-
-            if not char:
-                break
-
-            if char == b'\n':
-                clean_buffer.append(char[0])
-                break
-
-            if char == b'\x1B':
-                inside_control_sequence = True
-                control_buffer.append(char[0])
-
-            elif inside_control_sequence:
-                control_buffer.append(char[0])
-                if control_sequence_pattern.match(control_buffer.decode("utf-8", errors="replace")):
-                    # Complete control sequence found, discard buffer
-                    inside_control_sequence = False
-                    control_buffer = bytearray()
-
-            else:
-                clean_buffer.append(char[0])
-
-        string = clean_buffer.decode("utf-8", errors="replace")
+        # Each line is run through a state machine, which keeps track of control sequences
+        # split between reads.
+        string = self._stripper.feed(data).decode("utf-8", errors="replace")
 
         if includeos_signature in string:
             self._past_bios = True
 
         if self._past_bios and self._bios_signature in string:
-            print(color.WARNING("Reboot detected"))
+            message(color.WARNING("Reboot detected"))
 
         return string
 
@@ -933,26 +1213,43 @@ class qemu(hypervisor):
 class vm:
     """ VM management class """
 
-    def __init__(self, config = None, hyper_name = "qemu"):
-        """ initialise VM config with specified hypervisor """
+    def __init__(self, config = None, hyper_name = "qemu", exit_program = True):
+        """ initialise VM config with specified hypervisor. With exit_program set to False,
+            failures are reported through the exit status instead of exiting the program """
 
         self._stopping = False
         self._exit_status = None
         self._exit_msg = ""
         self._exit_complete = False
+        self._exit_program = exit_program
 
         self._allow_sudo = False # Set by boot()
         self._enable_kvm = False # Set by boot()
-
-        self._config = load_with_default_config(True, config)
+        self._snapshot_at = None # Set by boot() while the VM state is to be saved
+
+        # Boot phase timings, see metrics.py. Reset by boot()
+        self._metrics = boot_metrics()
+        self._metrics_file = None
+        self._watch_phases = False # Set while the IncludeOS banner hasn't been seen
+
+        # Output handling, see set_output
+        self._echo = True
+        self._captured = None # A memory_sink
+        self._recent = ring_sink() # Context for failure reports, see keep_recent
+        self._sinks = [terminal_sink(), self._recent]
+        self._log = None    # A capture.console_log, see log_to
+        self._log_id = None
+        self._prewarm = 0   # Hypervisors to keep started ahead of time, see prewarm
+
+        self._config = load_with_default_config(True, config, exit_program)
         self._on_success = lambda line : self.exit(exit_codes["SUCCESS"], nametag + " All tests passed")
         self._on_unsafe = lambda line : self.exit(exit_codes["UNSAFE"], nametag + " Tests passed with warnings")
         self._on_panic =  self.panic
         self._on_timeout = self.timeout
-        self._on_output = {
+        self._on_output = output_matcher({
             panic_signature : self._on_panic,
             "FATAL: Random source check failed" : self._on_unsafe,
-            "SUCCESS" : self._on_success }
+            "SUCCESS" : self._on_success })
 
         if hyper_name == "solo5-spt":
             hyper = solo5_spt
@@ -965,26 +1262,209 @@ class vm:
         assert issubclass(hyper, hypervisor)
         self._hyper  = hyper(self._config)
         self._timeout_after = None
-        self._timer = None
+        self._timer = None # The boot timeout, a deadlines.deadline
+        self._expected = [] # (pattern, seconds, callback) from expect, timed from each boot
+        self._pending = [] # (search, deadline) for expected output not seen yet
+        self._counting = False # Set while the deadlines of a boot run
         self._on_exit_success = lambda : None
         self._on_exit = lambda : None
         self._root = os.getcwd()
         self._kvm_present = False
 
+    def set_output(self, echo = True, prefix = None, capture = False, colored = None, sinks = ()):
+        """ choose where VM output goes: printed if echo is set, see sinks.terminal_sink for
+            prefix and colored, kept for output() if capture is set, and written to any other
+            sinks, see sinks.py. Without echo, vmrunner's own status messages aren't printed
+            either """
+        self._echo = echo
+        self._captured = memory_sink() if capture else None
+        self._sinks = list(sinks)
+        if echo:
+            self._sinks.append(terminal_sink(prefix, colored))
+        if self._captured:
+            self._sinks.append(self._captured)
+        self._sinks.append(self._recent)
+        return self
+
+    def output(self):
+        """ lines of VM output captured so far """
+        return self._captured.lines if self._captured else None
+
+    def keep_recent(self, max_lines = RING_LINES, max_chars = RING_CHARS):
+        """ keep the last max_lines lines of output, and at most max_chars characters of them,
+            for recent_output and failure reports """
+        self._sinks.remove(self._recent)
+        self._recent = ring_sink(max_lines, max_chars)
+        self._sinks.append(self._recent)
+        return self
+
+    def recent_output(self):
+        """ the last lines of VM output, see keep_recent """
+        return self._recent.lines()
+
+    def dump_recent(self, reason):
+        """ print the last lines of output as context for a failure, unless the output
+            has been printed already """
+        if self._echo:
+            return
+        lines = self._recent.lines()
+        message(color.WARNING(f"{reason}. Last {len(lines)} lines of VM output:"))
+        for line in lines:
+            message("  | " + line)
+
+    def flush_output(self):
+        """ make sure VM output emitted so far has been written by its sinks """
+        for sink in self._sinks:
+            sink.flush()
+
+    def prewarm(self, count):
+        """ keep count qemu processes for this VM started ahead of time, paused, see prewarm.py.
+            Boots with the same config and arguments claim one and resume it instead of
+            starting qemu, while the next one is started in the background. Boots with
+            snapshot_at or debug, and other hypervisors than qemu, start as usual """
+        self._prewarm = count
+        return self
+
+    def claim_prewarmed(self, boot_args):
+        """ switch to a hypervisor started ahead of time for boot_args and resume it.
+            Returns False if there was none """
+        debug = boot_args[1]
+        if not isinstance(self._hyper, qemu) or debug:
+            return False
+
+        from . import prewarm # pylint: disable=import-outside-toplevel
+        # The pool starts hypervisors from another thread, with a config of their own
+        config = copy.deepcopy(self._config)
+        hyper = prewarm.pool.claim(prewarm.key(config, boot_args), self._prewarm,
+                                   lambda : qemu(config).start_paused(*boot_args))
+        if hyper is None:
+            return False
+
+        try:
+            hyper.resume()
+        except Exception as e: # pylint: disable=broad-exception-caught
+            message(color.WARNING(f"Couldn't resume a VM started ahead of time: {e}"))
+            hyper.stop()
+            return False
+
+        info("Resumed", hyper.image_name(), "started ahead of time")
+        self._hyper = hyper
+        return True
+
+    def log_to(self, log, vm_id):
+        """ also write VM output to log, a capture.console_log, as vm_id. None stops logging """
+        self._log = log
+        self._log_id = vm_id
+        return self
+
+    def emit(self, line, source = "console"):
+        """ print, capture and / or log a line of VM output. source is where it came from
+        in the log, e.g. "panic" for output read after a panic """
+        if self._log:
+            self._log.write(self._log_id, source, line)
+
+        for sink in self._sinks:
+            sink.write(line)
+
+    def exit_status(self):
+        """ exit status, or None while running """
+        return self._exit_status
+
+    def exit_msg(self):
+        """ message describing the exit status """
+        return self._exit_msg
+
+    def metrics(self):
+        """ timings of the boot phases of the last boot, a metrics.boot_metrics """
+        return self._metrics
+
+    def finish_metrics(self):
+        """ record when the hypervisor process was reaped, and write the metrics if asked to """
+        first_output = self._hyper.first_output()
+        if first_output is not None:
+            self._metrics.mark("first_byte", first_output)
+        if self._hyper.has_process() and self.poll() is not None:
+            self._metrics.mark("reap")
+
+        info("Boot phases:", self._metrics.summary())
+        if not self._metrics_file:
+            return
+
+        try:
+            self._metrics.write_json(self._metrics_file, image = str(self._hyper.image_name()),
+                                     hypervisor = self._hyper.name(),
+                                     exit_status = self._exit_status,
+                                     status = get_exit_code_name(self._exit_status))
+        except OSError as e:
+            message(color.WARNING(f"Couldn't write boot metrics to {self._metrics_file}: {e}"))
+
+    def log_exit(self):
+        """ log the exit status, and write the log so far """
+        if not self._log:
+            return
+        self._log.write(self._log_id, "vmrunner", f"exit status {self._exit_status} "
+                        f"({get_exit_code_name(self._exit_status)}): {self._exit_msg}")
+        self._log.flush()
+
     def stop(self):
         """ stop hypervisor """
         self.flush()
         self._hyper.stop().wait()
+        self.cancel_deadlines()
+        return self
+
+    def deadline(self, seconds, callback):
+        """ call callback in seconds unless the returned deadline is cancelled, see
+            deadlines.py. Callbacks run on the scheduler's worker thread, as they may block
+            stopping the VM """
+        return deadlines.after(seconds, callback, blocking = True)
+
+    def cancel_deadlines(self):
+        """ cancel the timeout and output expected by expect """
+        self._counting = False
         if self._timer:
             self._timer.cancel()
+        for _, deadline in self._pending:
+            deadline.cancel()
+        self._pending = []
+
+    def extend_timeout(self, seconds):
+        """ give the running VM seconds more before it times out """
+        if self._timer and self._timer.extend(seconds):
+            self._timeout_after += seconds
+        return self
+
+    def expect(self, output, within, callback = None):
+        """ expect output, a pattern like for on_output, within seconds. The time is counted
+            from boot, or from now if the VM is running. If output isn't seen in time, callback
+            is called, by default failing the VM with exit status TIMEOUT """
+        if callback is None:
+            callback = functools.partial(self.missed, output, within)
+        if self._counting:
+            self.start_expecting(output, within, callback)
+        else:
+            self._expected.append((output, within, callback))
         return self
 
+    def start_expecting(self, output, within, callback):
+        """ start the deadline for output expected within seconds """
+        search = (lambda line : output in line) if is_literal(output) else re.compile(output).search
+        self._pending.append((search, self.deadline(within, callback)))
+
+    def check_expected(self, line):
+        """ cancel the deadlines of expected output found in line """
+        for item in list(self._pending):
+            search, deadline = item
+            if not deadline.pending or search(line):
+                deadline.cancel()
+                self._pending.remove(item)
+
     def flush(self):
         """ read and output remaining lines from hypervisor """
         if not self._hyper.has_process():
             return
 
-        while self._exit_status is None and self.poll() is None:
+        while self._exit_status is None:
             try:
                 line = self._hyper.readline()
             except Exception as e:
@@ -992,22 +1472,20 @@ class vm:
                 # because it stops us by sending sigterm to the parent process and all children.
                 # In that case an exception is expected, but not otherwise.
                 if signal is None:
-                    print(color.WARNING(f"Exception thrown while waiting for vm output: {e}"))
+                    message(color.WARNING(f"Exception thrown while waiting for vm output: {e}"))
                 break
 
-            if line and (self.find_exit_status(line) is None):
-                print(color.VM(line.rstrip()))
-                self.trigger_event(line)
+            # Empty line - all output has been read, e.g. the process exited
+            if not line:
+                break
 
-            # Empty line - should only happen if process exited
-            else:
-                pass
+            self.handle_line(line)
 
 
     def wait(self):
         """ wait """
         if hasattr(self, "_timer") and self._timer:
-            self._timer.join()
+            self._timer.wait()
         self._hyper.wait()
         return self._exit_status
 
@@ -1025,6 +1503,9 @@ class vm:
         self._exit_status = status
         self._exit_msg = msg
         self.stop()
+        self.finish_metrics()
+        self.log_exit()
+        self.flush_output()
 
         # Change back to test source
         os.chdir(self._root)
@@ -1046,32 +1527,43 @@ class vm:
                 info("Calling on_exit_success")
                 self._on_exit_success()
 
-            print(color.SUCCESS(msg))
+            if self._echo:
+                message(color.SUCCESS(msg))
             self._exit_complete = True
             return
 
         self._exit_complete = True
-        program_exit(status, msg)
+        if self._exit_program:
+            program_exit(status, msg)
 
     def timeout(self):
         """ Default timeout event """
         if VERB:
-            print(color.INFO("<timeout>"), "VM timed out")
+            message(color.INFO("<timeout>"), "VM timed out")
 
         # Note: we have to stop the VM since the main thread is blocking on vm.readline
         self._exit_status = exit_codes["TIMEOUT"]
         self._exit_msg = "vmrunner timed out after " + str(self._timeout_after) + " seconds"
         self._hyper.stop().wait()
+        self.dump_recent("VM timed out")
+
+    def missed(self, output, seconds):
+        """ Default event for output expected by expect that wasn't seen in time """
+        self._exit_status = exit_codes["TIMEOUT"]
+        self._exit_msg = f"{output} not seen within {seconds} seconds"
+        self._hyper.stop().wait()
+        self.dump_recent(self._exit_msg)
 
     def panic(self, _):
         """ Default panic event """
         panic_reason = self._hyper.readline()
         info("VM signalled PANIC. Reading until EOT (", hex(ord(EOT)), ")")
-        print(color.VM(panic_reason), end=' ')
+        self.emit(panic_reason.rstrip(), "panic")
         remaining_output = self._hyper.read_until_EOT()
         for line in remaining_output.split("\n"):
-            print(color.VM(line))
+            self.emit(line, "panic")
 
+        self.dump_recent("VM panicked")
         self.exit(exit_codes["VM_PANIC"], panic_reason)
 
 
@@ -1129,6 +1621,7 @@ class vm:
 
             self._exit_status = int(line.split(" ")[-1].rstrip())
             self._exit_msg = "Service exited with status " + str(self._exit_status)
+            self._metrics.mark("exit_line")
             return self._exit_status
 
         # Special case for end-of-transmission, e.g. on panic
@@ -1138,28 +1631,58 @@ class vm:
 
         return None
 
+    def handle_line(self, line):
+        """ process a line of VM output: check for exit status, emit it and trigger events """
+        if self._watch_phases:
+            self.mark_phases(line)
+        if self._pending:
+            self.check_expected(line)
+
+        # Saved before the line is acted on, which may stop the VM
+        if self._snapshot_at and self._snapshot_at in line:
+            self._snapshot_at = None
+            self._hyper.save_snapshot()
+
+        if self.find_exit_status(line) is None:
+            self.emit(line.rstrip())
+            self.trigger_event(line)
+
+    def mark_phases(self, line):
+        """ record the boot phases a line of output shows, until the IncludeOS banner """
+        if bios_signature in line:
+            self._metrics.mark("bios")
+        if includeos_signature in line:
+            self._metrics.mark("signature")
+            self._watch_phases = False
+
     def trigger_event(self, line):
         """ Find any callback triggered by this line """
-        for pattern, func in self._on_output.items():
-            if re.search(pattern, str(line)):
-                try:
-                    # Call it
-                    res = func(line)
-                except Exception:
-                    print(color.WARNING("Exception raised in event callback: "))
-                    print_exception()
-                    res = False
-                    self.stop()
-
-                # NOTE: Result can be 'None' without problem
-                if res is False:
-                    self._exit_status = exit_codes["CALLBACK_FAILED"]
-                    self.exit(self._exit_status, " Event-triggered test failed")
+        for func in self._on_output.match(str(line)):
+            self._metrics.mark("first_match")
+            try:
+                # Call it
+                res = func(line)
+            except Exception:
+                message(color.WARNING("Exception raised in event callback: "))
+                print_exception()
+                res = False
+
+            # NOTE: Result can be 'None' without problem
+            if res is False:
+                self.dump_recent("Event callback failed")
+                self._exit_status = exit_codes["CALLBACK_FAILED"]
+                self.exit(self._exit_status, " Event-triggered test failed")
 
 
     def boot(self, timeout = 60, multiboot = True, debug = False, kernel_args = "booted with vmrunner",
-             image_name = None, allow_sudo = False, enable_kvm = False):
-        """ Boot the VM and start reading output. This is the main event loop. """
+             image_name = None, allow_sudo = False, enable_kvm = False, snapshot_at = None,
+             metrics_file = None):
+        """ Boot the VM and start reading output. This is the main event loop.
+
+        With snapshot_at set, the VM state is saved the first time snapshot_at is seen in the
+        output, and later boots with the same command line, kernel and drives are restored
+        from it instead of booting from scratch. Timings of the boot phases are kept in
+        metrics(), and written to metrics_file as JSON if set """
         info ("VM boot, timeout: ", timeout, "multiboot: ", multiboot, "Kernel_args: ", kernel_args,
               "image_name: ", image_name, allow_sudo, "allow_sudo")
 
@@ -1170,39 +1693,51 @@ class vm:
         self._exit_status = None
         self._exit_complete = False
         self._timeout_after = timeout
+        self._metrics = boot_metrics()
+        self._metrics_file = metrics_file
+        self._watch_phases = True
 
-        # Start the timeout thread
+        # Start the timeout, and deadlines for expected output
+        self.cancel_deadlines()
+        self._counting = True
+        self._timer = None
         if timeout:
             info("setting timeout to",timeout,"seconds")
-            self._timer = threading.Timer(timeout, self._on_timeout)
-            self._timer.start()
+            self._timer = self.deadline(timeout, self._on_timeout)
+        for expected in self._expected:
+            self.start_expecting(*expected)
 
         # Boot via hypervisor
         try:
-            self._hyper.boot_in_hypervisor(multiboot, debug, kernel_args, image_name, allow_sudo, enable_kvm)
+            self._hyper.set_snapshot(snapshot_at)
+            boot_args = (multiboot, debug, kernel_args, image_name, allow_sudo, enable_kvm)
+            if not (self._prewarm and not snapshot_at and self.claim_prewarmed(boot_args)):
+                self._hyper.boot_in_hypervisor(*boot_args)
+            self._metrics.mark("spawn")
+            # pylint: disable-next=assignment-from-none
+            self._snapshot_at = self._hyper.snapshot_marker()
         except Exception as err:
-            print(color.WARNING("Exception raised while booting: "))
+            message(color.WARNING("Exception raised while booting: "))
             print_exception()
-            if timeout:
-                self._timer.cancel()
+            self.cancel_deadlines()
             self.exit(exit_codes["BOOT_FAILED"], str(err))
+            return self
 
-        # Start analyzing output
-        while self._exit_status is None and self.poll() is None:
+        # Start analyzing output. Lines are read until the process closes its output,
+        # which avoids polling the process for every line.
+        while self._exit_status is None:
 
             try:
                 line = self._hyper.readline()
             except Exception as e:
-                print(color.WARNING(f"Exception thrown while waiting for vm output: {e}"))
+                message(color.WARNING(f"Exception thrown while waiting for vm output: {e}"))
                 break
 
-            if line and (self.find_exit_status(line) is None):
-                print(color.VM(line.rstrip()))
-                self.trigger_event(line)
+            # Empty line - all output has been read, e.g. the process exited
+            if not line:
+                break
 
-            # Empty line - should only happen if process exited
-            else:
-                pass
+            self.handle_line(line)
 
 
         # VM Done
@@ -1218,22 +1753,20 @@ class vm:
 
             info("No poll - getting final output")
             try:
-                data, err = self._hyper.get_final_output()
-
-                # Print stderr if exit status wasnt 0
-                if err and self.poll() != 0:
-                    print(color.WARNING("Stderr: \n" + err))
-
-                # Parse the last output from vm
-                lines = data.split("\n")
-                for line in lines:
-                    print(color.VM(line))
+                # Parse the last output from vm, line by line so it's never all in memory
+                while line := self._hyper.readline():
+                    self.emit(line.rstrip())
                     self.find_exit_status(line)
                     # Note: keep going. Might find panic after service exit
 
             except Exception:
                 pass
 
+        # A restored VM dying on its own is most likely a state qemu couldn't load
+        if self._exit_status is None and self.poll() and self._hyper.discard_snapshot():
+            message(color.WARNING("VM exited after restoring a saved state. The state is "
+                                "discarded, the next boot starts from scratch"))
+
         # We should now have an exit status, either from a callback or VM EOT / exit msg.
         if self._exit_status is not None:
             info("VM has exit status. Exiting.")
@@ -1244,17 +1777,17 @@ class vm:
         # If everything went well we can return
         return self
 
-def load_with_default_config(use_default, path = default_json):
+def load_with_default_config(use_default, path = default_json, exit_on_error = True):
     """ load user config, optionally return defaults with user specified values modified """
 
     # load default config
     conf = {}
     if use_default:
         info("Loading default config.")
-        conf = load_config(default_config)
+        conf = load_config(default_config_path(), exit_on_error)
 
     # load user config (or fallback)
-    user_conf = load_config(path)
+    user_conf = load_config(path, exit_on_error)
 
     if user_conf:
         if not use_default:
@@ -1268,8 +1801,8 @@ def load_with_default_config(use_default, path = default_json):
 
     return conf
 
-def load_config(path):
-    """ Load a vm config """
+def load_config(path, exit_on_error = True):
+    """ Load a vm config. Invalid configs exit the program, or raise if exit_on_error is False """
 
     config = {}
     description = None
@@ -1290,16 +1823,20 @@ def load_config(path):
         except Exception as e:
             print_exception()
             info("Could not parse VM config file(s): " + path)
+            if not exit_on_error:
+                raise
             program_exit(73, str(e))
 
     elif os.path.isdir(path):
         try:
-            configs = validate_vm.load_config(path, VERB)
+            configs = validate_vm.load_config(path, VERB, first = True)
             info ("Found ", len(configs), "config files")
             config = configs[0]
             info ("Trying the first valid config ")
         except Exception as e:
             info("No valid config found: ", e)
+            if not exit_on_error:
+                raise Exception("No valid config files in " + path) from e
             program_exit(73, "No valid config files in " + path)
 
 
@@ -1319,17 +1856,20 @@ def program_exit(status, msg):
     info("Program exit called with status", status, "(",get_exit_code_name(status),")")
     info("Stopping all vms")
 
-    for vm_ in vms:
+    with _vms_lock:
+        running = list(_vms)
+
+    for vm_ in running:
         vm_.stop().wait()
 
     # Print status message and exit with appropriate code
     if get_exit_code_name(status) == "UNSAFE":
-        print(color.WARNING("Do not rely on this image for secure applications."))
+        message(color.WARNING("Do not rely on this image for secure applications."))
         status = 0
     if status != 0:
-        print(color.EXIT_ERROR(get_exit_code_name(status), msg))
+        message(color.EXIT_ERROR(get_exit_code_name(status), msg))
     else:
-        print(color.SUCCESS(msg))
+        message(color.SUCCESS(msg))
 
     sys.exit(status)
 
@@ -1337,22 +1877,73 @@ def program_exit(status, msg):
 def add_vm(**kwargs):
     """ Call this to add a new vm to the vms list as well. This ensures proper termination """
     new_vm = vm(**kwargs)
-    vms.append(new_vm)
+    register_vm(new_vm)
     return new_vm
 
+def register_vm(vm_):
+    """ add a vm to the vms list, so that it's stopped on SIGINT / SIGTERM """
+    install_signal_handlers()
+    with _vms_lock:
+        _vms.append(vm_)
+
+def unregister_vm(vm_):
+    """ remove a vm from the vms list """
+    with _vms_lock:
+        if vm_ in _vms:
+            _vms.remove(vm_)
+
+def add_signal_callback(callback):
+    """ call callback(signum) on SIGINT / SIGTERM, before the vms are stopped. E.g. pools
+        use this to stop starting new vms """
+    install_signal_handlers()
+    with _vms_lock:
+        _signal_callbacks.append(callback)
+
+def remove_signal_callback(callback):
+    """ undo add_signal_callback """
+    with _vms_lock:
+        if callback in _signal_callbacks:
+            _signal_callbacks.remove(callback)
+
 def handler(signum, _):
     """ Handler for signals """
-    print(color.WARNING(f"Process interrupted by signal {signum} - stopping vms"))
-    for vm_ in vms:
+    message(color.WARNING(f"Process interrupted by signal {signum} - stopping vms"))
+
+    with _vms_lock:
+        callbacks = list(_signal_callbacks)
+    for callback in callbacks:
+        callback(signum)
+
+    with _vms_lock:
+        running = list(_vms)
+
+    for vm_ in running:
         try:
             vm_.exit(exit_codes["ABORT"], "Process terminated by user")
         except Exception as e:
-            print(color.WARNING("Forced shutdown caused exception: "), e)
+            message(color.WARNING("Forced shutdown caused exception: "), e)
             raise e
 
+def install_signal_handlers():
+    """ stop all vms on SIGINT / SIGTERM. Signal handlers can only be installed from the
+        main thread, elsewhere this does nothing """
+    global _handlers_installed # pylint: disable=global-statement
+    with _vms_lock:
+        if _handlers_installed or threading.current_thread() is not threading.main_thread():
+            return
 
-# One unconfigured vm is created by default, which will try to load a config if booted
-vms.append(vm())
-
-signal.signal(signal.SIGTERM, handler)
-signal.signal(signal.SIGINT, handler)
+        signal.signal(signal.SIGTERM, handler)
+        signal.signal(signal.SIGINT, handler)
+        _handlers_installed = True
+
+def init():
+    """ Create the default vm as vms[0] and install signal handlers, unless done already.
+        The default vm loads and validates its config, the defaults updated with ./vm.json if
+        there is one, when it's created here. Returns vms """
+    global _default_vm # pylint: disable=global-statement
+    install_signal_handlers()
+    with _vms_lock:
+        if _default_vm is None:
+            _default_vm = vm()
+            _vms.insert(0, _default_vm)
+    return _vms